@@ -10,23 +10,49 @@
 # Updated: Added new tools - git_ops, db_query, shell_exec, code_lint, api_simulate.
 import streamlit as st
 import os
-from openai import OpenAI  # Using OpenAI SDK for xAI compatibility and streaming
+import openai
+from openai import OpenAI, DefaultHttpxClient  # Using OpenAI SDK for xAI compatibility and streaming
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient  # Async core (many conversations per event loop)
+import asyncio
+import weakref  # Per-event-loop async client registry
+import httpx  # Bundled with openai; used for connection pool limits/timeouts
+import threading  # For thread-safe client stats
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # Optional metrics exporter port
+import multiprocessing  # For the code_lint process pool
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future  # Concurrent tool calls
+import concurrent.futures  # TimeoutError while waiting on the async bridge
 from passlib.hash import sha256_crypt
 import sqlite3
 from dotenv import load_dotenv
 import json
 import time
+import random  # For retry jitter
+import math  # Percentiles for latency metrics
+import bisect  # Histogram buckets for the metrics exporter
+import email.utils  # For HTTP-date Retry-After headers
+import hashlib  # For response cache keys
+import uuid  # Session/turn ids for latency metrics
+from collections import OrderedDict, deque  # LRU for the response cache; queued tool calls
 import base64  # For image handling
 import traceback  # For error logging
+import logging  # Structured, queue-backed app logging
+import logging.handlers
+import queue
+import contextvars  # Per-session/turn ids on log records
+import copy
+import atexit
+import cProfile  # Opt-in profiling mode
+import pstats
+import tracemalloc
+import contextlib
 import html  # For escaping content to prevent rendering errors
 import re  # For regex in code detection
-import ntplib  # For NTP time sync; pip install ntplib
 import io  # For capturing code output
 import sys  # For stdout redirection
-import pygit2  # For git_ops; pip install pygit2
 import subprocess  # Already imported, but explicit
-import requests  # For api_simulate; pip install requests
-from black import format_str, FileMode  # For code_lint; pip install black
+import importlib  # Lazy optional imports: pygit2 (git_ops), black (code_lint), requests (api_simulate), ntplib (time sync)
+import importlib.util
+import functools  # Process-wide resource getters
 
 # Load environment variables
 load_dotenv()
@@ -34,28 +60,583 @@ API_KEY = os.getenv("XAI_API_KEY")
 if not API_KEY:
     st.error("XAI_API_KEY not set in .env! Please add it and restart.")
 
+# NEW: Process-Wide Resources (built on first use, then shared by every rerun and session)
+class ResourceRegistry:
+    """Objects built once per process, keyed by the getter's code and arguments. st.cache_resource hashes each
+    decorated function's source (inspect.getsource) whenever the decorator runs, i.e. on every rerun for every
+    module-level getter; the registry itself is the only cache_resource lookup a rerun pays for them."""
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.RLock()  # Reentrant: building one resource may call other getters
+
+    def get(self, factory, args: tuple, kwargs: dict):
+        code = factory.__code__
+        key = (factory.__qualname__, code.co_code, code.co_consts, factory.__defaults__, args, tuple(sorted(kwargs.items())))
+        try:
+            return self._objects[key]
+        except KeyError:
+            pass
+        with self._lock:
+            if key not in self._objects:
+                self._objects[key] = factory(*args, **kwargs)
+            return self._objects[key]
+
+@st.cache_resource(show_spinner=False)
+def get_resource_registry() -> ResourceRegistry:
+    return ResourceRegistry()
+
+RESOURCES = get_resource_registry()  # "Clear cache" in the Streamlit menu drops it, so everything is rebuilt
+
+def process_resource(factory):
+    """Decorator for module-level getters: factory(*args) runs once per process and argument tuple, like
+    st.cache_resource, but without re-hashing the getter's source on every rerun. A changed getter body (new code)
+    builds a new object, as st.cache_resource does."""
+    @functools.wraps(factory)
+    def getter(*args, **kwargs):
+        return RESOURCES.get(factory, args, kwargs)
+    return getter
+
+# NEW: Structured Logging (hot paths only enqueue; a QueueListener thread writes rotated JSON lines to app.log)
+LOG_FILE = os.getenv("LOG_FILE", "app.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # Rotate app.log at this size
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # Default for all grokcoder.* loggers
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")  # Per-module overrides, e.g. "grokcoder.api=DEBUG,grokcoder.tools=WARNING"
+LOG_CONSOLE_LEVEL = os.getenv("LOG_CONSOLE_LEVEL", "INFO")  # Console copy of the log ("OFF" to disable)
+LOG_ID_FIELDS = ("session", "user", "convo_id", "turn")
+LOG_CONTEXT = contextvars.ContextVar("grokcoder_log_context", default=None)
+
+log_app = logging.getLogger("grokcoder.app")
+log_api = logging.getLogger("grokcoder.api")
+log_tools = logging.getLogger("grokcoder.tools")
+log_db = logging.getLogger("grokcoder.db")
+
+def set_log_context(**ids):
+    """Set session/user/convo_id/turn ids for log records emitted from the current thread or task."""
+    LOG_CONTEXT.set({**(LOG_CONTEXT.get() or {}), **ids})
+
+def log_ids() -> dict:
+    """Snapshot of the current ids, for passing as `extra=` from threads that do not share the context."""
+    return dict(LOG_CONTEXT.get() or {})
+
+class LogContextFilter(logging.Filter):
+    """Stamps records with the emitting context's ids (explicit `extra=` values win)."""
+    def filter(self, record):
+        ids = LOG_CONTEXT.get() or {}
+        for field in LOG_ID_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, ids.get(field))
+        return True
+
+class FastQueueHandler(logging.handlers.QueueHandler):
+    """Like QueueHandler, but leaves formatting to the listener: only merges args and renders a traceback."""
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info))
+            record.exc_info = None
+        return record
+
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f".{int(record.msecs):03d}",
+                 "level": record.levelname, "logger": record.name, "thread": record.threadName, "msg": record.getMessage()}
+        for field in LOG_ID_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+def parse_log_levels(spec: str) -> dict:
+    """Parse 'grokcoder.api=DEBUG,grokcoder.tools=WARNING' into {logger name: level name}."""
+    levels = {}
+    for item in (spec or "").split(','):
+        name, sep, level = item.partition('=')
+        if sep and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+@process_resource
+def get_log_listener():
+    """Configure the grokcoder loggers once per process; the listener thread owns all file/console I/O."""
+    root = logging.getLogger("grokcoder")
+    root.setLevel(LOG_LEVEL.upper())
+    root.propagate = False
+    for name, level in parse_log_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+    file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    file_handler.setFormatter(JsonLineFormatter())
+    handlers = [file_handler]
+    if LOG_CONSOLE_LEVEL.upper() != "OFF":
+        console = logging.StreamHandler()
+        console.setLevel(LOG_CONSOLE_LEVEL.upper())
+        console.setFormatter(logging.Formatter("[%(levelname)s] %(name)s: %(message)s"))
+        handlers.append(console)
+    log_queue = queue.SimpleQueue()
+    queue_handler = FastQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    root.handlers = [queue_handler]
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Drain queued records on shutdown
+    return listener
+
+get_log_listener()
+
 # Database Setup (SQLite for users and history) with WAL mode for concurrency
-conn = sqlite3.connect('chatapp.db', check_same_thread=False)
-conn.execute("PRAGMA journal_mode=WAL;")
-c = conn.cursor()
-c.execute('''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT)''')
-c.execute('''CREATE TABLE IF NOT EXISTS history (user TEXT, convo_id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT, messages TEXT)''')
-
-# NEW: Memory table for hybrid hierarchy (key-value with timestamp/index for fast queries)
-c.execute('''CREATE TABLE IF NOT EXISTS memory (
+# NEW: One-time bootstrap: the schema runs once per process in get_db(), not on every rerun
+DB_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT)''',
+    # NEW: Normalized append-only history: one row per conversation, one row per message keyed by (convo_id, seq)
+    '''CREATE TABLE IF NOT EXISTS conversations (
+    convo_id INTEGER PRIMARY KEY AUTOINCREMENT,
     user TEXT,
-    convo_id INTEGER,  -- Links to history for per-session
+    title TEXT,
+    message_count INTEGER DEFAULT 0,  -- Next seq to write
+    created DATETIME DEFAULT CURRENT_TIMESTAMP,
+    updated DATETIME DEFAULT CURRENT_TIMESTAMP
+)''',
+    'CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations (user, updated DESC, convo_id DESC)',  # Sidebar keyset pages
+    '''CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,  -- Stable rowid
+    convo_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,  -- Position in the conversation (0-based)
+    role TEXT,
+    content TEXT,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (convo_id, seq)
+)''',
+    # NEW: Memory table for hybrid hierarchy (key-value with timestamp/index for fast queries)
+    '''CREATE TABLE IF NOT EXISTS memory (
+    user TEXT,
+    convo_id INTEGER,  -- Links to conversations for per-session
     mem_key TEXT,
     mem_value TEXT,  -- JSON string for flexibility (e.g., logs as dicts)
     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
     PRIMARY KEY (user, convo_id, mem_key)
-)''')
-c.execute('CREATE INDEX IF NOT EXISTS idx_memory_timestamp ON memory (timestamp)')  # For fast time-based queries
-conn.commit()
+)''',
+    'CREATE INDEX IF NOT EXISTS idx_memory_timestamp ON memory (timestamp)',  # For fast time-based queries
+    # NEW: Per-turn latency metrics (one row per measurement; ms, or tokens for *_tokens metrics)
+    '''CREATE TABLE IF NOT EXISTS metrics (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT,
+    session_id TEXT,
+    convo_id INTEGER,
+    turn_id TEXT,
+    metric TEXT,  -- e.g. ttft, api_iteration, tool, db_commit, render_stream
+    label TEXT,  -- Tool name or iteration number
+    value REAL,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+)''',
+    'CREATE INDEX IF NOT EXISTS idx_metrics_session ON metrics (session_id, metric)',
+    # NEW: Token usage per API iteration (turn, conversation and user totals are sums; cost in USD at MODEL_PRICES)
+    '''CREATE TABLE IF NOT EXISTS token_usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT,
+    session_id TEXT,
+    convo_id INTEGER,
+    turn_id TEXT,
+    model TEXT,
+    iteration INTEGER,  -- Tool-loop step within the turn (1 = first request)
+    prompt TEXT,  -- System prompt file, if one was selected
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    total_tokens INTEGER,
+    cost REAL,  -- NULL for models without a price
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+)''',
+    'CREATE INDEX IF NOT EXISTS idx_token_usage_user ON token_usage (user, convo_id)',
+]
+
+def migrate_history(db: sqlite3.Connection):
+    """One-time move of the legacy `history` table (a full JSON copy of the transcript per turn) into
+    conversations/messages. A row whose messages extend an earlier row's is a later snapshot of the same chat, so the
+    chain becomes one conversation under its first convo_id, and memory/metrics/usage rows of the later snapshots are
+    re-pointed to it. The old table is kept as history_legacy."""
+    if not db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='history'").fetchone():
+        return
+    rows = db.execute("SELECT user, convo_id, title, messages FROM history ORDER BY convo_id").fetchall()
+    conversations = []  # [convo_id, user, title, messages]
+    open_chains = {}  # (user, first message) -> conversations that a later snapshot may extend
+    remap = []  # (snapshot convo_id, surviving convo_id), oldest first
+    for user, convo_id, title, raw in rows:
+        try:
+            messages = json.loads(raw or "[]")
+        except ValueError:
+            log_db.warning("Skipping unreadable history row %s", convo_id)
+            continue
+        key = (user, json.dumps(messages[0], sort_keys=True) if messages else None)
+        for convo in open_chains.get(key, []):
+            if len(convo[3]) <= len(messages) and messages[:len(convo[3])] == convo[3]:
+                convo[3] = messages
+                remap.append((convo_id, convo[0]))
+                break
+        else:
+            convo = [convo_id, user, title, messages]
+            conversations.append(convo)
+            open_chains.setdefault(key, []).append(convo)
+    with db:
+        for convo_id, user, title, messages in conversations:
+            db.execute("INSERT INTO conversations (convo_id, user, title, message_count) VALUES (?, ?, ?, ?)",
+                       (convo_id, user, title, len(messages)))
+            db.executemany("INSERT INTO messages (convo_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                           [(convo_id, seq, msg.get('role'), msg.get('content')) for seq, msg in enumerate(messages)])
+        for old_id, new_id in remap:
+            db.execute("UPDATE OR REPLACE memory SET convo_id=? WHERE convo_id=?", (new_id, old_id))  # Later snapshot's value wins
+            db.execute("UPDATE metrics SET convo_id=? WHERE convo_id=?", (new_id, old_id))
+            db.execute("UPDATE token_usage SET convo_id=? WHERE convo_id=?", (new_id, old_id))
+        if rows:  # New conversations must not reuse any old convo_id (stale references elsewhere)
+            db.execute("UPDATE sqlite_sequence SET seq=max(seq, ?) WHERE name='conversations'", (rows[-1][1],))
+        db.execute("ALTER TABLE history RENAME TO history_legacy")
+    log_db.info("Migrated %d history rows into %d conversations", len(rows), len(conversations))
+
+# NEW: Full-text search over message content (FTS5 external-content index on messages, kept in sync by triggers)
+MESSAGE_SEARCH_SCHEMA = [
+    # Indexes messages.content without a second copy of the text; rowid = messages.id. prefix= speeds up "term*"
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+)""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END""",
+]
+
+def setup_message_search(db: sqlite3.Connection) -> bool:
+    """Create the FTS5 index and its triggers; a new index is backfilled from existing messages. Returns False
+    (message search disabled, title search still works) when this SQLite build lacks FTS5."""
+    exists = db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages_fts'").fetchone()
+    try:
+        with db:
+            for statement in MESSAGE_SEARCH_SCHEMA:
+                db.execute(statement)
+            if not exists:
+                db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError as e:  # "no such module: fts5"
+        log_db.warning("Message search disabled: %s", e)
+        return False
+    return True
+
+# NEW: SQLite Connection Manager (per-thread read connections + one writer thread that batches writes into transactions)
+DB_PATH = os.getenv("DB_PATH", "chatapp.db")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))  # Wait this long on a lock instead of failing
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "8192"))  # Page cache per connection
+DB_MMAP_SIZE_MB = int(os.getenv("DB_MMAP_SIZE_MB", "64"))  # Memory-mapped reads (shared OS page cache; 0 = off)
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "64"))  # Max queued writes committed in one transaction
+
+class DatabaseManager:
+    """chatapp.db access for every session and thread. Reads use a connection private to the calling thread
+    (query_only), so no cursor or connection is ever shared. All writes go through one writer thread: queued jobs are
+    drained into a single transaction (group commit: one WAL sync for everything that arrived together), each job
+    in its own savepoint so one failing job does not undo the others. SQLite allows one writer at a time anyway;
+    queueing in-process means sessions never contend for the lock or see "database is locked"."""
+    def __init__(self, path: str):
+        self.path = path
+        self.writer_connection = self._connect()  # Used for bootstrap, then only by the writer thread
+        self._local = threading.local()
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self.writes = 0
+        self.batches = 0
+        self.max_batch = 0
+
+    def _connect(self, query_only: bool = False) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        db.execute("PRAGMA synchronous=NORMAL")  # Durable across app crashes under WAL; fsync at checkpoints
+        db.execute(f"PRAGMA cache_size={-DB_CACHE_SIZE_KB}")
+        db.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE_MB * 1024 * 1024}")
+        if query_only:
+            db.execute("PRAGMA query_only=ON")
+        return db
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)  # Queued writes are committed before the interpreter exits
+
+    # Reads (calling thread's own connection; each statement sees the latest committed writes)
+    def reader(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self._connect(query_only=True)
+        return db
+
+    def query(self, sql: str, params=()) -> list:
+        return self.reader().execute(sql, params).fetchall()
+
+    def query_one(self, sql: str, params=()):
+        return self.reader().execute(sql, params).fetchone()
+
+    # Writes (run on the writer thread; the caller blocks until its transaction has committed)
+    def submit(self, fn, *args) -> Future:
+        """Queue fn(cursor, *args) for the writer thread; the Future resolves after commit. fn must not commit."""
+        future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def write(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    def execute(self, sql: str, params=()) -> int:
+        """One write statement; returns its lastrowid."""
+        return self.write(lambda cur: cur.execute(sql, params).lastrowid)
+
+    def executemany(self, sql: str, rows: list):
+        self.write(lambda cur: cur.executemany(sql, rows))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < DB_WRITE_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            jobs = [job for job in batch if job is not None and job[0].set_running_or_notify_cancel()]
+            if jobs:
+                self._commit(jobs)
+            if stop:
+                return
+
+    def _commit(self, jobs: list):
+        cur = self.writer_connection.cursor()
+        results = []
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            for future, fn, args in jobs:
+                cur.execute("SAVEPOINT job")
+                try:
+                    results.append((future, fn(cur, *args), None))
+                    cur.execute("RELEASE job")
+                except Exception as e:
+                    cur.execute("ROLLBACK TO job")
+                    cur.execute("RELEASE job")
+                    results.append((future, None, e))
+            self.writer_connection.commit()
+        except Exception as e:  # BEGIN or COMMIT failed (e.g. disk full): nothing in this batch was written
+            note_sqlite_error(e)
+            log_db.error("Write batch of %d failed: %s", len(jobs), e)
+            if self.writer_connection.in_transaction:
+                self.writer_connection.rollback()
+            results = [(future, None, e) for future, _, _ in jobs]
+        with self._stats_lock:
+            self.writes += len(jobs)
+            self.batches += 1
+            self.max_batch = max(self.max_batch, len(jobs))
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {"writes": self.writes, "batches": self.batches, "max_batch": self.max_batch,
+                    "queued": self._queue.qsize()}
+
+    def close(self):
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=10)
+
+@process_resource
+def get_db() -> DatabaseManager:
+    """Process-wide connection manager; WAL, schema, migration and the search index are set up once on the writer
+    connection before its thread starts. Reruns and sessions reuse it."""
+    db = DatabaseManager(DB_PATH)
+    writer = db.writer_connection
+    for statement in DB_SCHEMA:
+        writer.execute(statement)
+    writer.commit()
+    migrate_history(writer)
+    db.message_search = setup_message_search(writer)
+    db.start()
+    return db
+
+DB = get_db()
+MESSAGE_SEARCH = DB.message_search
+
+# NEW: OpenMetrics Exporter (in-process counters/histograms; optional side port or node_exporter textfile)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = no HTTP exporter
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE", "")  # e.g. /var/lib/node_exporter/textfile_collector/grokcoder.prom
+METRICS_TEXTFILE_INTERVAL = float(os.getenv("METRICS_TEXTFILE_INTERVAL", "15"))  # Seconds between textfile rewrites
+ACTIVE_SESSION_WINDOW = float(os.getenv("ACTIVE_SESSION_WINDOW", "300"))  # A session is active if seen this recently
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+METRIC_FAMILIES = {  # name -> (type, help)
+    "grokcoder_api_requests": ("counter", "xAI API requests by model and outcome."),
+    "grokcoder_api_retries": ("counter", "xAI API retries by error class."),
+    "grokcoder_api_request_duration_seconds": ("histogram", "Duration of one streamed API request (until the stream ends)."),
+    "grokcoder_api_ttft_seconds": ("histogram", "Time to first streamed token per API iteration."),
+    "grokcoder_tokens": ("counter", "Tokens reported by the API, by model and direction (in = prompt, out = completion)."),
+    "grokcoder_cost_dollars": ("counter", "Estimated API spend in USD by model (reported tokens at MODEL_PRICES)."),
+    "grokcoder_tool_invocations": ("counter", "Tool calls by tool and outcome."),
+    "grokcoder_tool_duration_seconds": ("histogram", "Wall time per tool call."),
+    "grokcoder_memory_cache_lookups": ("counter", "memory_query key lookups by result (hit = served from the RAM cache)."),
+    "grokcoder_sqlite_errors": ("counter", "SQLite busy/locked errors by kind."),
+    "grokcoder_memory_cache_hit_ratio": ("gauge", "Share of memory_query key lookups served from the cache."),
+    "grokcoder_active_sessions": ("gauge", "Chat sessions with a rerun in the last ACTIVE_SESSION_WINDOW seconds."),
+}
+
+class MetricsRegistry:
+    """Process-wide counters and histograms. An update is one dict write under a lock (no I/O, nothing per
+    streamed chunk); the text exposition is only built when scraped or when the textfile is rewritten."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}  # (name, labels) -> count, or [per-bucket counts..., +Inf count, sum] for histograms
+        self._sessions = {}  # session_id -> last seen (monotonic)
+
+    def inc(self, name: str, labels: tuple = (), amount: float = 1):
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, labels: tuple = ()):
+        key = (name, labels)
+        index = bisect.bisect_left(LATENCY_BUCKETS, value)
+        with self._lock:
+            hist = self._values.get(key)
+            if hist is None:
+                hist = self._values[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            hist[index] += 1
+            hist[-1] += value
+
+    def touch_session(self, session_id: str):
+        with self._lock:
+            self._sessions[session_id] = time.monotonic()
+
+    def _gauges(self, values: dict) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            for session_id, seen in list(self._sessions.items()):
+                if now - seen > ACTIVE_SESSION_WINDOW:
+                    del self._sessions[session_id]
+            active = len(self._sessions)
+        hits = values.get(("grokcoder_memory_cache_lookups", (("result", "hit"),)), 0)
+        misses = values.get(("grokcoder_memory_cache_lookups", (("result", "miss"),)), 0)
+        gauges = {("grokcoder_active_sessions", ()): active}
+        if hits + misses:
+            gauges[("grokcoder_memory_cache_hit_ratio", ())] = round(hits / (hits + misses), 6)
+        return gauges
+
+    def snapshot(self) -> dict:
+        """Copy of the raw values: (name, labels) -> count, or histogram list."""
+        with self._lock:
+            return {key: list(value) if isinstance(value, list) else value for key, value in self._values.items()}
+
+    def render(self, openmetrics: bool = True) -> str:
+        """OpenMetrics text (or the Prometheus 0.0.4 text format the textfile collector expects)."""
+        values = self.snapshot()
+        values.update(self._gauges(values))
+        lines = []
+        for name, (kind, help_text) in METRIC_FAMILIES.items():
+            samples = sorted((labels, value) for (family, labels), value in values.items() if family == name)
+            family = name if openmetrics or kind != "counter" else f"{name}_total"
+            lines.append(f"# TYPE {family} {kind}")
+            lines.append(f"# HELP {family} {help_text}")
+            for labels, value in samples:
+                if kind == "counter":
+                    lines.append(f"{name}_total{format_labels(labels)} {value}")
+                elif kind == "gauge":
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                else:
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), value[:-1]):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {round(value[-1], 6)}")
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels) + "}"
+
+def note_sqlite_error(exc: Exception):
+    """Count SQLite busy/locked errors (called from except blocks; other errors are ignored)."""
+    message = str(exc).lower()
+    if isinstance(exc, sqlite3.OperationalError) and ("locked" in message or "busy" in message):
+        METRICS.inc("grokcoder_sqlite_errors", (("kind", "locked" if "locked" in message else "busy"),))
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would flood the console
+
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+        openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+        body = self.registry.render(openmetrics).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8" if openmetrics
+                         else "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def write_metrics_textfile(registry: MetricsRegistry, path: str, interval: float):
+    """node_exporter textfile mode: rewrite the file atomically every `interval` seconds."""
+    while True:
+        try:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(registry.render(openmetrics=False))
+            os.replace(tmp_path, path)  # Collector never sees a half-written file
+        except Exception as e:
+            log_app.warning("Metrics textfile write failed: %s", e)
+        time.sleep(interval)
+
+@process_resource
+def get_metrics():
+    return MetricsRegistry()
+
+@process_resource
+def get_metrics_exporter():
+    """Start the configured exporters once per process (no-op unless METRICS_PORT or METRICS_TEXTFILE is set)."""
+    registry = get_metrics()
+    server = None
+    if METRICS_PORT:
+        try:
+            server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), type("BoundMetricsHandler", (MetricsHandler,), {"registry": registry}))
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="metrics-exporter", daemon=True).start()
+            log_app.info("Metrics exporter on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            log_app.error("Metrics exporter not started: %s", e)
+    if METRICS_TEXTFILE:
+        threading.Thread(target=write_metrics_textfile, args=(registry, METRICS_TEXTFILE, METRICS_TEXTFILE_INTERVAL),
+                         name="metrics-textfile", daemon=True).start()
+    return server
+
+METRICS = get_metrics()  # Same object on every rerun; module functions (incl. pool threads) use this global
+get_metrics_exporter()
 
 # Prompts Directory (create if not exists, with defaults)
 PROMPTS_DIR = "./prompts"
-os.makedirs(PROMPTS_DIR, exist_ok=True)
 
 # Default Prompts (auto-create files if dir is empty)
 default_prompts = {
@@ -80,22 +661,64 @@ api_simulate(url, method optional, data optional, mock optional): Simulate API c
 Invoke tools via structured calls, then incorporate results into your response. Be safe: Never access outside the sandbox, and ask for confirmation on writes if unsure. Limit to one tool per response to avoid loops. When outputting tags or code (e.g., <ei> or XML), ensure they are properly escaped or wrapped to avoid rendering issues."""
 }
 
-# Auto-create defaults if no files
-if not any(f.endswith('.txt') for f in os.listdir(PROMPTS_DIR)):
-    for filename, content in default_prompts.items():
-        with open(os.path.join(PROMPTS_DIR, filename), 'w') as f:
-            f.write(content)
+# Auto-create defaults if no files (once per process, not on every rerun)
+@process_resource
+def seed_prompts_dir():
+    os.makedirs(PROMPTS_DIR, exist_ok=True)
+    if not any(f.endswith('.txt') for f in os.listdir(PROMPTS_DIR)):
+        for filename, content in default_prompts.items():
+            with open(os.path.join(PROMPTS_DIR, filename), 'w') as f:
+                f.write(content)
+    return True
+
+seed_prompts_dir()
 
 # Function to Load Prompt Files
+# NEW: Catalogue is cached per directory mtime (adding, removing or renaming a file changes it), so reruns only stat()
+@st.cache_resource(show_spinner=False, max_entries=4)
+def prompt_catalogue(dir_mtime_ns: int) -> tuple:
+    return tuple(f for f in os.listdir(PROMPTS_DIR) if f.endswith('.txt'))
+
 def load_prompt_files():
-    return [f for f in os.listdir(PROMPTS_DIR) if f.endswith('.txt')]
+    return list(prompt_catalogue(os.stat(PROMPTS_DIR).st_mtime_ns))
 
 # Sandbox Directory for FS Tools (create if not exists)
 SANDBOX_DIR = "./sandbox"
-os.makedirs(SANDBOX_DIR, exist_ok=True)
+
+@process_resource
+def ensure_sandbox_dir():
+    os.makedirs(SANDBOX_DIR, exist_ok=True)
+    return True
+
+ensure_sandbox_dir()
+
+# NEW: Lazy Optional Dependencies (each tool's library is imported on first use; a missing one disables only its tool)
+TOOL_DEPENDENCIES = {"git_ops": "pygit2", "code_lint": "black"}  # Tool is dropped from the schema if its package is missing
+OPTIONAL_DEPENDENCIES = ("pygit2", "black", "requests", "ntplib")  # requests: live api_simulate; ntplib: get_current_time(sync)
+
+@process_resource
+def missing_dependencies() -> frozenset:
+    """Optional packages that are not installed (find_spec checks without importing)."""
+    missing = frozenset(name for name in OPTIONAL_DEPENDENCIES if importlib.util.find_spec(name) is None)
+    for name in sorted(missing):
+        log_app.warning("Optional package '%s' not installed; dependent tools are disabled", name)
+    return missing
+
+def optional_import(name: str):
+    """Import an optional package on first use (later calls hit sys.modules); None if it is not installed."""
+    if name in missing_dependencies():
+        return None
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        log_app.warning("Optional package '%s' failed to import: %s", name, e)
+        return None
+
+def dependency_missing_message(name: str) -> str:
+    return f"Tool unavailable: optional package '{name}' is not installed (pip install {name})."
 
 # Custom CSS for Pretty UI (Neon Gradient Theme, Chat Bubbles, Responsive) with Wrapping Fix and Padding
-st.markdown("""<style>
+APP_CSS = """<style>
     body {
         background: linear-gradient(to right, #1f1c2c, #928DAB);
         color: white;
@@ -145,12 +768,20 @@ st.markdown("""<style>
         border-radius: 5px;
         font-family: monospace;
     }
+    .search-focus {
+        outline: 2px solid #8f94fb;  /* Message opened from a search hit */
+    }
+    .search-hit mark {
+        background-color: #8f94fb;
+        color: white;
+    }
     /* Dark Mode (toggleable) */
     [data-theme="dark"] .stApp {
         background: linear-gradient(to right, #000000, #434343);
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+st.markdown(APP_CSS, unsafe_allow_html=True)  # Static asset; still sent each rerun (Streamlit drops elements a rerun does not emit)
 
 # Helper: Hash Password
 def hash_password(password):
@@ -225,20 +856,100 @@ def fs_mkdir(dir_path: str) -> str:
     except Exception as e:
         return f"Error creating directory: {str(e)}"
 
+# NEW: Background Clock-Offset Service (NTP measured off the request path; time = monotonic clock + cached offset)
+NTP_SERVER = os.getenv("NTP_SERVER", "pool.ntp.org")  # Empty disables NTP entirely
+NTP_REFRESH_INTERVAL = float(os.getenv("NTP_REFRESH_INTERVAL", "900"))  # Seconds between offset measurements
+NTP_RETRY_INTERVAL = float(os.getenv("NTP_RETRY_INTERVAL", "60"))  # Seconds between attempts while offline
+NTP_OFFSET_TTL = float(os.getenv("NTP_OFFSET_TTL", "3600"))  # An offset older than this is no longer trusted
+NTP_TIMEOUT = float(os.getenv("NTP_TIMEOUT", "2"))
+
+class ClockOffsetService:
+    """Daemon thread that measures the NTP offset periodically. now() never touches the network: it advances the
+    last NTP-corrected time with the monotonic clock, or silently falls back to host time if no fresh offset exists.
+    get_clock_service() starts the thread, so the ntplib import and the first measurement happen off the script thread."""
+    def __init__(self, server: str = NTP_SERVER, interval: float = NTP_REFRESH_INTERVAL, ttl: float = NTP_OFFSET_TTL,
+                 retry_interval: float = NTP_RETRY_INTERVAL, timeout: float = NTP_TIMEOUT):
+        self.server = server
+        self.interval = interval
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.offset = None  # Seconds to add to host time (last good measurement)
+        self.last_error = None
+        self._anchor = None  # (monotonic at measurement, corrected epoch at measurement)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not self.server:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ntp-offset", daemon=True)
+                self._thread.start()
+
+    def measure(self) -> float:
+        ntplib = optional_import("ntplib")
+        if ntplib is None:
+            raise RuntimeError("ntplib is not installed")
+        response = ntplib.NTPClient().request(self.server, version=3, timeout=self.timeout)
+        with self._lock:
+            self.offset = response.offset
+            self._anchor = (time.monotonic(), time.time() + response.offset)
+            self.last_error = None
+        return response.offset
+
+    def _run(self):
+        while True:
+            try:
+                offset = self.measure()
+                log_tools.debug("NTP offset from %s: %+.3fs", self.server, offset)
+                wait = self.interval
+            except Exception as e:
+                if self.last_error is None:
+                    log_tools.info("NTP unavailable, using host time: %s", e)  # Once per outage; retries stay quiet
+                self.last_error = str(e)
+                wait = self.retry_interval
+            self._wake.wait(wait)
+            self._wake.clear()
+
+    def refresh(self):
+        """Ask the thread to measure now (does not wait for it)."""
+        self._wake.set()
+
+    def now(self):
+        """(epoch seconds, source) without blocking: NTP-corrected if the offset is fresh, else host time."""
+        if self._thread is None:
+            self.start()  # Not started by get_clock_service (e.g. built directly)
+        with self._lock:
+            anchor = self._anchor
+        if anchor is not None:
+            elapsed = time.monotonic() - anchor[0]
+            if elapsed < self.ttl:
+                return anchor[1] + elapsed, "NTP"
+            self.refresh()
+        if not self.server:
+            return time.time(), "host"
+        if anchor is None and self.last_error is None:
+            return time.time(), "host (NTP pending)"  # First measurement still in flight
+        return time.time(), "host (NTP unavailable)"
+
+@process_resource
+def get_clock_service():
+    clock = ClockOffsetService()
+    clock.start()
+    return clock
+
+CLOCK = get_clock_service()  # Same object on every rerun; pool threads read the module global
+
 # Time Tool Function
 def get_current_time(sync: bool = False, format: str = 'iso') -> str:
-    """Fetch current time: host default, NTP if sync=true."""
+    """Fetch current time: host default, NTP-corrected if sync=true (from the cached offset; never blocks)."""
     try:
         if sync:
-            try:
-                c = ntplib.NTPClient()
-                response = c.request('pool.ntp.org', version=3)
-                t = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(response.tx_time))
-                source = "NTP"
-            except Exception as e:
-                print(f"[LOG] NTP Error: {e}")
-                t = time.strftime('%Y-%m-%d %H:%M:%S')
-                source = "host (NTP failed)"
+            now, source = CLOCK.now()
+            t = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
         else:
             t = time.strftime('%Y-%m-%d %H:%M:%S')
             source = "host"
@@ -252,11 +963,12 @@ def get_current_time(sync: bool = False, format: str = 'iso') -> str:
         return f"Time error: {str(e)}"
 
 # Code Execution Function
-def code_execution(code: str) -> str:
+def code_execution(code: str, namespace: dict = None) -> str:
     """Execute Python code safely in a stateful REPL and return output/errors."""
-    if 'repl_namespace' not in st.session_state:
-        st.session_state['repl_namespace'] = {'__builtins__': __builtins__}  # Restricted globals
-    namespace = st.session_state['repl_namespace']
+    if namespace is None:
+        if 'repl_namespace' not in st.session_state:
+            st.session_state['repl_namespace'] = {'__builtins__': __builtins__}  # Restricted globals
+        namespace = st.session_state['repl_namespace']
     old_stdout = sys.stdout
     redirected_output = io.StringIO()
     sys.stdout = redirected_output
@@ -269,52 +981,165 @@ def code_execution(code: str) -> str:
     finally:
         sys.stdout = old_stdout
 
+# NEW: Memory Write-Behind Buffer (memory_insert is acknowledged from RAM; rows reach SQLite in group commits)
+MEMORY_DURABILITY = os.getenv("MEMORY_DURABILITY", "buffered").lower()  # buffered | commit (wait for each insert's commit)
+MEMORY_FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "0.25"))  # Seconds an insert may wait in RAM
+MEMORY_FLUSH_MAX = int(os.getenv("MEMORY_FLUSH_MAX", "64"))  # Flush early once this many keys are pending
+
+def memory_timestamp() -> str:
+    """UTC like CURRENT_TIMESTAMP, with milliseconds: rows keep insert order even though they are written later."""
+    now = time.time()
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now)) + f".{int(now % 1 * 1000):03d}"
+
+class MemoryWriteBuffer:
+    """Pending memory rows keyed by (user, convo_id, mem_key); a later insert of the same key replaces the pending
+    one (INSERT OR REPLACE semantics). A background thread hands everything pending to the DB writer as one job (one
+    transaction) every MEMORY_FLUSH_INTERVAL, or sooner when MEMORY_FLUSH_MAX keys are waiting. A crash can lose at
+    most one interval of inserts; use MEMORY_DURABILITY=commit to wait for every insert's commit instead."""
+    def __init__(self, db: DatabaseManager):
+        self.db = db
+        self._pending = {}  # (user, convo_id, mem_key) -> (json value, timestamp)
+        self._inflight = {}  # Handed to the writer but not yet committed (still served by get())
+        self._lock = threading.Lock()
+        self._ready = threading.Event()  # Something is pending (the flusher sleeps until then)
+        self._full = threading.Event()  # MEMORY_FLUSH_MAX reached: flush without waiting out the interval
+        self.flushes = 0
+        self.rows_flushed = 0
+        self._thread = threading.Thread(target=self._run, name="memory-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)  # Registered after the DB writer's, so it runs first (atexit is LIFO)
+
+    def put(self, user: str, convo_id: int, mem_key: str, json_value: str):
+        with self._lock:
+            self._pending.pop((user, convo_id, mem_key), None)  # Re-inserted key moves to the end: rows are written in insert order
+            self._pending[(user, convo_id, mem_key)] = (json_value, memory_timestamp())
+            self._ready.set()
+            if len(self._pending) >= MEMORY_FLUSH_MAX:
+                self._full.set()
+
+    def get(self, user: str, convo_id: int, mem_key: str):
+        """Pending or in-flight (not yet committed) JSON value for a key, or None."""
+        with self._lock:
+            entry = self._pending.get((user, convo_id, mem_key)) or self._inflight.get((user, convo_id, mem_key))
+        return entry[0] if entry else None
+
+    def flush(self, wait: bool = False):
+        """Hand all pending rows to the DB writer. With wait=True, return once they (and any earlier flush) have
+        committed: jobs are submitted under the lock and the writer runs them in order."""
+        with self._lock:
+            rows, self._pending = self._pending, {}
+            self._inflight.update(rows)  # Readers keep seeing these rows until _done()
+            self._ready.clear()
+            if not rows and not wait:
+                return
+            future = self.db.submit(self._write, rows)
+        future.add_done_callback(lambda done: self._done(rows, done))
+        if wait:
+            future.result()
+
+    def _write(self, cur, rows: dict):
+        cur.executemany("INSERT OR REPLACE INTO memory (user, convo_id, mem_key, mem_value, timestamp) VALUES (?, ?, ?, ?, ?)",
+                        [key + value for key, value in rows.items()])
+
+    def _done(self, rows: dict, future: Future):
+        error = future.exception()
+        if error is not None:
+            note_sqlite_error(error)
+            log_db.warning("Memory flush of %d rows failed, retrying next interval: %s", len(rows), error)
+        with self._lock:
+            for key, value in rows.items():
+                if error is not None:
+                    self._pending.setdefault(key, value)  # Newer inserts of the same key win
+                if self._inflight.get(key) is value:  # A later flush of the same key is still in flight
+                    del self._inflight[key]
+            if error is None:
+                self.flushes += 1
+                self.rows_flushed += len(rows)
+            else:
+                self._ready.set()
+
+    def _run(self):
+        while True:
+            self._ready.wait()
+            self._full.wait(MEMORY_FLUSH_INTERVAL)  # Let more inserts join this group commit
+            self._full.clear()
+            try:
+                self.flush()
+            except Exception as e:  # The flusher must survive anything
+                log_db.error("Memory flush failed: %s", e)
+
+    def close(self):
+        try:
+            self.flush(wait=True)
+        except Exception as e:
+            log_db.error("Memory flush on shutdown failed: %s", e)
+
+@process_resource
+def get_memory_buffer() -> MemoryWriteBuffer:
+    return MemoryWriteBuffer(get_db())
+
+MEMORY_BUFFER = get_memory_buffer()
+
 # NEW: Memory Functions (Hybrid: Cache + DB)
-def memory_insert(user: str, convo_id: int, mem_key: str, mem_value: dict) -> str:
-    """Insert/update memory key-value (value as dict, stored as JSON). Syncs to DB."""
+def memory_insert(user: str, convo_id: int, mem_key: str, mem_value: dict, cache: dict = None) -> str:
+    """Insert/update memory key-value (value as dict, stored as JSON). Buffered, then group-committed to DB."""
     try:
         json_value = json.dumps(mem_value)
-        c.execute("INSERT OR REPLACE INTO memory (user, convo_id, mem_key, mem_value) VALUES (?, ?, ?, ?)",
-                  (user, convo_id, mem_key, json_value))
-        conn.commit()
+        if MEMORY_DURABILITY == "commit":
+            DB.execute("INSERT OR REPLACE INTO memory (user, convo_id, mem_key, mem_value, timestamp) VALUES (?, ?, ?, ?, ?)",
+                       (user, convo_id, mem_key, json_value, memory_timestamp()))
+        else:
+            MEMORY_BUFFER.put(user, convo_id, mem_key, json_value)
         # Update cache
         cache_key = f"{user}:{convo_id}:{mem_key}"
-        if 'memory_cache' not in st.session_state:
-            st.session_state['memory_cache'] = {}
-        st.session_state['memory_cache'][cache_key] = mem_value
+        if cache is None:
+            if 'memory_cache' not in st.session_state:
+                st.session_state['memory_cache'] = {}
+            cache = st.session_state['memory_cache']
+        cache[cache_key] = mem_value
         return "Memory inserted successfully."
     except Exception as e:
+        note_sqlite_error(e)
         return f"Error inserting memory: {str(e)}"
 
-def memory_query(user: str, convo_id: int, mem_key: str = None, limit: int = 10) -> str:
+def memory_query(user: str, convo_id: int, mem_key: str = None, limit: int = 10, cache: dict = None) -> str:
     """Query memory: specific key or last N entries. Cache-first for speed."""
     try:
-        if 'memory_cache' not in st.session_state:
-            st.session_state['memory_cache'] = {}
+        if cache is None:
+            if 'memory_cache' not in st.session_state:
+                st.session_state['memory_cache'] = {}
+            cache = st.session_state['memory_cache']
         if mem_key:
             cache_key = f"{user}:{convo_id}:{mem_key}"
-            cached = st.session_state['memory_cache'].get(cache_key)
+            cached = cache.get(cache_key)
             if cached:
+                METRICS.inc("grokcoder_memory_cache_lookups", (("result", "hit"),))
                 return json.dumps(cached)  # Fast RAM hit
-            c.execute("SELECT mem_value FROM memory WHERE user=? AND convo_id=? AND mem_key=? ORDER BY timestamp DESC LIMIT 1",
-                      (user, convo_id, mem_key))
-            result = c.fetchone()
+            pending = MEMORY_BUFFER.get(user, convo_id, mem_key)  # Inserted by another session, not committed yet
+            if pending is not None:
+                METRICS.inc("grokcoder_memory_cache_lookups", (("result", "hit"),))
+                cache[cache_key] = json.loads(pending)
+                return pending
+            METRICS.inc("grokcoder_memory_cache_lookups", (("result", "miss"),))
+            result = DB.query_one("SELECT mem_value FROM memory WHERE user=? AND convo_id=? AND mem_key=? ORDER BY timestamp DESC LIMIT 1",
+                                  (user, convo_id, mem_key))
             if result:
                 value = json.loads(result[0])
-                st.session_state['memory_cache'][cache_key] = value  # Cache for next
+                cache[cache_key] = value  # Cache for next
                 return json.dumps(value)
             return "Not found."
         else:
-            # Recent entries (no specific key)
-            c.execute("SELECT mem_key, mem_value FROM memory WHERE user=? AND convo_id=? ORDER BY timestamp DESC LIMIT ?",
-                      (user, convo_id, limit))
-            results = c.fetchall()
+            # Recent entries (no specific key): ordered by the DB, so pending inserts must be written first
+            MEMORY_BUFFER.flush(wait=True)
+            results = DB.query("SELECT mem_key, mem_value FROM memory WHERE user=? AND convo_id=? ORDER BY timestamp DESC, rowid DESC LIMIT ?",
+                               (user, convo_id, limit))
             output = {row[0]: json.loads(row[1]) for row in results}
             # Cache them
             for k, v in output.items():
-                st.session_state['memory_cache'][f"{user}:{convo_id}:{k}"] = v
+                cache[f"{user}:{convo_id}:{k}"] = v
             return json.dumps(output)
     except Exception as e:
+        note_sqlite_error(e)
         return f"Error querying memory: {str(e)}"
 
 # NEW: Git Ops Tool
@@ -325,6 +1150,9 @@ def git_ops(operation: str, repo_path: str = "", **kwargs) -> str:
     safe_repo = os.path.abspath(os.path.normpath(os.path.join(SANDBOX_DIR, repo_path)))
     if not safe_repo.startswith(os.path.abspath(SANDBOX_DIR)):
         return "Invalid repo path."
+    pygit2 = optional_import("pygit2")
+    if pygit2 is None:
+        return dependency_missing_message("pygit2")
     try:
         if operation == 'init':
             pygit2.init_repository(safe_repo, bare=False)
@@ -374,6 +1202,7 @@ def db_query(db_path: str, query: str, params: list = []) -> str:
             db_conn.commit()
             return f"Query executed, {cur.rowcount} rows affected."
     except Exception as e:
+        note_sqlite_error(e)
         return f"DB error: {str(e)}"
     finally:
         if db_conn:
@@ -398,8 +1227,11 @@ def code_lint(language: str, code: str) -> str:
     """Lint and format code snippets."""
     if language.lower() != 'python':
         return "Only Python supported currently."
+    black = optional_import("black")
+    if black is None:
+        return dependency_missing_message("black")
     try:
-        formatted = format_str(code, mode=FileMode(line_length=88))
+        formatted = black.format_str(code, mode=black.FileMode(line_length=88))
         return formatted
     except Exception as e:
         return f"Lint error: {str(e)}"
@@ -416,6 +1248,9 @@ def api_simulate(url: str, method: str = 'GET', data: dict = None, mock: bool =
         return json.dumps({"status": "mocked", "url": url, "method": method, "data": data})
     if not any(url.startswith(base) for base in API_WHITELIST):
         return "URL not in whitelist."
+    requests = optional_import("requests")
+    if requests is None:
+        return dependency_missing_message("requests")
     try:
         if method.upper() == 'GET':
             resp = requests.get(url, timeout=5)
@@ -429,214 +1264,1064 @@ def api_simulate(url: str, method: str = 'GET', data: dict = None, mock: bool =
         return f"API error: {str(e)}"
 
 # Tool Schema for Structured Outputs (Including New Tools)
-TOOLS = [
-    {
-        "type": "function",
-        "function": {
-            "name": "fs_read_file",
-            "description": "Read the content of a file in the sandbox directory (./sandbox/). Supports relative paths (e.g., 'subdir/test.txt'). Use for fetching data.",
-            "parameters": {
-                "type": "object",
-                "properties": {"file_path": {"type": "string", "description": "Relative path to the file (e.g., subdir/test.txt)."}},
-                "required": ["file_path"]
+# NEW: Built once per process with its JSON digest (response cache key), shared by every rerun and session
+@process_resource
+def get_tool_schema():
+    tools = [
+        {
+            "type": "function",
+            "function": {
+                "name": "fs_read_file",
+                "description": "Read the content of a file in the sandbox directory (./sandbox/). Supports relative paths (e.g., 'subdir/test.txt'). Use for fetching data.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {"file_path": {"type": "string", "description": "Relative path to the file (e.g., subdir/test.txt)."}},
+                    "required": ["file_path"]
+                }
             }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "fs_write_file",
-            "description": "Write content to a file in the sandbox directory (./sandbox/). Supports relative paths (e.g., 'subdir/newfile.txt'). Use for saving or updating files. If 'Love' is in file_path or content, optionally add ironic flair like 'LOVE <3' for fun.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "file_path": {"type": "string", "description": "Relative path to the file (e.g., subdir/newfile.txt)."},
-                    "content": {"type": "string", "description": "Content to write."}
-                },
-                "required": ["file_path", "content"]
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "fs_write_file",
+                "description": "Write content to a file in the sandbox directory (./sandbox/). Supports relative paths (e.g., 'subdir/newfile.txt'). Use for saving or updating files. If 'Love' is in file_path or content, optionally add ironic flair like 'LOVE <3' for fun.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "file_path": {"type": "string", "description": "Relative path to the file (e.g., subdir/newfile.txt)."},
+                        "content": {"type": "string", "description": "Content to write."}
+                    },
+                    "required": ["file_path", "content"]
+                }
             }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "fs_list_files",
-            "description": "List all files in a directory within the sandbox (./sandbox/). Supports relative paths (default: root). Use to check available files.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "dir_path": {"type": "string", "description": "Relative path to the directory (e.g., subdir). Optional; defaults to root."}
-                },
-                "required": []
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "fs_list_files",
+                "description": "List all files in a directory within the sandbox (./sandbox/). Supports relative paths (default: root). Use to check available files.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "dir_path": {"type": "string", "description": "Relative path to the directory (e.g., subdir). Optional; defaults to root."}
+                    },
+                    "required": []
+                }
             }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "fs_mkdir",
-            "description": "Create a new directory in the sandbox (./sandbox/). Supports relative/nested paths (e.g., 'subdir/newdir'). Use to organize files.",
-            "parameters": {
-                "type": "object",
-                "properties": {"dir_path": {"type": "string", "description": "Relative path for the new directory (e.g., subdir/newdir)."}},
-                "required": ["dir_path"]
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "fs_mkdir",
+                "description": "Create a new directory in the sandbox (./sandbox/). Supports relative/nested paths (e.g., 'subdir/newdir'). Use to organize files.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {"dir_path": {"type": "string", "description": "Relative path for the new directory (e.g., subdir/newdir)."}},
+                    "required": ["dir_path"]
+                }
             }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "get_current_time",
-            "description": "Fetch current datetime. Use host clock by default; sync with NTP if requested for precision.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "sync": {"type": "boolean", "description": "True for NTP sync (requires network), false for local host time. Default: false."},
-                    "format": {"type": "string", "description": "Output format: 'iso' (default), 'human', 'json'."}
-                },
-                "required": []
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "get_current_time",
+                "description": "Fetch current datetime. Use host clock by default; sync with NTP if requested for precision.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "sync": {"type": "boolean", "description": "True for NTP sync (requires network), false for local host time. Default: false."},
+                        "format": {"type": "string", "description": "Output format: 'iso' (default), 'human', 'json'."}
+                    },
+                    "required": []
+                }
             }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "code_execution",
-            "description": "Execute provided code in a stateful REPL environment and return output or errors for verification. Supports Python with various libraries (e.g., numpy, sympy, pygame). No internet access or package installation.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "code": { "type": "string", "description": "The code snippet to execute." }
-                },
-                "required": ["code"]
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "code_execution",
+                "description": "Execute provided code in a stateful REPL environment and return output or errors for verification. Supports Python with various libraries (e.g., numpy, sympy, pygame). No internet access or package installation.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "code": { "type": "string", "description": "The code snippet to execute." }
+                    },
+                    "required": ["code"]
+                }
             }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "memory_insert",
-            "description": "Insert or update a memory key-value pair (value as JSON dict) for logging/metadata. Use for fast persistent storage without files.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "mem_key": {"type": "string", "description": "Key for the memory entry (e.g., 'chat_log_1')."},
-                    "mem_value": {"type": "object", "description": "Value as dict (e.g., {'content': 'Log text'})."}
-                },
-                "required": ["mem_key", "mem_value"]
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "memory_insert",
+                "description": "Insert or update a memory key-value pair (value as JSON dict) for logging/metadata. Use for fast persistent storage without files.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "mem_key": {"type": "string", "description": "Key for the memory entry (e.g., 'chat_log_1')."},
+                        "mem_value": {"type": "object", "description": "Value as dict (e.g., {'content': 'Log text'})."}
+                    },
+                    "required": ["mem_key", "mem_value"]
+                }
             }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "memory_query",
-            "description": "Query memory: specific key or last N entries. Returns JSON. Use for recalling logs without FS reads.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "mem_key": {"type": "string", "description": "Specific key to query (optional)."},
-                    "limit": {"type": "integer", "description": "Max recent entries if no key (default 10)."}
-                },
-                "required": []
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "memory_query",
+                "description": "Query memory: specific key or last N entries. Returns JSON. Use for recalling logs without FS reads.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "mem_key": {"type": "string", "description": "Specific key to query (optional)."},
+                        "limit": {"type": "integer", "description": "Max recent entries if no key (default 10)."}
+                    },
+                    "required": []
+                }
             }
-        }
-    },
-    # NEW: Git Ops
-    {
-        "type": "function",
-        "function": {
-            "name": "git_ops",
-            "description": "Basic Git operations in sandbox (init, commit, branch, diff). No remote operations.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "operation": {"type": "string", "enum": ["init", "commit", "branch", "diff"]},
-                    "repo_path": {"type": "string", "description": "Relative path to repo."},
-                    "message": {"type": "string", "description": "Commit message (for commit)."},
-                    "name": {"type": "string", "description": "Branch name (for branch)."}
-                },
-                "required": ["operation", "repo_path"]
+        },
+        # NEW: Git Ops
+        {
+            "type": "function",
+            "function": {
+                "name": "git_ops",
+                "description": "Basic Git operations in sandbox (init, commit, branch, diff). No remote operations.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "operation": {"type": "string", "enum": ["init", "commit", "branch", "diff"]},
+                        "repo_path": {"type": "string", "description": "Relative path to repo."},
+                        "message": {"type": "string", "description": "Commit message (for commit)."},
+                        "name": {"type": "string", "description": "Branch name (for branch)."}
+                    },
+                    "required": ["operation", "repo_path"]
+                }
             }
-        }
-    },
-    # NEW: DB Query
-    {
-        "type": "function",
-        "function": {
-            "name": "db_query",
-            "description": "Interact with local SQLite database in sandbox (create, insert, query).",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "db_path": {"type": "string", "description": "Relative path to DB file."},
-                    "query": {"type": "string", "description": "SQL query."},
-                    "params": {"type": "array", "items": {"type": "string"}, "description": "Query parameters."}
-                },
-                "required": ["db_path", "query"]
+        },
+        # NEW: DB Query
+        {
+            "type": "function",
+            "function": {
+                "name": "db_query",
+                "description": "Interact with local SQLite database in sandbox (create, insert, query).",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "db_path": {"type": "string", "description": "Relative path to DB file."},
+                        "query": {"type": "string", "description": "SQL query."},
+                        "params": {"type": "array", "items": {"type": "string"}, "description": "Query parameters."}
+                    },
+                    "required": ["db_path", "query"]
+                }
             }
-        }
-    },
-    # NEW: Shell Exec
-    {
-        "type": "function",
-        "function": {
-            "name": "shell_exec",
-            "description": "Run safe whitelisted shell commands in sandbox (e.g., ls, grep).",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "command": {"type": "string", "description": "Shell command string."}
-                },
-                "required": ["command"]
+        },
+        # NEW: Shell Exec
+        {
+            "type": "function",
+            "function": {
+                "name": "shell_exec",
+                "description": "Run safe whitelisted shell commands in sandbox (e.g., ls, grep).",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "command": {"type": "string", "description": "Shell command string."}
+                    },
+                    "required": ["command"]
+                }
             }
-        }
-    },
-    # NEW: Code Lint
-    {
-        "type": "function",
-        "function": {
-            "name": "code_lint",
-            "description": "Lint and auto-format code (Python with Black).",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "language": {"type": "string", "description": "Language (python)."},
-                    "code": {"type": "string", "description": "Code snippet."}
-                },
-                "required": ["language", "code"]
+        },
+        # NEW: Code Lint
+        {
+            "type": "function",
+            "function": {
+                "name": "code_lint",
+                "description": "Lint and auto-format code (Python with Black).",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "language": {"type": "string", "description": "Language (python)."},
+                        "code": {"type": "string", "description": "Code snippet."}
+                    },
+                    "required": ["language", "code"]
+                }
             }
-        }
-    },
-    # NEW: API Simulate
-    {
-        "type": "function",
-        "function": {
-            "name": "api_simulate",
-            "description": "Simulate API calls with mock or fetch from public APIs.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "url": {"type": "string", "description": "API URL."},
-                    "method": {"type": "string", "description": "GET/POST (default GET)."},
-                    "data": {"type": "object", "description": "POST data."},
-                    "mock": {"type": "boolean", "description": "True for mock (default)."}
-                },
-                "required": ["url"]
+        },
+        # NEW: API Simulate
+        {
+            "type": "function",
+            "function": {
+                "name": "api_simulate",
+                "description": "Simulate API calls with mock or fetch from public APIs.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "url": {"type": "string", "description": "API URL."},
+                        "method": {"type": "string", "description": "GET/POST (default GET)."},
+                        "data": {"type": "object", "description": "POST data."},
+                        "mock": {"type": "boolean", "description": "True for mock (default)."}
+                    },
+                    "required": ["url"]
+                }
             }
         }
-    }
-]
+    ]
+    # Tools whose optional package is missing are not offered to the model (the rest keep working)
+    tools = [tool for tool in tools if TOOL_DEPENDENCIES.get(tool["function"]["name"]) not in missing_dependencies()]
+    return tools, hashlib.sha256(json.dumps(tools, sort_keys=True).encode('utf-8')).hexdigest()
+
+TOOLS, TOOLS_DIGEST = get_tool_schema()
+
+# NEW: Tool Dispatch and Concurrent Executor
+class ToolContext:
+    """Per-turn session state the tools need, captured on the Streamlit script thread (pool threads have no session_state)."""
+    def __init__(self, user: str = None, convo_id: int = 0, memory_cache: dict = None, repl_namespace: dict = None,
+                 log_ids: dict = None):
+        self.user = user
+        self.convo_id = convo_id
+        self.memory_cache = memory_cache if memory_cache is not None else {}
+        self.repl_namespace = repl_namespace if repl_namespace is not None else {'__builtins__': __builtins__}
+        self.log_ids = log_ids or {"user": user, "convo_id": convo_id}  # Pool threads do not inherit the log context
+
+    @classmethod
+    def from_session(cls):
+        if 'memory_cache' not in st.session_state:
+            st.session_state['memory_cache'] = {}
+        if 'repl_namespace' not in st.session_state:
+            st.session_state['repl_namespace'] = {'__builtins__': __builtins__}  # Restricted globals
+        return cls(user=st.session_state.get('user'), convo_id=st.session_state.get('current_convo_id', 0),
+                   memory_cache=st.session_state['memory_cache'], repl_namespace=st.session_state['repl_namespace'],
+                   log_ids=log_ids())
+
+def run_tool(func_name: str, args: dict, ctx: ToolContext) -> str:
+    """Execute one tool call by name with already-parsed arguments."""
+    if func_name == "fs_read_file":
+        return fs_read_file(args['file_path'])
+    elif func_name == "fs_write_file":
+        return fs_write_file(args['file_path'], args['content'])
+    elif func_name == "fs_list_files":
+        dir_path = args.get('dir_path', "")
+        return fs_list_files(dir_path)
+    elif func_name == "fs_mkdir":
+        return fs_mkdir(args['dir_path'])
+    elif func_name == "get_current_time":
+        sync = args.get('sync', False)
+        fmt = args.get('format', 'iso')
+        return get_current_time(sync, fmt)
+    elif func_name == "code_execution":
+        return code_execution(args['code'], ctx.repl_namespace)
+    elif func_name == "memory_insert":
+        return memory_insert(ctx.user, ctx.convo_id, args['mem_key'], args['mem_value'], ctx.memory_cache)
+    elif func_name == "memory_query":
+        mem_key = args.get('mem_key')
+        limit = args.get('limit', 10)
+        return memory_query(ctx.user, ctx.convo_id, mem_key, limit, ctx.memory_cache)
+    elif func_name == "git_ops":
+        operation = args['operation']
+        repo_path = args['repo_path']
+        # Only the optional fields: passing **args would repeat operation/repo_path (TypeError) and any stray keys
+        return git_ops(operation, repo_path, message=args.get('message', 'Default commit'), name=args.get('name'))
+    elif func_name == "db_query":
+        db_path = args['db_path']
+        query = args['query']
+        params = args.get('params', [])
+        return db_query(db_path, query, params)
+    elif func_name == "shell_exec":
+        command = args['command']
+        return shell_exec(command)
+    elif func_name == "code_lint":
+        language = args['language']
+        code = args['code']
+        return code_lint(language, code)
+    elif func_name == "api_simulate":
+        url = args['url']
+        method = args.get('method', 'GET')
+        data = args.get('data')
+        mock = args.get('mock', True)
+        return api_simulate(url, method, data, mock)
+    return "Unknown tool."
+
+def tool_error(func_name: str = None, ctx: ToolContext = None) -> str:
+    """Format and log the exception being handled as a tool result."""
+    log_tools.exception("Tool error in %s", func_name, extra=ctx.log_ids if ctx else None)
+    return f"Tool error: {traceback.format_exc()}"
+
+# Execution modes: 'thread' = read-only/I/O-bound (thread pool), 'process' = CPU-heavy (process pool).
+# Anything else runs 'inline' on the caller in call order, because it mutates the sandbox, DB or REPL state.
+TOOL_MODES = {
+    "fs_read_file": "thread",
+    "fs_list_files": "thread",
+    "get_current_time": "thread",
+    "api_simulate": "thread",
+    "code_lint": "process",
+}
+DEFAULT_TOOL_CONCURRENCY = {"fs_read_file": 8, "fs_list_files": 4, "get_current_time": 2, "api_simulate": 4, "code_lint": 2}
+TOOL_ERROR_PREFIXES = ("Error", "Tool error", "Time error", "Git error", "DB error", "Shell error", "Lint error", "API error",
+                       "Invalid", "Unknown tool", "Unsupported", "Command not whitelisted", "URL not in whitelist",
+                       "File not found", "Directory not found", "Path is", "Parent directory does not exist")  # Failure results (metrics)
+TOOL_THREAD_WORKERS = int(os.getenv("TOOL_THREAD_WORKERS", "8"))
+TOOL_PROCESS_WORKERS = int(os.getenv("TOOL_PROCESS_WORKERS", "2"))
+
+def parse_tool_concurrency(spec: str) -> dict:
+    """Parse per-tool caps like 'fs_read_file=4,code_lint=1' (from TOOL_CONCURRENCY in .env) over the defaults."""
+    caps = dict(DEFAULT_TOOL_CONCURRENCY)
+    for item in (spec or "").split(','):
+        name, sep, value = item.partition('=')
+        if sep and value.strip().isdigit():
+            caps[name.strip()] = max(int(value), 1)
+    return caps
+
+class ToolSlots:
+    """Concurrency cap for one tool. A call over the cap is queued as a start callback instead of blocking a thread;
+    release() hands the freed slot straight to the oldest queued call."""
+    def __init__(self, cap: int):
+        self.cap = cap
+        self.running = 0
+        self.waiting = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, start) -> bool:
+        """Take a slot now (True), or queue `start` to be called holding the slot once one frees up (False)."""
+        with self._lock:
+            if self.running < self.cap:
+                self.running += 1
+                return True
+            self.waiting.append(start)
+            return False
+
+    def release(self):
+        with self._lock:
+            if not self.waiting:
+                self.running -= 1
+                return
+            start = self.waiting.popleft()
+        start()
+
+class ToolExecutor:
+    """Process-wide pools for running independent tool calls concurrently, with per-tool concurrency caps.
+    Caps are enforced before a call reaches the thread pool, so a call waiting for its tool never holds a worker."""
+    def __init__(self, caps: dict, thread_workers: int = TOOL_THREAD_WORKERS, process_workers: int = TOOL_PROCESS_WORKERS):
+        self.threads = ThreadPoolExecutor(max_workers=thread_workers, thread_name_prefix="tool")
+        self.process_workers = process_workers
+        self._processes = None  # Started on first CPU-heavy call
+        self._lock = threading.Lock()
+        self._caps = {name: ToolSlots(cap) for name, cap in caps.items()}
+
+    def is_parallel(self, func_name: str) -> bool:
+        return TOOL_MODES.get(func_name) in ("thread", "process")
+
+    def _process_pool(self):
+        with self._lock:
+            if self._processes is None:
+                methods = multiprocessing.get_all_start_methods()
+                ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")  # No fork from a threaded server
+                self._processes = ProcessPoolExecutor(max_workers=self.process_workers, mp_context=ctx)
+            return self._processes
+
+    def _run_in_process(self, func_name: str, args: dict, ctx: ToolContext) -> str:
+        # Only library callables can be pickled across processes (the Streamlit script module cannot)
+        black = optional_import("black") if func_name == "code_lint" else None
+        if black is not None and args['language'].lower() == 'python':
+            try:
+                return self._process_pool().submit(black.format_str, args['code'], mode=black.FileMode(line_length=88)).result()
+            except Exception as e:
+                return f"Lint error: {str(e)}"
+        return run_tool(func_name, args, ctx)
+
+    def execute(self, func_name: str, arguments: str, ctx: ToolContext, timings: list = None) -> str:
+        """Parse arguments and run one call on the current thread (waiting there for the tool's cap); never raises.
+        If `timings` is given, (func_name, wall seconds) is appended once the call finishes."""
+        slots = self._caps.get(func_name)
+        if slots is None:
+            return self._call(func_name, arguments, ctx, timings)
+        ready = threading.Event()
+        if not slots.acquire(ready.set):
+            ready.wait()
+        try:
+            return self._call(func_name, arguments, ctx, timings)
+        finally:
+            slots.release()
+
+    def _call(self, func_name: str, arguments: str, ctx: ToolContext, timings: list = None) -> str:
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            args = json.loads(arguments or "{}")
+            if TOOL_MODES.get(func_name) == "process":
+                result = self._run_in_process(func_name, args, ctx)
+            else:
+                result = run_tool(func_name, args, ctx)
+            if isinstance(result, str) and result.startswith(TOOL_ERROR_PREFIXES):
+                outcome = "error"
+            return result
+        except Exception:
+            outcome = "exception"
+            return tool_error(func_name, ctx)
+        finally:
+            elapsed = time.perf_counter() - started
+            if timings is not None:
+                timings.append((func_name, elapsed))
+            METRICS.inc("grokcoder_tool_invocations", (("tool", func_name), ("outcome", outcome)))
+            METRICS.observe("grokcoder_tool_duration_seconds", elapsed, (("tool", func_name),))
+
+    def submit(self, func_name: str, arguments: str, ctx: ToolContext, timings: list = None) -> Future:
+        """Run a call on the thread pool. Over its tool's cap, the call waits in that tool's queue (not on a worker)."""
+        slots = self._caps.get(func_name)
+        if slots is None:
+            return self.threads.submit(self._call, func_name, arguments, ctx, timings)
+        future = Future()
+        start = lambda: self.threads.submit(self._run_slot, slots, future, func_name, arguments, ctx, timings)
+        if slots.acquire(start):
+            start()
+        return future
+
+    def _run_slot(self, slots: ToolSlots, future: Future, func_name: str, arguments: str, ctx: ToolContext, timings: list):
+        try:
+            if future.set_running_or_notify_cancel():  # Skipped if cancelled while queued
+                future.set_result(self._call(func_name, arguments, ctx, timings))
+        finally:
+            slots.release()
+
+    def batch(self, ctx: ToolContext):
+        return ToolBatch(self, ctx)
+
+class ToolBatch:
+    """Tool calls from one model turn. Parallel-safe calls start as soon as they are submitted; an inline call
+    waits for everything before it and holds back later calls until it is done. Results come back in call order."""
+    def __init__(self, executor: ToolExecutor, ctx: ToolContext):
+        self.executor = executor
+        self.ctx = ctx
+        self.entries = []  # [tool_call_id, func_name, arguments, future]
+        self.timings = []  # (func_name, wall seconds) per finished call
+        self._blocked = False  # True once an inline call is pending
+
+    def submit(self, call_id: str, func_name: str, arguments: str):
+        entry = [call_id, func_name, arguments, None]
+        if self.executor.is_parallel(func_name):
+            if not self._blocked:
+                entry[3] = self.executor.submit(func_name, arguments, self.ctx, self.timings)
+        else:
+            self._blocked = True
+        self.entries.append(entry)
+
+    def _start_after(self, index: int):
+        """Start deferred parallel calls that follow an inline call, up to the next inline one."""
+        for entry in self.entries[index + 1:]:
+            if not self.executor.is_parallel(entry[1]):
+                break
+            entry[3] = self.executor.submit(entry[1], entry[2], self.ctx, self.timings)
+
+    def results(self):
+        """Yield (tool_call_id, func_name, result) in the original call order."""
+        for i, (call_id, func_name, arguments, future) in enumerate(self.entries):
+            if future is None:
+                result = self.executor.execute(func_name, arguments, self.ctx, self.timings)
+                self._start_after(i)
+            else:
+                result = future.result()
+            yield call_id, func_name, result
+
+    async def aresults(self):
+        """Async version of results(): awaits pool futures and runs inline calls off the event loop."""
+        for i, (call_id, func_name, arguments, future) in enumerate(self.entries):
+            if future is None:
+                result = await asyncio.to_thread(self.executor.execute, func_name, arguments, self.ctx, self.timings)
+                self._start_after(i)
+            else:
+                result = await asyncio.wrap_future(future)
+            yield call_id, func_name, result
+
+    def cancel(self):
+        """Cancel calls that have not started yet (e.g. the turn was abandoned or the stream is being retried)."""
+        for entry in self.entries:
+            if entry[3] is not None:
+                entry[3].cancel()
+
+@process_resource
+def get_tool_executor():
+    """Shared across reruns and sessions so pools are created once per process."""
+    return ToolExecutor(parse_tool_concurrency(os.getenv("TOOL_CONCURRENCY", "")))
+
+# NEW: Streamed Tool-Call Assembly (merge fragments by index; hand each call off as soon as its arguments are complete)
+class ToolCallAccumulator:
+    """Merges streamed tool_call deltas by index into whole calls.
+
+    A call is complete when a later index starts or its JSON arguments parse. Complete calls are passed to
+    on_complete(call_id, func_name, arguments) in index order, so tools can start while the model is still streaming."""
+    def __init__(self, on_complete=None):
+        self.calls = {}  # index -> {"id", "name", "arguments"}
+        self.on_complete = on_complete
+        self._dispatched = 0  # Number of calls (in index order) already handed off
+
+    def add(self, delta_tool_calls):
+        for tc in delta_tool_calls:
+            index = tc.index if tc.index is not None else len(self.calls)
+            call = self.calls.setdefault(index, {"id": None, "name": "", "arguments": ""})
+            if tc.id:
+                call["id"] = tc.id
+            if tc.function:
+                if tc.function.name:
+                    call["name"] += tc.function.name
+                if tc.function.arguments:
+                    call["arguments"] += tc.function.arguments
+        self._dispatch_ready(final=False)
+
+    def finish(self):
+        """Stream ended: hand off whatever is left, complete or not (the executor reports bad JSON)."""
+        self._dispatch_ready(final=True)
+
+    @staticmethod
+    def _arguments_complete(arguments: str) -> bool:
+        if not arguments.rstrip().endswith('}'):  # Cheap check before trying a full parse
+            return False
+        try:
+            json.loads(arguments)
+            return True
+        except ValueError:
+            return False
+
+    def _dispatch_ready(self, final: bool):
+        indexes = sorted(self.calls)
+        while self._dispatched < len(indexes):
+            position = self._dispatched
+            call = self.calls[indexes[position]]
+            superseded = position + 1 < len(indexes)  # A later call has started streaming
+            if not final and not (call["id"] and call["name"] and (superseded or self._arguments_complete(call["arguments"]))):
+                return
+            self._dispatched += 1
+            if self.on_complete:
+                self.on_complete(call["id"], call["name"], call["arguments"])
+
+    def message_tool_calls(self) -> list:
+        """Tool calls in the shape the API expects on the assistant message that precedes the tool results."""
+        return [{"id": call["id"], "type": "function", "function": {"name": call["name"], "arguments": call["arguments"] or "{}"}}
+                for _, call in sorted(self.calls.items())]
+
+# NEW: Pooled xAI Client (shared across reruns and sessions; keeps HTTP connections, TLS sessions alive)
+XAI_BASE_URL = os.getenv("XAI_BASE_URL", "https://api.x.ai/v1")
+XAI_MAX_CONNECTIONS = int(os.getenv("XAI_MAX_CONNECTIONS", "20"))  # Total sockets per client
+XAI_MAX_KEEPALIVE = int(os.getenv("XAI_MAX_KEEPALIVE", "10"))  # Idle sockets kept open for reuse
+XAI_KEEPALIVE_EXPIRY = float(os.getenv("XAI_KEEPALIVE_EXPIRY", "120"))  # Seconds an idle socket stays pooled
+XAI_CONNECT_TIMEOUT = float(os.getenv("XAI_CONNECT_TIMEOUT", "10"))
+XAI_READ_TIMEOUT = float(os.getenv("XAI_READ_TIMEOUT", "3600"))  # Long reads for big streamed answers
+
+class ClientStats:
+    """Thread-safe counters for HTTP requests vs. newly opened connections (reused = requests - opened)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.opened = 0
+
+    def on_request(self, request):
+        """httpx request hook: count the request and trace whether it opens a new TCP connection."""
+        request.extensions["trace"] = self._trace
+        with self._lock:
+            self.requests += 1
+
+    async def aon_request(self, request):
+        """Same as on_request for httpx.AsyncClient (async hooks and trace callbacks)."""
+        request.extensions["trace"] = self._atrace
+        with self._lock:
+            self.requests += 1
+
+    def _trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.opened += 1
+
+    async def _atrace(self, event_name, info):
+        self._trace(event_name, info)
 
-# API Wrapper with Streaming and Tool Handling
-def call_xai_api(model, messages, sys_prompt, stream=True, image_files=None, enable_tools=False):
-    client = OpenAI(
-        api_key=API_KEY,
-        base_url="https://api.x.ai/v1",
-        timeout=3600
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "connections_opened": self.opened,
+                    "connections_reused": max(self.requests - self.opened, 0)}
+
+@process_resource
+def get_client_stats():
+    return ClientStats()
+
+@process_resource
+def get_xai_client(api_key=API_KEY, base_url=XAI_BASE_URL):
+    """Process-wide pooled client, one per (api_key, base_url). Survives Streamlit reruns and sessions."""
+    timeout = httpx.Timeout(XAI_READ_TIMEOUT, connect=XAI_CONNECT_TIMEOUT)
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(max_connections=XAI_MAX_CONNECTIONS,
+                            max_keepalive_connections=XAI_MAX_KEEPALIVE,
+                            keepalive_expiry=XAI_KEEPALIVE_EXPIRY),
+        timeout=timeout,
+        event_hooks={"request": [get_client_stats().on_request]}
     )
-    # Prepare messages (system first, then history)
+    # max_retries=0: retries are handled by RetryState so they respect the turn deadline and circuit breaker
+    return OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, http_client=http_client, max_retries=0)
+
+# NEW: Bounded Retries (error classes, capped exponential backoff with jitter, per-turn deadline, circuit breaker)
+XAI_RETRY_MAX_ATTEMPTS = int(os.getenv("XAI_RETRY_MAX_ATTEMPTS", "4"))  # Tries per API request
+XAI_RETRY_BASE_DELAY = float(os.getenv("XAI_RETRY_BASE_DELAY", "1"))
+XAI_RETRY_MAX_DELAY = float(os.getenv("XAI_RETRY_MAX_DELAY", "30"))
+XAI_TURN_DEADLINE = float(os.getenv("XAI_TURN_DEADLINE", "300"))  # Seconds a whole turn may spend retrying
+XAI_BREAKER_THRESHOLD = int(os.getenv("XAI_BREAKER_THRESHOLD", "5"))  # Consecutive outage-type failures before opening
+XAI_BREAKER_COOLDOWN = float(os.getenv("XAI_BREAKER_COOLDOWN", "30"))  # Seconds to fail fast before probing again
+
+RETRYABLE_ERRORS = ("rate_limit", "server", "timeout", "connection")
+OUTAGE_ERRORS = ("server", "timeout", "connection")  # Count towards the circuit breaker (429 means the API is up)
+
+def classify_api_error(exc: Exception) -> str:
+    """Map an exception from request creation or mid-stream to 'rate_limit', 'server', 'timeout', 'connection' or 'fatal'."""
+    if isinstance(exc, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(exc, (openai.APITimeoutError, httpx.TimeoutException)):
+        return "timeout"
+    if isinstance(exc, (openai.APIConnectionError, httpx.TransportError)):  # Includes dropped streams
+        return "connection"
+    if isinstance(exc, openai.APIStatusError):
+        if exc.status_code >= 500 or exc.status_code in (408, 409):
+            return "server"
+        return "fatal"  # Other 4xx: bad request, auth, not found - retrying will not help
+    if isinstance(exc, openai.APIError):
+        return "server"  # Error event inside an SSE stream
+    return "fatal"
+
+def retry_after_seconds(exc: Exception):
+    """Server-requested wait from Retry-After / retry-after-ms headers, if any."""
+    response = getattr(exc, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            seconds = float(headers['retry-after-ms']) / 1000
+        else:
+            value = headers.get('retry-after')
+            if not value:
+                return None
+            try:
+                seconds = float(value)  # Delay-seconds, including fractional "1.5" from proxies and the mock server
+            except ValueError:
+                return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        return max(seconds, 0.0) if math.isfinite(seconds) else None  # nan/inf would slip past the retry deadline check
+    except (ValueError, TypeError):
+        return None
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the API while the circuit breaker is open."""
+
+class CircuitBreaker:
+    """Process-wide breaker: opens after `threshold` consecutive outage failures, fails fast for `cooldown`
+    seconds, then lets a single probe request through (half-open) and closes again on success."""
+    def __init__(self, threshold: int = XAI_BREAKER_THRESHOLD, cooldown: float = XAI_BREAKER_COOLDOWN, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if self.clock() - self._opened_at >= self.cooldown else "open"
+
+    def before_request(self) -> bool:
+        """Raise CircuitOpenError while open; in half-open, only one caller gets to probe.
+        Returns True if this caller holds the probe (it must end in record_success/record_failure/release_probe)."""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            remaining = self.cooldown - (self.clock() - self._opened_at)
+            if remaining > 0 or self._probing:
+                raise CircuitOpenError(f"xAI API marked unavailable; retry in {max(remaining, 1):.0f}s")
+            self._probing = True
+            return True
+
+    def release_probe(self):
+        """The probe was abandoned (rerun, Stop, cancellation) without an outcome: stay half-open, let the next
+        caller probe."""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self, error_class: str):
+        with self._lock:
+            if error_class not in OUTAGE_ERRORS:
+                self._probing = False
+                return
+            self._failures += 1
+            if self._probing or self._failures >= self.threshold:
+                self._opened_at = self.clock()  # (Re)open: failed probe or too many failures in a row
+            self._probing = False
+
+@process_resource
+def get_circuit_breaker():
+    return CircuitBreaker()
+
+class RetryState:
+    """Retry bookkeeping for one turn. Attempts are counted per request; the deadline covers the whole turn."""
+    def __init__(self, breaker: CircuitBreaker = None, max_attempts: int = XAI_RETRY_MAX_ATTEMPTS,
+                 deadline: float = XAI_TURN_DEADLINE, base_delay: float = XAI_RETRY_BASE_DELAY,
+                 max_delay: float = XAI_RETRY_MAX_DELAY, clock=time.monotonic):
+        self.breaker = breaker
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.deadline_at = clock() + deadline
+        self.attempt = 0
+        self.retries = 0  # Total retries this turn (for stats)
+        self.probing = False  # This turn holds the breaker's half-open probe
+
+    def before_request(self):
+        self.attempt += 1
+        if self.breaker:
+            self.probing = self.breaker.before_request()
+
+    def succeeded(self):
+        self.attempt = 0
+        self.probing = False
+        if self.breaker:
+            self.breaker.record_success()
+
+    def release_probe(self):
+        """Call when a request ends without succeeded()/next_delay() (abandoned or cancelled); no-op otherwise."""
+        if self.probing:
+            self.probing = False
+            self.breaker.release_probe()
+
+    def next_delay(self, exc: Exception):
+        """Seconds to wait before retrying after exc, or None to give up (fatal error, attempts or deadline exhausted)."""
+        error_class = classify_api_error(exc)
+        self.probing = False
+        if self.breaker:
+            self.breaker.record_failure(error_class)
+        if error_class not in RETRYABLE_ERRORS or self.attempt >= self.max_attempts:
+            return None
+        server_delay = retry_after_seconds(exc) if error_class == "rate_limit" else None
+        if server_delay is not None:
+            delay = server_delay  # Honor Retry-After exactly; the turn deadline still bounds it
+        else:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (self.attempt - 1)))  # Full jitter
+        if self.clock() + delay > self.deadline_at:
+            return None
+        self.retries += 1
+        return delay
+
+def log_api_error(exc: Exception, note: str = "", ids: dict = None, final: bool = True):
+    """Queue an API error record; `ids` carries session/turn ids from the script thread.
+    Only the final give-up is an ERROR with a traceback; an attempt that will be retried is a one-line WARNING."""
+    if final:
+        log_api.error("API Error (%s)%s: %s", classify_api_error(exc), note, exc, exc_info=exc, extra=ids)
+    else:
+        log_api.warning("API Error (%s)%s: %s", classify_api_error(exc), note, exc, extra=ids)
+
+# NEW: Token-Aware Context Window (pin system prompt + latest user turn, pack newest history under a per-model budget)
+MODEL_CONTEXT_TOKENS = {"grok-4-0709": 256000, "grok-3-mini": 131072, "grok-code-fast-1": 256000}
+DEFAULT_CONTEXT_TOKENS = 131072
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "64000"))  # Spend cap per request, below the model window
+CONTEXT_RESERVE_TOKENS = int(os.getenv("CONTEXT_RESERVE_TOKENS", "8000"))  # Left free for the reply
+TOOL_RESULT_KEEP_CHARS = int(os.getenv("TOOL_RESULT_KEEP_CHARS", "300"))  # Old tool results are cut to this first
+IMAGE_TOKENS = 1000  # Rough flat cost per attached image
+TOKEN_RE = re.compile(r"\w{1,4}|[^\w\s]")  # Conservative estimate: short word pieces + punctuation
+TOOL_RESULT_RE = re.compile(r"(\[Tool Result \([\w]+\): )(.*?)(\]\n)", re.DOTALL)
+
+def estimate_tokens(text: str) -> int:
+    return len(TOKEN_RE.findall(text)) if text else 0
+
+def message_tokens(msg: dict) -> int:
+    """Token estimate for an API message (text parts, images, tool call arguments, per-message overhead)."""
+    content = msg.get('content')
+    if isinstance(content, list):
+        total = sum(estimate_tokens(part.get('text', '')) if part.get('type') == 'text' else IMAGE_TOKENS for part in content)
+    else:
+        total = estimate_tokens(content or "")
+    for tool_call in msg.get('tool_calls') or []:
+        total += estimate_tokens(tool_call['function']['name']) + estimate_tokens(tool_call['function']['arguments'])
+    return total + 4
+
+def cached_message_tokens(msg: dict) -> int:
+    """Token estimate for a chat history message, cached on the message itself (stale if its content changes)."""
+    cached = msg.get('tokens')
+    if not cached or cached[0] != len(msg['content']):
+        msg['tokens'] = cached = [len(msg['content']), message_tokens({"content": msg['content']})]
+    return cached[1]
+
+def context_budget(model: str) -> int:
+    window = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+    return min(window - CONTEXT_RESERVE_TOKENS, CONTEXT_MAX_TOKENS)
+
+def shrink_tool_results(msg: dict) -> dict:
+    """Copy of msg with bulky tool output elided (tool messages and inline [Tool Result ...] echoes)."""
+    def elide(text):
+        if len(text) <= TOOL_RESULT_KEEP_CHARS:
+            return text
+        return f"{text[:TOOL_RESULT_KEEP_CHARS]}... [{len(text) - TOOL_RESULT_KEEP_CHARS} chars elided]"
+    content = msg.get('content')
+    if not isinstance(content, str):
+        return msg
+    if msg['role'] == 'tool':
+        return {**msg, 'content': elide(content)}
+    if msg['role'] == 'assistant' and '[Tool Result (' in content:
+        return {**msg, 'content': TOOL_RESULT_RE.sub(lambda m: m.group(1) + elide(m.group(2)) + m.group(3), content)}
+    return msg
+
+def pack_context(api_messages: list, model: str, counts: dict = None) -> list:
+    """Fit api_messages into the model's token budget.
+
+    The system prompt and everything from the latest user message on (the current turn, incl. its tool loop)
+    are always kept. If older history does not fit, old tool results are shrunk first, then the newest
+    turns are packed until the budget is used; assistant tool_calls stay grouped with their tool results.
+    `counts` maps id(message) -> known token count to avoid recounting cached history."""
+    counts = counts or {}
+    def size(msg):
+        return counts.get(id(msg)) or message_tokens(msg)
+    budget = context_budget(model)
+    last_user = max((i for i, m in enumerate(api_messages) if m['role'] == 'user'), default=len(api_messages))
+    head, history, tail = api_messages[:1], api_messages[1:last_user], api_messages[last_user:]
+    used = sum(size(m) for m in head) + sum(size(m) for m in tail)
+    if used + sum(size(m) for m in history) <= budget:
+        return api_messages
+    history = [shrink_tool_results(m) for m in history]
+    groups = []
+    for msg in history:
+        if msg['role'] == 'tool' and groups:
+            groups[-1].append(msg)  # Keep with the assistant message that requested it
+        else:
+            groups.append([msg])
+    kept = []
+    for group in reversed(groups):
+        group_size = sum(size(m) for m in group)
+        if used + group_size > budget:
+            break
+        kept = group + kept
+        used += group_size
+    dropped = len(history) - len(kept)
+    if dropped:
+        log_api.info("Context packed for %s: %d older messages omitted, ~%d tokens", model, dropped, used)
+        head = head + [{"role": "system", "content": f"[{dropped} earlier messages omitted to fit the context window]"}]
+    return head + kept + tail
+
+# NEW: Local Response Cache (opt-in; identical requests are replayed as a stream from memory/SQLite)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "false").lower() in ("1", "true", "yes")  # Sidebar default
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB", "response_cache.db")  # Separate file: no contention with chatapp.db
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))  # Seconds
+RESPONSE_CACHE_MAX_MB = float(os.getenv("RESPONSE_CACHE_MAX_MB", "50"))  # On-disk size cap (least recently hit evicted)
+RESPONSE_CACHE_MEMORY_ENTRIES = int(os.getenv("RESPONSE_CACHE_MEMORY_ENTRIES", "256"))
+RESPONSE_REPLAY_CHUNK = 64  # Characters per replayed chunk
+# Only pure tools keep a turn cacheable; anything else has side effects or reads state that may change (files, memory, time)
+CACHEABLE_TOOLS = {"code_lint"}
+
+def response_cache_key(model, sys_prompt, messages, enable_tools, image_files=None) -> str:
+    """Hash of everything that determines the reply: model, system prompt, messages, tool schema, image bytes."""
+    image_digests = []
+    for img_file in image_files or []:
+        img_file.seek(0)
+        image_digests.append(hashlib.sha256(img_file.read()).hexdigest())
+    payload = {
+        "model": model,
+        "system": sys_prompt,
+        "messages": [[msg['role'], msg['content']] for msg in messages],
+        "tools": TOOLS_DIGEST if enable_tools else None,
+        "images": image_digests,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """In-memory LRU in front of a SQLite store with TTL and size-based eviction. Thread-safe."""
+    def __init__(self, path: str = RESPONSE_CACHE_DB, ttl: float = RESPONSE_CACHE_TTL,
+                 max_bytes: int = int(RESPONSE_CACHE_MAX_MB * 1024 * 1024), memory_entries: int = RESPONSE_CACHE_MEMORY_ENTRIES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()  # key -> (created, response)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key TEXT PRIMARY KEY, response TEXT, created REAL, last_hit REAL, size INTEGER)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_last_hit ON response_cache (last_hit)')
+        self._conn.commit()
+
+    def _remember(self, key, created, response):
+        self._memory[key] = (created, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                row = self._conn.execute("SELECT created, response FROM response_cache WHERE cache_key=?", (key,)).fetchone()
+                entry = tuple(row) if row else None
+            if entry is None or now - entry[0] > self.ttl:
+                self.misses += 1
+                self._memory.pop(key, None)
+                return None
+            self._remember(key, *entry)
+            self._conn.execute("UPDATE response_cache SET last_hit=? WHERE cache_key=?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, response)
+            self._conn.execute("INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?)",
+                               (key, response, now, now, len(response.encode('utf-8'))))
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float):
+        self._conn.execute("DELETE FROM response_cache WHERE created < ?", (now - self.ttl,))
+        # Keep the most recently hit entries whose running size fits under max_bytes
+        self._conn.execute('''DELETE FROM response_cache WHERE cache_key IN (
+            SELECT cache_key FROM (SELECT cache_key, SUM(size) OVER (ORDER BY last_hit DESC) AS running FROM response_cache)
+            WHERE running > ?)''', (self.max_bytes,))
+        for key in [k for k, (created, _) in self._memory.items() if created < now - self.ttl]:
+            del self._memory[key]
+
+def replay_cached(response: str):
+    """Yield a cached reply in chunks so the UI takes the same streaming path as a live answer."""
+    for i in range(0, len(response), RESPONSE_REPLAY_CHUNK):
+        yield response[i:i + RESPONSE_REPLAY_CHUNK]
+
+@process_resource
+def get_response_cache():
+    return ResponseCache()
+
+# NEW: Async Core (AsyncOpenAI stream + async tool dispatch). Streamlit drives it through a sync bridge;
+# batch runners and servers can run many conversations on one event loop via acall_xai_api.
+class AsyncClientRegistry:
+    """One pooled AsyncOpenAI client per event loop (async connection pools cannot be shared across loops)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = weakref.WeakKeyDictionary()  # loop -> {(api_key, base_url): client}
+
+    def get(self, api_key: str = API_KEY, base_url: str = XAI_BASE_URL):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = self._clients.setdefault(loop, {})
+            client = clients.get((api_key, base_url))
+            if client is None:
+                timeout = httpx.Timeout(XAI_READ_TIMEOUT, connect=XAI_CONNECT_TIMEOUT)
+                http_client = DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(max_connections=XAI_MAX_CONNECTIONS,
+                                        max_keepalive_connections=XAI_MAX_KEEPALIVE,
+                                        keepalive_expiry=XAI_KEEPALIVE_EXPIRY),
+                    timeout=timeout,
+                    event_hooks={"request": [get_client_stats().aon_request]}
+                )
+                client = clients[(api_key, base_url)] = AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=timeout,
+                                                                    http_client=http_client, max_retries=0)
+            return client
+
+@process_resource
+def get_async_client_registry():
+    return AsyncClientRegistry()
+
+class AsyncBridge:
+    """A background event loop thread that lets sync code (the Streamlit script) iterate async generators."""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="grokcoder-async", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    async def _step(agen, running: list):
+        running.append(asyncio.current_task())  # Lets _settle() wait for this step if it gets cancelled
+        return await agen.__anext__()
+
+    @staticmethod
+    async def _settle(running: list):
+        """Wait until a cancelled step has unwound, so the generator is no longer running when it is closed."""
+        if running:
+            await asyncio.wait(running)
+
+    def iterate(self, agen, on_idle=None, idle: float = 0.1):
+        """Sync generator over an async generator run on the bridge loop. Closing it early closes the async side,
+        which cancels pending tool calls and releases the HTTP stream. While no piece arrives (tools running,
+        retry backoff, a slow model), `on_idle()` is called on the caller's thread every `idle` seconds."""
+        try:
+            while True:
+                running = []
+                step = asyncio.run_coroutine_threadsafe(self._step(agen, running), self.loop)
+                try:
+                    while True:
+                        try:
+                            piece = step.result(timeout=idle if on_idle else None)
+                            break
+                        except concurrent.futures.TimeoutError:
+                            on_idle()  # May raise Streamlit's rerun/stop exceptions while the step is still pending
+                except StopAsyncIteration:
+                    return
+                except BaseException:
+                    if not step.done():
+                        step.cancel()  # Cancels the step's task on the loop (or stops it from starting)
+                        asyncio.run_coroutine_threadsafe(self._settle(running), self.loop).result()
+                    raise
+                yield piece
+        finally:
+            asyncio.run_coroutine_threadsafe(agen.aclose(), self.loop).result()
+
+@process_resource
+def get_async_bridge():
+    return AsyncBridge()
+
+class TurnState:
+    """Results of one chat turn, filled in by the core loop and read by its caller."""
+    def __init__(self):
+        self.full_response = ""  # Model text only (no tool echoes or notices)
+        self.cacheable = True  # Cleared by errors, retries, truncation or non-cacheable tools
+        self.iterations = 0
+        self.error = None  # Set when the turn gave up (API error or circuit open)
+        self.turn_id = uuid.uuid4().hex[:12]
+        self.log_ids = {**log_ids(), "turn": self.turn_id}  # Captured where the turn starts (the loop thread has no context)
+        self.started = time.perf_counter()
+        self.ttft = None  # Seconds until the first streamed text
+        self.usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}  # Summed over iterations
+        self.iteration_usage = []  # Usage block reported for each API iteration
+        self.iteration_timings = []  # {"iteration", "seconds", "ttft", "tokens"} per API iteration (retries included)
+        self.tool_timings = []  # (func_name, wall seconds) per tool call
+
+    def add_usage(self, usage, model: str = None, iteration: int = None):
+        tokens = {key: getattr(usage, key, 0) or 0 for key in self.usage}
+        self.iteration_usage.append({**tokens, "model": model, "iteration": iteration})
+        for key, value in tokens.items():
+            self.usage[key] += value
+
+class StreamRetry(str):
+    """Notice yielded when a stream broke mid-reply and is retried: the `discard` characters of model text streamed
+    just before it belong to the interrupted attempt and are replaced by the retry, so consumers must drop them."""
+    def __new__(cls, notice: str, discard: int):
+        piece = super().__new__(cls, notice)
+        piece.discard = discard
+        return piece
+
+def join_stream(pieces) -> str:
+    """Reply text from streamed pieces, without interrupted attempts or their retry notices."""
+    kept = []
+    for piece in pieces:
+        if isinstance(piece, StreamRetry):
+            text = "".join(kept)
+            kept = [text[:len(text) - piece.discard]]
+        else:
+            kept.append(piece)
+    return "".join(kept)
+
+def prepare_api_messages(messages, sys_prompt, image_files=None):
+    """Build API messages (system first, then history) and the cached token counts pack_context can reuse."""
     api_messages = [{"role": "system", "content": sys_prompt}]
+    token_counts = {}  # id(api message) -> cached history token count
     for msg in messages:
         content_parts = [{"type": "text", "text": msg['content']}]
         if msg['role'] == 'user' and image_files and msg is messages[-1]:  # Add images to last user message
@@ -645,131 +2330,632 @@ def call_xai_api(model, messages, sys_prompt, stream=True, image_files=None, ena
                 img_data = base64.b64encode(img_file.read()).decode('utf-8')
                 content_parts.append({"type": "image_url", "image_url": {"url": f"data:{img_file.type};base64,{img_data}"}})
         api_messages.append({"role": msg['role'], "content": content_parts if len(content_parts) > 1 else msg['content']})
-    full_response = ""
-    def generate(current_messages):
-        nonlocal full_response
-        max_iterations = 5  # Balanced for agentic tasks without high loop risk
-        iteration = 0
-        while iteration < max_iterations:
-            iteration += 1
-            print(f"[LOG] API Call Iteration: {iteration}")  # Debug
-            tools_param = TOOLS if enable_tools else None
-            response = client.chat.completions.create(
-                model=model,
-                messages=current_messages,
-                tools=tools_param,
-                tool_choice="auto" if enable_tools else None,
-                stream=True
-            )
-            tool_calls = []
+        if len(content_parts) == 1:
+            token_counts[id(api_messages[-1])] = cached_message_tokens(msg)
+    return api_messages, token_counts
+
+async def astream_chat(client, model, current_messages, token_counts=None, enable_tools=False, tool_ctx=None,
+                       executor=None, retry=None, turn=None, limiter=None):
+    """Async generator over one turn: streams text, runs tool calls, and loops until the model is done.
+    `limiter` (optional) is anything with an async acquire(), awaited before every API request."""
+    turn = turn or TurnState()
+    retry = retry or RetryState()
+    executor = executor or get_tool_executor()
+    tool_ctx = tool_ctx or ToolContext()
+    max_iterations = 5  # Balanced for agentic tasks without high loop risk
+    iteration = 0
+    while iteration < max_iterations:
+        iteration += 1
+        turn.iterations = iteration
+        log_api.debug("API Call Iteration: %d", iteration, extra=turn.log_ids)
+        tools_param = TOOLS if enable_tools else None
+        iteration_started = time.perf_counter()
+        iteration_ttft = None
+        usage_seen = len(turn.iteration_usage)
+        while True:  # Retry loop: covers request creation and failures mid-stream
+            # Tool calls are merged by index and start running as soon as each one's arguments are complete
+            batch = executor.batch(tool_ctx) if enable_tools else None
+            accumulator = ToolCallAccumulator(on_complete=batch.submit if batch else None)
             chunk_response = ""
             has_content = False
-            for chunk in response:
-                delta = chunk.choices[0].delta
-                if delta.content is not None:
-                    content = delta.content
-                    chunk_response += content
-                    yield content
-                    has_content = True
-                if delta.tool_calls:
-                    tool_calls += delta.tool_calls
-            full_response += chunk_response
-            if not tool_calls and not has_content:
-                print("[DEBUG] No progress in this iteration; breaking early")
-                break  # Graceful exit if nothing new
-            if not tool_calls:
-                break  # Normal done
-            yield "\nProcessing additional steps...\n"  # User-friendly feedback
-            # Process all tool calls in batch
-            tools_processed = False
-            for tool_call in tool_calls:
+            response = None
+            try:
+                retry.before_request()
+                if limiter:
+                    await limiter.acquire()
+                request_started = time.perf_counter()
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=pack_context(current_messages, model, token_counts),
+                    tools=tools_param,
+                    tool_choice="auto" if enable_tools else None,
+                    stream=True,
+                    stream_options={"include_usage": True}  # Final chunk carries token usage
+                )
+                async for chunk in response:
+                    if chunk.usage:
+                        turn.add_usage(chunk.usage, model, iteration)
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.content is not None:
+                        content = delta.content
+                        chunk_response += content
+                        if iteration_ttft is None:
+                            iteration_ttft = time.perf_counter() - iteration_started
+                        if turn.ttft is None:
+                            turn.ttft = time.perf_counter() - turn.started
+                        yield content
+                        has_content = True
+                    if delta.tool_calls:
+                        accumulator.add(delta.tool_calls)
+                retry.succeeded()
+                METRICS.inc("grokcoder_api_requests", (("model", model), ("outcome", "ok")))
+                METRICS.observe("grokcoder_api_request_duration_seconds", time.perf_counter() - request_started, (("model", model),))
+                break
+            except CircuitOpenError as e:
+                METRICS.inc("grokcoder_api_requests", (("model", model), ("outcome", "circuit_open")))
+                turn.cacheable = False
+                turn.error = str(e)
+                yield f"\n[API unavailable: {e}]\n"
+                return
+            except (asyncio.CancelledError, GeneratorExit):
+                if batch:
+                    batch.cancel()
+                raise
+            except Exception as e:
+                turn.cacheable = False
+                if batch:
+                    batch.cancel()
+                delay = retry.next_delay(e)
+                METRICS.inc("grokcoder_api_requests", (("model", model), ("outcome", classify_api_error(e))))
+                if delay is not None:
+                    METRICS.inc("grokcoder_api_retries", (("error_class", classify_api_error(e)),))
+                log_api_error(e, f" on attempt {retry.attempt}" + ("" if delay is None else f"; retrying in {delay:.1f}s"), turn.log_ids,
+                              final=delay is None)
+                if delay is None:
+                    turn.error = f"{classify_api_error(e)}: {e}"
+                    yield f"\n[API Error ({classify_api_error(e)}): {e}. Giving up after {retry.attempt} attempt(s).]\n"
+                    return
+                if has_content:
+                    yield StreamRetry("\n[Stream interrupted; retrying...]\n", len(chunk_response))
+                await asyncio.sleep(delay)
+            finally:
+                retry.release_probe()  # Abandoned mid-request (GeneratorExit/CancelledError): don't strand the breaker half-open
+                if response is not None:
+                    await response.close()  # Release the pooled connection even if the consumer stopped early
+        accumulator.finish()
+        tool_calls = accumulator.message_tool_calls()
+        turn.full_response += chunk_response
+        reported = turn.iteration_usage[usage_seen:]
+        for usage in reported:
+            METRICS.inc("grokcoder_tokens", (("model", model), ("direction", "in")), usage["prompt_tokens"])
+            METRICS.inc("grokcoder_tokens", (("model", model), ("direction", "out")), usage["completion_tokens"])
+            METRICS.inc("grokcoder_cost_dollars", (("model", model),),
+                        usage_cost(model, usage["prompt_tokens"], usage["completion_tokens"]) or 0)
+        if iteration_ttft is not None:
+            METRICS.observe("grokcoder_api_ttft_seconds", iteration_ttft, (("model", model),))
+        turn.iteration_timings.append({
+            "iteration": iteration, "seconds": time.perf_counter() - iteration_started, "ttft": iteration_ttft,
+            "tokens": reported[-1]["completion_tokens"] if reported else estimate_tokens(chunk_response)})
+        if not tool_calls and not has_content:
+            log_api.debug("No progress in this iteration; breaking early", extra=turn.log_ids)
+            break  # Graceful exit if nothing new
+        if not tool_calls or batch is None:
+            break  # Normal done (tool calls are ignored when tools are disabled)
+        if any(call['function']['name'] not in CACHEABLE_TOOLS for call in tool_calls):
+            turn.cacheable = False
+        yield "\nProcessing additional steps...\n"  # User-friendly feedback
+        # The assistant turn that requested the tools must precede their results
+        current_messages.append({"role": "assistant", "content": chunk_response or None, "tool_calls": tool_calls})
+        # Collect the batch: independent calls already run concurrently, results stay in call order
+        tools_processed = False
+        try:
+            async for call_id, func_name, result in batch.aresults():
                 tools_processed = True
-                func_name = tool_call.function.name
-                try:
-                    args = json.loads(tool_call.function.arguments)
-                    if func_name == "fs_read_file":
-                        result = fs_read_file(args['file_path'])
-                    elif func_name == "fs_write_file":
-                        result = fs_write_file(args['file_path'], args['content'])
-                    elif func_name == "fs_list_files":
-                        dir_path = args.get('dir_path', "")
-                        result = fs_list_files(dir_path)
-                    elif func_name == "fs_mkdir":
-                        result = fs_mkdir(args['dir_path'])
-                    elif func_name == "get_current_time":
-                        sync = args.get('sync', False)
-                        fmt = args.get('format', 'iso')
-                        result = get_current_time(sync, fmt)
-                    elif func_name == "code_execution":
-                        result = code_execution(args['code'])
-                    elif func_name == "memory_insert":
-                        user = st.session_state['user']
-                        convo_id = st.session_state.get('current_convo_id', 0)
-                        result = memory_insert(user, convo_id, args['mem_key'], args['mem_value'])
-                    elif func_name == "memory_query":
-                        user = st.session_state['user']
-                        convo_id = st.session_state.get('current_convo_id', 0)
-                        mem_key = args.get('mem_key')
-                        limit = args.get('limit', 10)
-                        result = memory_query(user, convo_id, mem_key, limit)
-                    # NEW: Handle new tools
-                    elif func_name == "git_ops":
-                        operation = args['operation']
-                        repo_path = args['repo_path']
-                        result = git_ops(operation, repo_path, **args)
-                    elif func_name == "db_query":
-                        db_path = args['db_path']
-                        query = args['query']
-                        params = args.get('params', [])
-                        result = db_query(db_path, query, params)
-                    elif func_name == "shell_exec":
-                        command = args['command']
-                        result = shell_exec(command)
-                    elif func_name == "code_lint":
-                        language = args['language']
-                        code = args['code']
-                        result = code_lint(language, code)
-                    elif func_name == "api_simulate":
-                        url = args['url']
-                        method = args.get('method', 'GET')
-                        data = args.get('data')
-                        mock = args.get('mock', True)
-                        result = api_simulate(url, method, data, mock)
-                    else:
-                        result = "Unknown tool."
-                except Exception as e:
-                    result = f"Tool error: {traceback.format_exc()}"
-                    print(f"[LOG] Tool Error: {result}")  # Debug
-                    with open('app.log', 'a') as log:
-                        log.write(f"Tool Error: {result}\n")
                 yield f"\n[Tool Result ({func_name}): {result}]\n"
                 # Append to messages for next iteration
-                current_messages.append({"role": "tool", "content": result, "tool_call_id": tool_call.id})
-            if not tools_processed:
-                print("[DEBUG] No meaningful tools processed; breaking early")
-                break  # Added: Prevent unnecessary iterations if no tools were actually handled
-        if iteration >= max_iterations:
-            yield "Reached max steps—summarizing results so far to avoid delays."
+                current_messages.append({"role": "tool", "content": result, "tool_call_id": call_id})
+        finally:
+            batch.cancel()  # No-op when all calls finished; cancels queued ones if the turn was abandoned
+            turn.tool_timings.extend(batch.timings)
+        if not tools_processed:
+            log_api.debug("No meaningful tools processed; breaking early", extra=turn.log_ids)
+            break  # Added: Prevent unnecessary iterations if no tools were actually handled
+    if iteration >= max_iterations:
+        turn.cacheable = False
+        yield "Reached max steps—summarizing results so far to avoid delays."
+
+async def acall_xai_api(model, messages, sys_prompt, image_files=None, enable_tools=False, tool_ctx=None,
+                        client=None, turn=None, retry=None, limiter=None):
+    """Async entry point for non-Streamlit callers: yields streamed text for one turn (tools included)."""
+    api_messages, token_counts = prepare_api_messages(messages, sys_prompt, image_files)
+    client = client or get_async_client_registry().get()
+    # aclosing: closing this generator closes the core now (releasing the stream and any breaker probe), not at GC
+    async with contextlib.aclosing(astream_chat(client, model, api_messages, token_counts, enable_tools, tool_ctx,
+                                                retry=retry or RetryState(breaker=get_circuit_breaker()), turn=turn,
+                                                limiter=limiter)) as pieces:
+        async for piece in pieces:
+            yield piece
+
+# API Wrapper with Streaming and Tool Handling (sync facade over the async core for Streamlit)
+def call_xai_api(model, messages, sys_prompt, stream=True, image_files=None, enable_tools=False, use_cache=False,
+                 turn=None, on_idle=None):
+    """`turn` (optional TurnState) collects usage and latency for the caller; it is filled while the stream is consumed.
+    `on_idle` (optional) is called on this thread while the stream stalls, e.g. StreamRenderer.flush."""
+    cache_key = None
+    if use_cache and stream:
+        cache_key = response_cache_key(model, sys_prompt, messages, enable_tools, image_files)
+        cached = get_response_cache().get(cache_key)
+        if cached is not None:
+            log_api.info("Response cache hit")
+            return replay_cached(cached)
+    # Resolved here on the script thread: the core runs on the bridge loop, where session_state is unavailable
+    tool_ctx = ToolContext.from_session() if enable_tools else None
+    executor = get_tool_executor()
+    retry = RetryState(breaker=get_circuit_breaker())  # One retry budget/deadline per turn
+    turn = turn or TurnState()
+    api_messages, token_counts = prepare_api_messages(messages, sys_prompt, image_files)
+    bridge = get_async_bridge()
+    registry = get_async_client_registry()
+    async def core():
+        async with contextlib.aclosing(astream_chat(registry.get(), model, api_messages, token_counts, enable_tools,
+                                                    tool_ctx, executor, retry, turn)) as pieces:
+            async for piece in pieces:
+                yield piece
+    def generate_and_cache():
+        pieces = []
+        for piece in bridge.iterate(core(), on_idle):
+            pieces.append(piece)
+            yield piece
+        if turn.cacheable:  # Only complete, clean turns (an abandoned stream never gets here)
+            get_response_cache().put(cache_key, "".join(pieces))
+    if stream:
+        if cache_key:
+            return generate_and_cache()
+        return bridge.iterate(core(), on_idle)  # Return generator for streaming (retries happen inside)
+    client = get_xai_client()
     try:
-        if stream:
-            return generate(api_messages)  # Return generator for streaming
+        while True:
+            try:
+                retry.before_request()
+                response = client.chat.completions.create(
+                    model=model,
+                    messages=pack_context(api_messages, model, token_counts),
+                    tools=TOOLS if enable_tools else None,
+                    tool_choice="auto" if enable_tools else None,
+                    stream=False
+                )
+                retry.succeeded()
+                METRICS.inc("grokcoder_api_requests", (("model", model), ("outcome", "ok")))
+                if response.usage:
+                    turn.add_usage(response.usage, model, 1)
+                    METRICS.inc("grokcoder_cost_dollars", (("model", model),),
+                                usage_cost(model, response.usage.prompt_tokens or 0, response.usage.completion_tokens or 0) or 0)
+                    METRICS.inc("grokcoder_tokens", (("model", model), ("direction", "in")), response.usage.prompt_tokens or 0)
+                    METRICS.inc("grokcoder_tokens", (("model", model), ("direction", "out")), response.usage.completion_tokens or 0)
+                full_response = response.choices[0].message.content
+                return lambda: [full_response]  # Mock generator for non-stream
+            except CircuitOpenError as e:
+                METRICS.inc("grokcoder_api_requests", (("model", model), ("outcome", "circuit_open")))
+                st.error(f"API unavailable: {e}")
+                return lambda: []
+            except Exception as e:
+                delay = retry.next_delay(e)
+                METRICS.inc("grokcoder_api_requests", (("model", model), ("outcome", classify_api_error(e))))
+                if delay is not None:
+                    METRICS.inc("grokcoder_api_retries", (("error_class", classify_api_error(e)),))
+                log_api_error(e, "" if delay is None else f"; retrying in {delay:.1f}s", turn.log_ids, final=delay is None)
+                if delay is None:
+                    st.error(f"API Error: {e}")
+                    return lambda: []
+                time.sleep(delay)
+    finally:
+        retry.release_probe()  # Interrupted mid-request (e.g. a rerun): don't strand the breaker half-open
+
+# NEW: Incremental Streaming Renderer (escape only the new delta, throttle UI frames, render closed code fences once)
+STREAM_RENDER_FPS = float(os.getenv("STREAM_RENDER_FPS", "15"))  # Max live UI updates per second while streaming
+CODE_FENCE = "```"
+
+def split_fence_language(block: str):
+    """Split a fenced block body into (language, code); defaults to python like the history view."""
+    first, sep, rest = block.partition("\n")
+    if sep and re.fullmatch(r"[\w+#.-]*", first.strip()):
+        return (first.strip() or 'python'), rest
+    return 'python', block
+
+class StreamRenderer:
+    """Renders a streamed reply into a Streamlit container without re-escaping or re-sending the whole text.
+
+    The live tail lives in one st.empty() slot that is refreshed at most `fps` times per second.
+    When a code fence closes, the text before it and the code block are written once as permanent
+    elements and the live slot restarts after them. A StreamRetry redraws the reply without the interrupted
+    attempt's text."""
+    def __init__(self, container, fps: float = STREAM_RENDER_FPS, role_class: str = "chat-bubble-assistant",
+                 clock=time.perf_counter):
+        self._outer = container
+        self._root = container.empty()  # Holds everything below; cleared and replaced if a broken stream is retried
+        self.container = self._root.container()
+        self.min_interval = 1.0 / fps if fps > 0 else 0.0
+        self.role_class = role_class
+        self.clock = clock
+        self.frames = 0  # Number of UI updates sent (for benchmarks)
+        self.render_time = 0.0  # Seconds spent escaping and sending UI updates (latency metrics)
+        self._chunks = []  # Full raw reply
+        self._raw = ""  # Raw text of the live segment (since the last closed fence)
+        self._escaped = []  # Escaped pieces of the live segment
+        self._scan = 0  # Where to resume searching for the next fence in _raw
+        self._open_fence = -1  # Index of an unclosed opening fence in _raw
+        self._dirty = False
+        self._notice = ""  # Escaped retry notice shown after the live text until new text arrives
+        self._last_frame = float('-inf')
+        self._live = self.container.empty()
+
+    def _bubble(self, escaped: str) -> str:
+        return f"<div class='{self.role_class}'><div class='wrapped-code'>{escaped}</div></div>"
+
+    def feed(self, delta: str):
+        """Add a streamed chunk; renders only if the frame interval has elapsed."""
+        if not delta:
+            return
+        if isinstance(delta, StreamRetry):
+            self._retry(delta)
+            return
+        started = time.perf_counter()
+        self._notice = ""
+        self._chunks.append(delta)
+        self._raw += delta
+        self._escaped.append(html.escape(delta))
+        self._dirty = True
+        self._close_fences()
+        now = self.clock()
+        if now - self._last_frame >= self.min_interval:
+            self._render_live(now)
+        self.render_time += time.perf_counter() - started
+
+    def _retry(self, notice: StreamRetry):
+        """Redraw the reply without the interrupted attempt's text, which may already sit in finished code blocks."""
+        started = time.perf_counter()
+        kept = join_stream(self._chunks + [notice])
+        self._root.empty()  # Drop every element written so far and redraw in a fresh slot
+        self._root = self._outer.empty()
+        self.container = self._root.container()
+        self._live = self.container.empty()
+        self._chunks, self._raw, self._escaped = [], "", []
+        self._scan, self._open_fence = 0, -1
+        self.frames += 1
+        if kept:
+            self._chunks.append(kept)
+            self._raw = kept
+            self._escaped.append(html.escape(kept))
+            self._close_fences()
+        self._notice = html.escape(notice)
+        self._dirty = True
+        self._render_live(self.clock())
+        self.render_time += time.perf_counter() - started
+
+    def _close_fences(self):
+        while True:
+            idx = self._raw.find(CODE_FENCE, self._scan)
+            if idx < 0:
+                self._scan = max(self._scan, len(self._raw) - len(CODE_FENCE) + 1)  # A fence may straddle chunks
+                return
+            if self._open_fence < 0:
+                self._open_fence = idx
+                self._scan = idx + len(CODE_FENCE)
+            else:
+                self._finalize_segment(idx)
+
+    def _finalize_segment(self, close_idx: int):
+        """Write the text before the fence and the finished code block once, then restart the live slot."""
+        before = self._raw[:self._open_fence]
+        block = self._raw[self._open_fence + len(CODE_FENCE):close_idx]
+        rest = self._raw[close_idx + len(CODE_FENCE):]
+        if before.strip():
+            self._live.markdown(self._bubble(html.escape(before)), unsafe_allow_html=True)
         else:
-            response = client.chat.completions.create(
-                model=model,
-                messages=api_messages,
-                tools=TOOLS if enable_tools else None,
-                tool_choice="auto" if enable_tools else None,
-                stream=False
-            )
-            full_response = response.choices[0].message.content
-            return lambda: [full_response]  # Mock generator for non-stream
+            self._live.empty()
+        language, code = split_fence_language(block)
+        self.container.code(code, language=language)
+        self.frames += 1
+        self._live = self.container.empty()
+        self._raw = rest
+        self._escaped = [html.escape(rest)] if rest else []
+        self._scan = 0
+        self._open_fence = -1
+        self._dirty = bool(rest)
+
+    def _render_live(self, now: float):
+        if self._dirty:
+            escaped = "".join(self._escaped)
+            self._escaped = [escaped]  # Keep the piece list short
+            self._live.markdown(self._bubble(escaped + self._notice), unsafe_allow_html=True)
+            self.frames += 1
+            self._dirty = False
+        self._last_frame = now
+
+    def flush(self):
+        """Render pending text now, ignoring the frame interval. Call it when the stream stalls (no next delta
+        is coming soon, e.g. while tools run), so the tail of the reply isn't held back."""
+        if self._dirty:
+            started = time.perf_counter()
+            self._render_live(self.clock())
+            self.render_time += time.perf_counter() - started
+
+    def finish(self) -> str:
+        """Flush the last frame and return the full raw reply."""
+        started = time.perf_counter()
+        self._render_live(self.clock())
+        self.render_time += time.perf_counter() - started
+        return "".join(self._chunks)
+
+# NEW: Turn Latency Metrics (one row per measurement in chatapp.db; p50/p95 per session in the sidebar)
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile of a non-empty list (q in 0..100)."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)), 1) - 1]
+
+def turn_metric_rows(turn: TurnState, total: float = None, render: float = None, history_render: float = None,
+                     db_commit: float = None) -> list:
+    """Flatten a finished turn into (metric, label, value) rows; times in ms, token counts as-is."""
+    rows = []
+    def add(metric, seconds, label=None):
+        if seconds is not None:
+            rows.append((metric, label, round(seconds * 1000, 3)))
+    add("turn_total", total)
+    add("ttft", turn.ttft)
+    for timing in turn.iteration_timings:
+        add("api_iteration", timing["seconds"], str(timing["iteration"]))
+        rows.append(("iteration_tokens", str(timing["iteration"]), timing["tokens"]))
+    for func_name, seconds in turn.tool_timings:
+        add("tool", seconds, func_name)
+    add("db_commit", db_commit)
+    add("render_stream", render)
+    add("render_history", history_render)
+    return rows
+
+def record_turn_metrics(user: str, session_id: str, convo_id: int, turn_id: str, rows: list):
+    try:
+        DB.executemany("INSERT INTO metrics (user, session_id, convo_id, turn_id, metric, label, value) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       [(user, session_id, convo_id, turn_id, metric, label, value) for metric, label, value in rows])
     except Exception as e:
-        error_msg = f"API Error: {traceback.format_exc()}"
-        st.error(error_msg)
-        with open('app.log', 'a') as log:
-            log.write(f"{error_msg}\n")
-        time.sleep(5)
-        return call_xai_api(model, messages, sys_prompt, stream, image_files, enable_tools)  # Retry
+        note_sqlite_error(e)
+        log_db.warning("Metrics write failed: %s", e)  # Metrics must never break a chat turn
+
+def session_latency_summary(session_id: str) -> list:
+    """p50/p95 per metric for one session (tools are broken out by name)."""
+    groups = {}
+    for metric, label, value in DB.query("SELECT metric, label, value FROM metrics WHERE session_id=?", (session_id,)):
+        name = f"tool: {label}" if metric == "tool" else metric
+        groups.setdefault(name, []).append(value)
+    return [{"metric": name, "n": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95)}
+            for name, values in sorted(groups.items())]
+
+# NEW: Token Usage and Cost Accounting (reported usage per API iteration in chatapp.db; sidebar totals per conversation/model)
+DEFAULT_MODEL_PRICES = {  # USD per 1M tokens: (prompt, completion)
+    "grok-4-0709": (3.00, 15.00),
+    "grok-3-mini": (0.30, 0.50),
+    "grok-code-fast-1": (0.20, 1.50),
+}
+
+def parse_model_prices(spec: str) -> dict:
+    """Parse price overrides like 'grok-4-0709=3/15,grok-3-mini=0.3/0.5' (from MODEL_PRICES in .env) over the defaults."""
+    prices = dict(DEFAULT_MODEL_PRICES)
+    for item in (spec or "").split(','):
+        name, sep, value = item.partition('=')
+        prompt_price, slash, completion_price = value.partition('/')
+        try:
+            if sep and slash:
+                prices[name.strip()] = (float(prompt_price), float(completion_price))
+        except ValueError:
+            log_app.warning("Ignoring malformed MODEL_PRICES entry: %s", item)
+    return prices
+
+MODEL_PRICES = parse_model_prices(os.getenv("MODEL_PRICES", ""))
+
+def usage_cost(model: str, prompt_tokens: int, completion_tokens: int):
+    """Cost in USD, or None if the model has no price."""
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1_000_000
+
+def turn_cost(turn: TurnState) -> float:
+    return sum(usage_cost(u["model"], u["prompt_tokens"], u["completion_tokens"]) or 0 for u in turn.iteration_usage)
+
+def record_turn_usage(user: str, session_id: str, convo_id: int, turn: TurnState, prompt: str = None):
+    rows = [(user, session_id, convo_id, turn.turn_id, u["model"], u["iteration"], prompt, u["prompt_tokens"],
+             u["completion_tokens"], u["total_tokens"], usage_cost(u["model"], u["prompt_tokens"], u["completion_tokens"]))
+            for u in turn.iteration_usage]
+    if not rows:
+        return
+    try:
+        DB.executemany("""INSERT INTO token_usage (user, session_id, convo_id, turn_id, model, iteration, prompt, prompt_tokens,
+                          completion_tokens, total_tokens, cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+    except Exception as e:
+        note_sqlite_error(e)
+        log_db.warning("Usage write failed: %s", e)  # Accounting must never break a chat turn
+
+def conversation_usage(user: str, limit: int = 10) -> list:
+    """Token totals per conversation for one user, biggest first."""
+    rows = DB.query("""SELECT u.convo_id, h.title, COUNT(DISTINCT u.turn_id), SUM(u.prompt_tokens), SUM(u.completion_tokens), SUM(u.cost)
+                       FROM token_usage u LEFT JOIN conversations h ON h.convo_id = u.convo_id
+                       WHERE u.user=? GROUP BY u.convo_id ORDER BY SUM(u.total_tokens) DESC LIMIT ?""", (user, limit))
+    return [{"conversation": title or f"#{convo_id}", "turns": turns, "prompt": prompt_tokens, "completion": completion_tokens,
+             "cost_usd": round(cost or 0, 4)} for convo_id, title, turns, prompt_tokens, completion_tokens, cost in rows]
+
+def model_cost_summary(user: str) -> list:
+    """Cumulative tokens and cost per model for one user."""
+    rows = DB.query("""SELECT model, COUNT(DISTINCT turn_id), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost)
+                       FROM token_usage WHERE user=? GROUP BY model ORDER BY SUM(cost) DESC""", (user,))
+    return [{"model": model, "turns": turns, "prompt": prompt_tokens, "completion": completion_tokens,
+             "cost_usd": round(cost, 4) if cost is not None else None} for model, turns, prompt_tokens, completion_tokens, cost in rows]
+
+# NEW: Opt-in Profiling (cProfile + tracemalloc around the next N reruns or turns; reports in ./diagnostics)
+DIAGNOSTICS_DIR = os.getenv("DIAGNOSTICS_DIR", "./diagnostics")
+PROFILE_RERUNS = int(os.getenv("PROFILE_RERUNS", "0"))  # Profile the next N reruns after startup (any session)
+PROFILE_TURNS = int(os.getenv("PROFILE_TURNS", "0"))  # Profile the next N chat turns after startup (any session)
+PROFILE_TOP_N = 25  # Rows in the text reports
+GROKCODER_ADMINS = {name.strip() for name in os.getenv("GROKCODER_ADMINS", "").split(",") if name.strip()}  # See the sidebar toggle
+
+class ProfileBudget:
+    """Process-wide countdown of env-requested captures (PROFILE_RERUNS / PROFILE_TURNS)."""
+    def __init__(self, reruns: int = 0, turns: int = 0):
+        self._lock = threading.Lock()
+        self.remaining = {"rerun": reruns, "turn": turns}
+
+    def take(self, kind: str) -> bool:
+        with self._lock:
+            if self.remaining.get(kind, 0) > 0:
+                self.remaining[kind] -= 1
+                return True
+            return False
+
+@process_resource
+def get_profile_budget():
+    return ProfileBudget(PROFILE_RERUNS, PROFILE_TURNS)
+
+def hottest_app_functions(stats: pstats.Stats, limit: int = 15) -> list:
+    """Functions defined in this script, by cumulative time."""
+    app_file = os.path.abspath(__file__)
+    rows = []
+    for (filename, lineno, funcname), (cc, nc, tt, ct, callers) in stats.stats.items():
+        if os.path.abspath(filename) == app_file:
+            rows.append({"function": f"{funcname} (line {lineno})", "calls": nc,
+                         "own_ms": round(tt * 1000, 2), "cumulative_ms": round(ct * 1000, 2)})
+    return sorted(rows, key=lambda row: row["cumulative_ms"], reverse=True)[:limit]
+
+class ProfileCapture:
+    """Profiles one rerun or turn: cProfile on the calling thread (plus the async bridge loop thread for turns,
+    where the API stream and tool dispatch run) and tracemalloc. Writes <stamp>-<label>.prof and a .txt report
+    (hottest app functions, top allocations) to DIAGNOSTICS_DIR, then hands the report dict to on_report."""
+    _active = set()  # Thread idents being profiled; nested captures on a thread are skipped
+    _loop_lock = threading.Lock()  # The shared loop thread takes one profiler at a time
+
+    def __init__(self, label: str, loop=None, on_report=None):
+        self.label = label
+        self.loop = loop
+        self.on_report = on_report
+        self.profile = cProfile.Profile()
+        self.loop_profile = None
+        self.report = None
+        self._owns_tracemalloc = False
+        self._profiling = False  # The calling thread's profiler is enabled
+
+    def _on_loop(self, fn):
+        async def call():
+            fn()  # Runs on the loop thread, so the profiler attaches to that thread
+        asyncio.run_coroutine_threadsafe(call(), self.loop).result(timeout=5)
+
+    def __enter__(self):
+        ProfileCapture._active.add(threading.get_ident())
+        try:
+            self._start()
+        except BaseException as e:
+            self._undo()  # Never leave tracemalloc, a profiler or the loop lock behind
+            if not isinstance(e, Exception):
+                raise
+            log_app.warning("Profiling skipped for this %s: %s", self.label, e)  # e.g. another capture holds the profiler
+        return self
+
+    def _start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self._owns_tracemalloc = True
+        self.started = time.perf_counter()
+        self.profile.enable()  # The calling thread's profile comes first: it is the one the capture needs
+        self._profiling = True
+        if self.loop is not None and ProfileCapture._loop_lock.acquire(blocking=False):
+            self.loop_profile = cProfile.Profile()
+            try:
+                self._on_loop(self.loop_profile.enable)
+            except Exception as e:  # Python 3.12+: one profiler per process, and it already sees every thread
+                log_app.debug("Loop-thread profiler not enabled: %s", e)
+                self.loop_profile = None
+                ProfileCapture._loop_lock.release()
+
+    def _undo(self):
+        if self._profiling:
+            self.profile.disable()
+            self._profiling = False
+        if self.loop_profile is not None:
+            try:
+                self._on_loop(self.loop_profile.disable)
+            except Exception as e:
+                log_app.warning("Disabling the loop-thread profiler failed: %s", e)
+            finally:
+                self.loop_profile = None
+                ProfileCapture._loop_lock.release()
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+            self._owns_tracemalloc = False
+        ProfileCapture._active.discard(threading.get_ident())
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self._profiling:
+            return False  # Setup failed and was undone in __enter__
+        self.profile.disable()
+        self._profiling = False
+        elapsed = time.perf_counter() - self.started
+        if self.loop_profile is not None:
+            try:
+                self._on_loop(self.loop_profile.disable)
+            finally:
+                ProfileCapture._loop_lock.release()
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+        ProfileCapture._active.discard(threading.get_ident())
+        try:
+            self.report = self._write(snapshot, elapsed)
+            log_app.info("Profile written: %s (%.1f ms)", self.report["prof"], self.report["wall_ms"])
+            if self.on_report:
+                self.on_report(self.report)
+        except Exception:
+            log_app.exception("Writing profile failed")
+        return False  # Never swallow the wrapped code's exceptions (incl. Streamlit rerun control flow)
+
+    def _write(self, snapshot, elapsed: float) -> dict:
+        os.makedirs(DIAGNOSTICS_DIR, exist_ok=True)
+        stem = os.path.join(DIAGNOSTICS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{self.label}-{uuid.uuid4().hex[:6]}")
+        stats = pstats.Stats(self.profile)
+        if self.loop_profile is not None:
+            try:
+                stats.add(self.loop_profile)
+            except TypeError:
+                pass  # Nothing ran on the loop thread
+        stats.dump_stats(stem + ".prof")
+        hot = hottest_app_functions(stats)
+        out = io.StringIO()
+        out.write(f"{self.label}: {elapsed * 1000:.1f} ms wall\n\nHottest app functions (cumulative):\n")
+        for row in hot:
+            out.write(f"  {row['cumulative_ms']:>10.2f} ms cum {row['own_ms']:>10.2f} ms own {row['calls']:>8} calls  {row['function']}\n")
+        out.write(f"\nTop allocations still live at the end (tracemalloc, by line):\n")
+        for stat in snapshot.statistics('lineno')[:PROFILE_TOP_N]:
+            out.write(f"  {stat}\n")
+        out.write("\nAll functions (cumulative):\n")
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+        with open(stem + ".txt", 'w') as f:
+            f.write(out.getvalue())
+        return {"label": self.label, "when": time.strftime('%H:%M:%S'), "wall_ms": round(elapsed * 1000, 1),
+                "prof": stem + ".prof", "report": stem + ".txt", "hot": hot}
+
+def remember_profile(report: dict):
+    reports = st.session_state.setdefault('profile_reports', [])
+    reports.append(report)
+    del reports[:-5]  # Keep the last few for the sidebar
+
+def profile_capture_for(kind: str, loop=None):
+    """A ProfileCapture if this rerun/turn should be profiled (admin toggle first, then the env budget), else None."""
+    if threading.get_ident() in ProfileCapture._active:
+        return None
+    pending = st.session_state.get('profile_pending')
+    if pending and pending['kind'] == kind and pending['remaining'] > 0:
+        pending['remaining'] -= 1
+    elif not get_profile_budget().take(kind):
+        return None
+    return ProfileCapture(kind, loop=loop, on_report=remember_profile)
 
 # Login Page
 def login_page():
@@ -783,8 +2969,7 @@ def login_page():
             password = st.text_input("Password", type="password", key="login_pass")
             submitted = st.form_submit_button("Login")
             if submitted:
-                c.execute("SELECT password FROM users WHERE username=?", (username,))
-                result = c.fetchone()
+                result = DB.query_one("SELECT password FROM users WHERE username=?", (username,))
                 if result and verify_password(result[0], password):
                     st.session_state['logged_in'] = True
                     st.session_state['user'] = username
@@ -798,14 +2983,15 @@ def login_page():
             new_pass = st.text_input("New Password", type="password", key="reg_pass")
             reg_submitted = st.form_submit_button("Register")
             if reg_submitted:
-                c.execute("SELECT * FROM users WHERE username=?", (new_user,))
-                if c.fetchone():
+                if DB.query_one("SELECT 1 FROM users WHERE username=?", (new_user,)):
                     st.error("Username already exists.")
                 else:
                     hashed = hash_password(new_pass)
-                    c.execute("INSERT INTO users VALUES (?, ?)", (new_user, hashed))
-                    conn.commit()
-                    st.success("Registered! Please login.")
+                    # OR IGNORE + rowcount: a concurrent registration of the same name loses cleanly
+                    if DB.write(lambda cur: cur.execute("INSERT OR IGNORE INTO users VALUES (?, ?)", (new_user, hashed)).rowcount):
+                        st.success("Registered! Please login.")
+                    else:
+                        st.error("Username already exists.")
 
 # Chat Page
 def chat_page():
@@ -816,6 +3002,7 @@ def chat_page():
         model = st.selectbox("Select Model", ["grok-4-0709", "grok-3-mini", "grok-code-fast-1"], key="model_select")  # Extensible
         # Load Prompt Files Dynamically
         prompt_files = load_prompt_files()
+        selected_file = None  # Recorded with token usage (which prompts cost the most)
         if not prompt_files:
             st.warning("No prompt files found in ./prompts/. Add some .txt files!")
             custom_prompt = st.text_area("Edit System Prompt", value="You are Grok, a helpful AI.", height=100, key="prompt_editor")
@@ -842,17 +3029,78 @@ def chat_page():
         enable_tools = st.checkbox("Enable FS Tools (Sandboxed R/W Access)", value=False)
         if enable_tools:
             st.info("Tools enabled: AI can read/write/list files in ./sandbox/. Copy files there to access.")
+        use_cache = st.checkbox("Cache identical requests (replay locally)", value=RESPONSE_CACHE_ENABLED,
+                                help="Byte-identical requests are answered from a local cache. Turns that used stateful tools are never cached.")
+        stats = get_client_stats().snapshot()
+        st.caption(f"API connections: {stats['connections_opened']} opened, {stats['connections_reused']} reused ({stats['requests']} requests)")
+        if 'session_id' not in st.session_state:
+            st.session_state['session_id'] = uuid.uuid4().hex
+        METRICS.touch_session(st.session_state['session_id'])
+        set_log_context(session=st.session_state['session_id'], user=st.session_state['user'],
+                        convo_id=st.session_state.get('current_convo_id'))
+        with st.expander("Turn Latency (this session)"):
+            summary = session_latency_summary(st.session_state['session_id'])
+            if summary:
+                st.table(summary)
+                st.caption("Times in ms (iteration_tokens in tokens).")
+            else:
+                st.caption("No turns measured yet.")
+        with st.expander("Token Usage & Cost"):
+            by_model = model_cost_summary(st.session_state['user'])
+            if by_model:
+                st.caption("Cumulative cost by model")
+                st.table(by_model)
+                st.caption("Top conversations by tokens")
+                st.table(conversation_usage(st.session_state['user']))
+                st.caption("Cost in USD at MODEL_PRICES (per 1M prompt/completion tokens); unpriced models show none.")
+            else:
+                st.caption("No usage recorded yet.")
+        if st.session_state['user'] in GROKCODER_ADMINS:
+            with st.expander("Profiling (admin)"):
+                profile_kind = st.radio("Capture", ["turn", "rerun"], horizontal=True, key="profile_kind")
+                profile_count = st.number_input("Next N", min_value=1, max_value=20, value=1, key="profile_count")
+                if st.button("Start Profiling"):
+                    st.session_state['profile_pending'] = {"kind": profile_kind, "remaining": int(profile_count)}
+                pending = st.session_state.get('profile_pending')
+                if pending and pending['remaining']:
+                    st.caption(f"Capturing the next {pending['remaining']} {pending['kind']}(s) to {DIAGNOSTICS_DIR}.")
+                for report in reversed(st.session_state.get('profile_reports', [])[-3:]):
+                    st.caption(f"{report['label']} at {report['when']}: {report['wall_ms']} ms, {report['prof']}")
+                    st.table(report['hot'][:10])
         st.header("Chat History")
+        if MESSAGE_SEARCH:
+            message_term = st.text_input("Search Messages", key="message_search")
+            for convo_id, seq, title, snippet in search_messages(st.session_state['user'], message_term):
+                highlighted = html.escape(snippet).replace(SNIPPET_START, "<mark>").replace(SNIPPET_END, "</mark>")
+                col1, col2 = st.columns([3,1])
+                col1.markdown(f"<div class='search-hit'><b>{html.escape(title or '')}</b> #{seq + 1}<br>{highlighted}</div>",
+                              unsafe_allow_html=True)
+                col2.button("Open", key=f"hit_{convo_id}_{seq}", on_click=lambda cid=convo_id, seq=seq: load_history(cid, seq))
+            if message_term and not fts_query(message_term):
+                st.caption("Type a word to search message text.")
         search_term = st.text_input("Search History")
-        c.execute("SELECT convo_id, title FROM history WHERE user=?", (st.session_state['user'],))
-        histories = c.fetchall()
-        filtered_histories = [h for h in histories if search_term.lower() in h[1].lower()]
-        for convo_id, title in filtered_histories:
+        if st.session_state.get('history_search') != search_term:  # New filter: back to the newest page
+            st.session_state['history_search'] = search_term
+            st.session_state['history_cursors'] = []
+        cursors = st.session_state.setdefault('history_cursors', [])
+        page, next_cursor = list_conversations(st.session_state['user'], search_term, cursors[-1] if cursors else None)
+        for convo_id, title in page:
             col1, col2 = st.columns([3,1])
             col1.button(f"{title}", key=f"load_{convo_id}", on_click=lambda cid=convo_id: load_history(cid))
             col2.button("", key=f"delete_{convo_id}", on_click=lambda cid=convo_id: delete_history(cid))
+        if cursors or next_cursor:
+            col1, col2 = st.columns(2)
+            if cursors and col1.button("Newer", key="history_newer"):
+                cursors.pop()
+                st.rerun()
+            if next_cursor and col2.button("Load more", key="history_more"):
+                cursors.append(next_cursor)
+                st.rerun()
         if st.button("Clear Current Chat"):
             st.session_state['messages'] = []
+            st.session_state['current_convo_id'] = None  # The next turn starts a new conversation
+            st.session_state['saved_count'] = 0
+            st.session_state['focus_seq'] = None
             st.rerun()
         # Dark Mode Toggle with CSS Injection
         if st.button("Toggle Dark Mode"):
@@ -866,16 +3114,14 @@ def chat_page():
         st.session_state['messages'] = []
     if 'current_convo_id' not in st.session_state:
         st.session_state['current_convo_id'] = None  # None for new; set on save
-    # Truncate for performance
-    if len(st.session_state['messages']) > 50:
-        st.session_state['messages'] = st.session_state['messages'][-50:]
-        st.warning("Chat truncated to last 50 messages for performance.")
+    history_started = time.perf_counter()
     if st.session_state['messages']:
         chunk_size = 10  # Group every 10 messages
+        focus_seq = st.session_state.get('focus_seq')  # Opened from a search hit: expand and outline that message
         for i in range(0, len(st.session_state['messages']), chunk_size):
             chunk = st.session_state['messages'][i:i + chunk_size]
-            with st.expander(f"Messages {i+1}-{i+len(chunk)}"):
-                for msg in chunk:
+            with st.expander(f"Messages {i+1}-{i+len(chunk)}", expanded=focus_seq is not None and i <= focus_seq < i + chunk_size):
+                for seq, msg in enumerate(chunk, start=i):
                     avatar = None
                     with st.chat_message(msg['role'], avatar=avatar):
                         content = msg['content']
@@ -890,50 +3136,152 @@ def chat_page():
                             non_code = non_code.replace('<ei>', '<ei>').replace('</ei>', '</ei>')
                             escaped_non_code = html.escape(non_code)
                             role_class = "chat-bubble-user" if msg['role'] == 'user' else "chat-bubble-assistant"
+                            role_class += " search-focus" if seq == focus_seq else ""
                             st.markdown(f"<div class='{role_class}'><div class='wrapped-code'>{escaped_non_code}</div></div>", unsafe_allow_html=True)
                         else:
                             # Full content with custom unescape
                             content = content.replace('<ei>', '<ei>').replace('</ei>', '</ei>')
                             escaped_content = html.escape(content)
                             role_class = "chat-bubble-user" if msg['role'] == 'user' else "chat-bubble-assistant"
+                            role_class += " search-focus" if seq == focus_seq else ""
                             st.markdown(f"<div class='{role_class}'><div class='wrapped-code'>{escaped_content}</div></div>", unsafe_allow_html=True)
 
+    history_render = time.perf_counter() - history_started
     # Chat Input
     prompt = st.chat_input("Type your message here...")
     if prompt:
+        st.session_state['focus_seq'] = None
         st.session_state['messages'].append({"role": "user", "content": prompt})
         with st.chat_message("user", avatar=None):
             escaped_prompt = html.escape(prompt)
             st.markdown(f"<div class='chat-bubble-user'>{escaped_prompt}</div>", unsafe_allow_html=True)
         with st.chat_message("assistant", avatar=None):
-            response_container = st.empty()
-            generator = call_xai_api(model, st.session_state['messages'], custom_prompt, stream=True, image_files=uploaded_images if uploaded_images else None, enable_tools=enable_tools)
-            full_response = ""
-            for chunk in generator:
-                full_response += chunk
-                # Escape dynamically for streaming
-                escaped_full = html.escape(full_response).replace('<ei>', '<ei>').replace('</ei>', '</ei>')
-                response_container.markdown(f"<div class='chat-bubble-assistant'><div class='wrapped-code'>{escaped_full}</div></div>", unsafe_allow_html=True)
+            renderer = StreamRenderer(st.container())
+            turn = TurnState()
+            set_log_context(turn=turn.turn_id)
+            with profile_capture_for("turn", loop=get_async_bridge().loop) or contextlib.nullcontext():
+                generator = call_xai_api(model, st.session_state['messages'], custom_prompt, stream=True, image_files=uploaded_images if uploaded_images else None, enable_tools=enable_tools, use_cache=use_cache, turn=turn, on_idle=renderer.flush)
+                for chunk in generator:  # While it stalls (tools, retries), on_idle shows the pending tail
+                    renderer.feed(chunk)  # Escapes only the delta; UI refresh is throttled
+                full_response = renderer.finish()
+            turn_total = time.perf_counter() - turn.started
         st.session_state['messages'].append({"role": "assistant", "content": full_response})
         # Save to History (Auto-title from first user message)
         title = st.session_state['messages'][0]['content'][:50] + "..." if st.session_state['messages'] else "New Chat"
-        c.execute("INSERT INTO history (user, title, messages) VALUES (?, ?, ?)",
-                  (st.session_state['user'], title, json.dumps(st.session_state['messages'])))
-        conn.commit()
-        st.session_state['current_convo_id'] = c.lastrowid  # Set for new chats
+        commit_started = time.perf_counter()
+        try:  # Appends only this turn's messages (the whole transcript for a new conversation)
+            st.session_state['current_convo_id'] = save_turn_messages(st.session_state['user'], st.session_state['current_convo_id'],
+                                                                      st.session_state['messages'], st.session_state.get('saved_count', 0), title)
+            st.session_state['saved_count'] = len(st.session_state['messages'])
+        except sqlite3.OperationalError as e:
+            note_sqlite_error(e)
+            raise
+        db_commit = time.perf_counter() - commit_started
+        record_turn_metrics(st.session_state['user'], st.session_state['session_id'], st.session_state['current_convo_id'], turn.turn_id,
+                            turn_metric_rows(turn, turn_total, renderer.render_time, history_render, db_commit))
+        record_turn_usage(st.session_state['user'], st.session_state['session_id'], st.session_state['current_convo_id'], turn,
+                          selected_file)
+
+# NEW: History Storage (append-only: a turn writes only its new messages, in one transaction)
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))  # Conversations per sidebar page
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", "10"))  # Message search hits shown
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", "2000"))  # Newest matches ranked by bm25 (bounds common terms)
+SNIPPET_START, SNIPPET_END = "\x02", "\x03"  # Highlight markers (cannot occur in typed text; replaced after escaping)
+
+def save_turn_messages(user: str, convo_id, messages: list, saved_count: int, title: str) -> int:
+    """Append messages[saved_count:] to a conversation and return its convo_id. A new conversation (or one that was
+    deleted meanwhile) is created with the whole transcript. seq continues from the stored message_count."""
+    def append(cur, convo_id):
+        row = None
+        if convo_id is not None:
+            row = cur.execute("SELECT message_count FROM conversations WHERE convo_id=?", (convo_id,)).fetchone()
+        if row is None:
+            cur.execute("INSERT INTO conversations (user, title) VALUES (?, ?)", (user, title))
+            convo_id, start, new_messages = cur.lastrowid, 0, messages
+        else:
+            start, new_messages = row[0], messages[saved_count:]
+        cur.executemany("INSERT INTO messages (convo_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                        [(convo_id, start + i, msg['role'], msg['content']) for i, msg in enumerate(new_messages)])
+        cur.execute("UPDATE conversations SET message_count=?, updated=CURRENT_TIMESTAMP WHERE convo_id=?",
+                    (start + len(new_messages), convo_id))
+        return convo_id
+    return DB.write(append, convo_id)  # One transaction on the writer thread
+
+def escape_like(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def list_conversations(user: str, search: str = "", before: tuple = None, limit: int = HISTORY_PAGE_SIZE):
+    """One sidebar page of a user's conversations, most recently updated first, filtered by title in SQL.
+    `before` is the (updated, convo_id) keyset cursor of the previous page's last row, so each page is an index
+    range scan no matter how deep. Returns ([(convo_id, title)], cursor for the next page or None)."""
+    sql = "SELECT convo_id, title, updated FROM conversations WHERE user=?"
+    params = [user]
+    if search:
+        sql += " AND title LIKE ? ESCAPE '\\'"
+        params.append(f"%{escape_like(search)}%")
+    if before:
+        sql += " AND (updated, convo_id) < (?, ?)"
+        params.extend(before)
+    rows = DB.query(sql + " ORDER BY updated DESC, convo_id DESC LIMIT ?", params + [limit + 1])  # One extra row: is there more?
+    next_cursor = (rows[limit - 1][2], rows[limit - 1][0]) if len(rows) > limit else None
+    return [(convo_id, title) for convo_id, title, _ in rows[:limit]], next_cursor
+
+def fts_query(text: str) -> str:
+    """User input -> FTS5 query: every word quoted (no operator/syntax errors) and required; a trailing * keeps
+    prefix matching for that word only ("pars*"). An implicit prefix on every query would merge the doclists of all
+    words sharing it, which is several times slower for common words."""
+    return " ".join(f'"{term}"{star}' for term, star in re.findall(r"(\w+)(\*?)", text))
+
+def search_messages(user: str, text: str, limit: int = SEARCH_RESULTS) -> list:
+    """Full-text search of a user's messages, best bm25 match first. Only the newest SEARCH_RANK_WINDOW matches are
+    ranked (the index is read newest rowid first and stops there), so a word found in most messages costs the same as
+    a rare one. Snippets are built for the returned hits only. Returns [(convo_id, seq, title, snippet)], with
+    SNIPPET_START/SNIPPET_END around matched words."""
+    query = fts_query(text)
+    if not (MESSAGE_SEARCH and query):
+        return []
+    try:
+        hits = DB.query("""SELECT id, convo_id, seq, title FROM (
+            SELECT messages_fts.rowid AS id, m.convo_id, m.seq, cv.title, bm25(messages_fts) AS score
+            FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid JOIN conversations cv ON cv.convo_id = m.convo_id
+            WHERE messages_fts MATCH ? AND cv.user = ? ORDER BY messages_fts.rowid DESC LIMIT ?
+        ) ORDER BY score LIMIT ?""", (query, user, SEARCH_RANK_WINDOW, limit))
+        results = []
+        for message_id, convo_id, seq, title in hits:
+            snippet = DB.query_one("SELECT snippet(messages_fts, 0, ?, ?, '…', 16) FROM messages_fts WHERE messages_fts MATCH ? AND rowid=?",
+                                   (SNIPPET_START, SNIPPET_END, query, message_id))[0]
+            results.append((convo_id, seq, title, snippet))
+    except sqlite3.OperationalError as e:
+        note_sqlite_error(e)
+        log_db.warning("Message search failed for %r: %s", query, e)
+        return []
+    return results
+
+def load_conversation(convo_id: int) -> list:
+    rows = DB.query("SELECT role, content FROM messages WHERE convo_id=? ORDER BY seq", (convo_id,))
+    return [{"role": role, "content": content} for role, content in rows]
+
+def delete_conversation(convo_id: int):
+    def delete(cur):
+        cur.execute("DELETE FROM messages WHERE convo_id=?", (convo_id,))
+        cur.execute("DELETE FROM conversations WHERE convo_id=?", (convo_id,))
+    DB.write(delete)
 
 # Load History
-def load_history(convo_id):
-    c.execute("SELECT messages FROM history WHERE convo_id=?", (convo_id,))
-    messages = json.loads(c.fetchone()[0])
+def load_history(convo_id, focus_seq=None):
+    messages = load_conversation(convo_id)
     st.session_state['messages'] = messages
     st.session_state['current_convo_id'] = convo_id
+    st.session_state['saved_count'] = len(messages)
+    st.session_state['focus_seq'] = focus_seq  # Message to jump to (search hit), if any
     st.rerun()
 
 # Delete History
 def delete_history(convo_id):
-    c.execute("DELETE FROM history WHERE convo_id=?", (convo_id,))
-    conn.commit()
+    delete_conversation(convo_id)
+    if st.session_state.get('current_convo_id') == convo_id:
+        st.session_state['current_convo_id'] = None  # Still on screen; the next turn saves it as a new conversation
+        st.session_state['saved_count'] = 0
     st.rerun()
 
 # Main App with Init Time Check
@@ -943,9 +3291,10 @@ if __name__ == "__main__":
         st.session_state['theme'] = 'light'  # Default theme
     # Init Time Check (on app start)
     if 'init_time' not in st.session_state:
-        st.session_state['init_time'] = get_current_time(sync=True)  # Auto-sync on start
-        print(f"[LOG] Init Time: {st.session_state['init_time']}")
-    if not st.session_state['logged_in']:
-        login_page()
-    else:
-        chat_page()
+        st.session_state['init_time'] = get_current_time(sync=True)  # Auto-sync on start (host time while NTP is pending)
+        log_app.info("Init Time: %s", st.session_state['init_time'])
+    with profile_capture_for("rerun") or contextlib.nullcontext():
+        if not st.session_state['logged_in']:
+            login_page()
+        else:
+            chat_page()
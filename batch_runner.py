@@ -0,0 +1,154 @@
+###
+# batch_runner.py: Headless batch runner for GrokCoder (nightly code-generation / evaluation jobs, no Streamlit UI).
+# Each input line is a JSON record: {"id" optional, "model", "system_prompt_file", "messages", "enable_tools"}.
+# Records run through the same tool loop as the chat page (acall_xai_api in GrokCoder-v1.4.py) with bounded
+# concurrency and a global requests/sec limit. Results stream to an output JSONL file (one line per record,
+# with timing, token usage and estimated cost). Re-running with the same output file skips records that already finished
+# with status "ok" (resume); failed records run again and append a new line, so the last line per id is current.
+# Usage: python batch_runner.py prompts.jsonl results.jsonl [--concurrency 4] [--rps 2] [--app GrokCoder-v1.4.py]
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+import time
+
+DEFAULT_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "GrokCoder-v1.4.py")
+
+def load_app(app_path: str = DEFAULT_APP):
+    """Import the app script by path (its file name is not a valid module name). Streamlit runs in bare mode.
+    Also used by the benchmarks and tests (benchmarks/common.py), which first move into a scratch dir."""
+    from streamlit import config, logger
+    config.set_option("global.showWarningOnDirectExecution", False)
+    logger.set_log_level("ERROR")  # Silence bare-mode "missing ScriptRunContext" noise
+    spec = importlib.util.spec_from_file_location("grokcoder_app", os.path.abspath(app_path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["grokcoder_app"] = module
+    spec.loader.exec_module(module)
+    return module
+
+class RateLimiter:
+    """Global token bucket shared by all records: at most `rate` API requests per second (bursts up to `burst`)."""
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def read_records(path: str):
+    """Yield (record_id, record) for each non-empty line; records without an id are keyed by line number."""
+    with open(path, 'r') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield str(record.get("id", f"line-{line_no}")), record
+
+def completed_ids(path: str) -> set:
+    """Ids with an "ok" result in the output file; errors are retried (a truncated last line from a crash is ignored)."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                if result.get("status") == "ok":
+                    done.add(str(result["id"]))
+            except (ValueError, KeyError, AttributeError):
+                continue
+    return done
+
+def ends_mid_line(path: str) -> bool:
+    """True if the file's last line has no newline (a crash mid-write); appending would glue the next result to it."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return False
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) != b"\n"
+
+def load_system_prompt(app, record: dict) -> str:
+    prompt_file = record.get("system_prompt_file")
+    if not prompt_file:
+        return record.get("system_prompt", "You are Grok, a highly intelligent, helpful AI assistant.")
+    path = prompt_file if os.path.exists(prompt_file) else os.path.join(app.PROMPTS_DIR, prompt_file)
+    with open(path, 'r') as f:
+        return f.read()
+
+async def run_record(app, record_id: str, record: dict, args, limiter: RateLimiter, slots: asyncio.Semaphore) -> dict:
+    async with slots:
+        started = time.perf_counter()
+        turn = app.TurnState()
+        result = {"id": record_id, "model": record.get("model", args.model)}
+        try:
+            messages = record["messages"]
+            if isinstance(messages, str):
+                messages = [{"role": "user", "content": messages}]
+            ctx = app.ToolContext(user=record.get("user", args.user), convo_id=record.get("convo_id", 0))
+            pieces = []
+            async for piece in app.acall_xai_api(result["model"], messages, load_system_prompt(app, record),
+                                                 enable_tools=bool(record.get("enable_tools", False)),
+                                                 tool_ctx=ctx, turn=turn, limiter=limiter):
+                pieces.append(piece)
+            result.update(status="error" if turn.error else "ok", error=turn.error, response=app.join_stream(pieces))
+        except Exception as e:
+            result.update(status="error", error=f"{type(e).__name__}: {e}", response=None)
+        result.update(elapsed_s=round(time.perf_counter() - started, 3),
+                      ttft_s=round(turn.ttft, 3) if turn.ttft is not None else None,
+                      iterations=turn.iterations, usage=turn.usage, cost_usd=round(app.turn_cost(turn), 6))
+        return result
+
+async def run_batch(app, args) -> dict:
+    done = completed_ids(args.output)
+    pending = [(rid, rec) for rid, rec in read_records(args.input) if rid not in done]
+    print(f"[LOG] {len(pending)} records to run ({len(done)} already done in {args.output})")
+    limiter = RateLimiter(args.rps, burst=args.concurrency)
+    slots = asyncio.Semaphore(args.concurrency)
+    totals = {"ok": 0, "error": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+    partial = ends_mid_line(args.output)
+    with open(args.output, 'a') as out:
+        if partial:
+            out.write("\n")  # Finish the truncated line; completed_ids() skips it
+        tasks = [asyncio.create_task(run_record(app, rid, rec, args, limiter, slots)) for rid, rec in pending]
+        for task in asyncio.as_completed(tasks):
+            result = await task
+            out.write(json.dumps(result) + "\n")
+            out.flush()  # Each finished record is durable, so an interrupted run can resume
+            totals[result["status"]] += 1
+            totals["prompt_tokens"] += result["usage"]["prompt_tokens"]
+            totals["completion_tokens"] += result["usage"]["completion_tokens"]
+            totals["cost_usd"] += result["cost_usd"]
+            print(f"[LOG] {result['id']}: {result['status']} in {result['elapsed_s']}s")
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser(description="Run JSONL prompt records through the GrokCoder tool loop.")
+    parser.add_argument("input", help="Input JSONL file of records")
+    parser.add_argument("output", help="Output JSONL file (appended; ids already ok are skipped)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Records in flight at once")
+    parser.add_argument("--rps", type=float, default=2.0, help="Global API requests per second (0 = unlimited)")
+    parser.add_argument("--model", default="grok-4-0709", help="Model for records that do not set one")
+    parser.add_argument("--user", default="batch", help="Memory namespace for tool calls")
+    parser.add_argument("--app", default=DEFAULT_APP, help="App script providing the tool loop")
+    args = parser.parse_args()
+    app = load_app(args.app)
+    totals = asyncio.run(run_batch(app, args))
+    print(json.dumps(totals))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+###
+# bench_async_conversations.py: Concurrent conversations, thread-per-chat (sync client) vs. one event loop (async core).
+# The API is simulated in-process with httpx.MockTransport: each reply streams --chunks SSE chunks, --delay s apart.
+# Usage: python benchmarks/bench_async_conversations.py [--conversations 50 200] [--chunks 40] [--delay 0.02]
+import argparse
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+from common import DEFAULT_APP, load_app
+
+def sse_chunk(text: str) -> bytes:
+    payload = {"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": "bench",
+               "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]}
+    return f"data: {json.dumps(payload)}\n\n".encode()
+
+def sync_handler(chunks: int, delay: float):
+    def handler(request):
+        def body():
+            for i in range(chunks):
+                time.sleep(delay)
+                yield sse_chunk(f"tok{i} ")
+            yield b"data: [DONE]\n\n"
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body())
+    return handler
+
+def async_handler(chunks: int, delay: float):
+    async def handler(request):
+        async def body():
+            for i in range(chunks):
+                await asyncio.sleep(delay)
+                yield sse_chunk(f"tok{i} ")
+            yield b"data: [DONE]\n\n"
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body())
+    return handler
+
+def run_sync(n: int, chunks: int, delay: float) -> dict:
+    """Pre-async model: one thread per active chat consuming a sync stream."""
+    client = OpenAI(api_key="bench", base_url="http://bench.local/v1", max_retries=0,
+                    http_client=httpx.Client(transport=httpx.MockTransport(sync_handler(chunks, delay))))
+    def conversation(i):
+        stream = client.chat.completions.create(model="bench", messages=[{"role": "user", "content": f"hi {i}"}], stream=True)
+        return "".join(chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices)
+    peak_threads = 0
+    def sample():
+        nonlocal peak_threads
+        peak_threads = max(peak_threads, threading.active_count())
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        futures = [pool.submit(conversation, i) for i in range(n)]
+        while not all(f.done() for f in futures):
+            sample()
+            time.sleep(0.01)
+        replies = [f.result() for f in futures]
+    return summarize(n, replies, time.process_time() - cpu0, time.perf_counter() - wall0, peak_threads)
+
+def run_async(app, n: int, chunks: int, delay: float) -> dict:
+    """Async core: every conversation is a task on one event loop (full acall_xai_api path, tools off)."""
+    async def main():
+        client = AsyncOpenAI(api_key="bench", base_url="http://bench.local/v1", max_retries=0,
+                             http_client=httpx.AsyncClient(transport=httpx.MockTransport(async_handler(chunks, delay))))
+        async def conversation(i):
+            return "".join([piece async for piece in app.acall_xai_api("bench", [{"role": "user", "content": f"hi {i}"}], "sys", client=client)])
+        return await asyncio.gather(*(conversation(i) for i in range(n)))
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    replies = asyncio.run(main())
+    return summarize(n, replies, time.process_time() - cpu0, time.perf_counter() - wall0, threading.active_count())
+
+def summarize(n, replies, cpu, wall, threads) -> dict:
+    assert all(reply.startswith("tok0 ") for reply in replies), "incomplete replies"
+    return {"conversations": n, "wall_s": round(wall, 3), "cpu_s": round(cpu, 3),
+            "cpu_ms_per_conversation": round(cpu * 1000 / n, 2),
+            "conversations_per_core_second": round(n / cpu, 1) if cpu else None,
+            "peak_threads": threads}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--conversations", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--chunks", type=int, default=40, help="SSE chunks per reply")
+    parser.add_argument("--delay", type=float, default=0.02, help="Seconds between chunks (simulated generation)")
+    parser.add_argument("--app", default=DEFAULT_APP)
+    args = parser.parse_args()
+    app = load_app(args.app)
+    results = []
+    for n in args.conversations:
+        results.append({"mode": "sync-threads", **run_sync(n, args.chunks, args.delay)})
+        results.append({"mode": "async-core", **run_async(app, n, args.chunks, args.delay)})
+    print(json.dumps({"chunks": args.chunks, "delay": args.delay, "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
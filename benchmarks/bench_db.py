@@ -0,0 +1,181 @@
+###
+# bench_db.py: chatapp.db write throughput and "database is locked" rates under concurrency (offline, no API key).
+# N threads each run a memory_insert/memory_query mix (INSERT OR REPLACE into memory, point reads back) through:
+#   shared       one connection for all threads (check_same_thread=False), commit per write: the app before the manager
+#   per_thread   a connection per thread, commit per write, no busy timeout: writers collide on the WAL write lock
+#   per_thread_busy  the same with busy_timeout=DB_BUSY_TIMEOUT_MS: no errors, but every writer waits its turn
+#   manager      the app's DatabaseManager: per-thread readers, one writer thread that group-commits queued writes
+# A second workload drives the memory tools like checkpointing turns (bursts of memory_insert, then a recent-entries
+# memory_query) under each MEMORY_DURABILITY: commit waits for every insert's commit, buffered group-commits them.
+# Usage: python benchmarks/bench_db.py [--threads 1 4 16] [--ops 500] [--read-ratio 0.2] [--modes manager shared]
+import argparse
+import json
+import random
+import sqlite3
+import statistics
+import threading
+import time
+
+from common import DEFAULT_APP, load_app
+
+MODES = ["shared", "per_thread", "per_thread_busy", "manager"]
+INSERT = "INSERT OR REPLACE INTO memory (user, convo_id, mem_key, mem_value) VALUES (?, ?, ?, ?)"
+SELECT = "SELECT mem_value FROM memory WHERE user=? AND convo_id=? AND mem_key=?"
+
+class Direct:
+    """Commit-per-write access with plain sqlite3 connections (one shared, or one per thread)."""
+    def __init__(self, path: str, shared: bool, busy_timeout_ms: int):
+        self.path, self.busy_timeout_ms = path, busy_timeout_ms
+        self.shared = self._connect() if shared else None
+        self.local = threading.local()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, check_same_thread=False)
+        db.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        return db
+
+    def connection(self):
+        if self.shared:
+            return self.shared
+        if not hasattr(self.local, "db"):
+            self.local.db = self._connect()
+        return self.local.db
+
+    def write(self, params):
+        db = self.connection()
+        cur = db.cursor()
+        cur.execute(INSERT, params)
+        db.commit()
+
+    def read(self, params):
+        return self.connection().cursor().execute(SELECT, params).fetchone()
+
+class Managed:
+    def __init__(self, manager):
+        self.manager = manager
+
+    def write(self, params):
+        self.manager.execute(INSERT, params)
+
+    def read(self, params):
+        return self.manager.query_one(SELECT, params)
+
+def classify(error: Exception) -> str:
+    message = str(error).lower()
+    if isinstance(error, sqlite3.OperationalError):
+        return "locked" if "locked" in message else "busy" if "busy" in message else "operational"
+    return type(error).__name__
+
+def run_mode(access, threads: int, ops: int, read_ratio: float) -> dict:
+    latencies, errors, lock = {"write": [], "read": []}, {}, threading.Lock()
+    barrier = threading.Barrier(threads)
+
+    def worker(n: int):
+        rng = random.Random(n)
+        own = {"write": [], "read": []}
+        barrier.wait()
+        for i in range(ops):
+            kind = "read" if i and rng.random() < read_ratio else "write"
+            params = (f"bench{n}", 1, f"key{rng.randrange(max(i, 1))}" if kind == "read" else f"key{i}")
+            if kind == "write":
+                params += (json.dumps({"step": i, "note": "checkpoint"}),)
+            started = time.perf_counter()
+            try:
+                access.write(params) if kind == "write" else access.read(params)
+                own[kind].append(time.perf_counter() - started)
+            except Exception as e:
+                with lock:
+                    errors[f"{kind}: {classify(e)}"] = errors.get(f"{kind}: {classify(e)}", 0) + 1
+        with lock:
+            for kind in own:
+                latencies[kind].extend(own[kind])
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    writes = len(latencies["write"])
+    failed_writes = sum(count for name, count in errors.items() if name.startswith("write"))
+    report = {"elapsed_s": round(elapsed, 3), "writes_per_s": round(writes / elapsed, 1),
+              "failed_write_rate": round(failed_writes / max(writes + failed_writes, 1), 4), "errors": errors}
+    for kind, samples in latencies.items():
+        if samples:
+            ordered = sorted(samples)
+            report[f"{kind}_p50_ms"] = round(statistics.median(ordered) * 1000, 3)
+            report[f"{kind}_p95_ms"] = round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3)
+    return report
+
+def run_memory_turns(app, durability: str, threads: int, turns: int, burst: int) -> dict:
+    """Each thread is a session whose turns issue `burst` memory_insert calls and one memory_query of recent entries."""
+    app.MEMORY_DURABILITY = durability
+    inserts, queries, lock = [], [], threading.Lock()
+    barrier = threading.Barrier(threads)
+    before = app.DB.stats()["batches"]
+
+    def session(n: int):
+        own_inserts, own_queries = [], []
+        barrier.wait()
+        for turn in range(turns):
+            for step in range(burst):
+                started = time.perf_counter()
+                app.memory_insert(f"bench{n}", turn, f"checkpoint{step}", {"turn": turn, "step": step}, cache={})
+                own_inserts.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            app.memory_query(f"bench{n}", turn, None, 5, cache={})
+            own_queries.append(time.perf_counter() - started)
+        with lock:
+            inserts.extend(own_inserts)
+            queries.extend(own_queries)
+
+    workers = [threading.Thread(target=session, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    ordered = sorted(inserts)
+    return {"inserts_per_s": round(len(inserts) / elapsed, 1),
+            "insert_p50_ms": round(statistics.median(ordered) * 1000, 3),
+            "insert_p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+            "query_recent_p50_ms": round(statistics.median(queries) * 1000, 3),
+            "commits": app.DB.stats()["batches"] - before}
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite write throughput and lock errors under concurrency.")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16], help="Concurrent threads")
+    parser.add_argument("--ops", type=int, default=500, help="Operations per thread")
+    parser.add_argument("--read-ratio", type=float, default=0.2, help="Share of operations that are point reads")
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--turns", type=int, default=20, help="Memory workload: turns per session")
+    parser.add_argument("--burst", type=int, default=10, help="Memory workload: memory_insert calls per turn")
+    parser.add_argument("--app", default=DEFAULT_APP, help="App script to load (schema, PRAGMAs and manager)")
+    args = parser.parse_args()
+    app = load_app(args.app)  # Scratch dir; creates chatapp.db with the app's schema
+    if "manager" in args.modes and not hasattr(app, "DB"):
+        raise SystemExit("This app version has no connection manager; pick other --modes.")
+    report = {"ops_per_thread": args.ops, "read_ratio": args.read_ratio, "modes": {}}
+    for mode in args.modes:
+        report["modes"][mode] = {}
+        for threads in args.threads:
+            with sqlite3.connect(app.DB_PATH if hasattr(app, "DB_PATH") else "chatapp.db") as db:
+                db.execute("DELETE FROM memory WHERE user LIKE 'bench%'")
+            if mode == "manager":
+                access = Managed(app.DB)
+            else:
+                access = Direct("chatapp.db", shared=mode == "shared",
+                                busy_timeout_ms=getattr(app, "DB_BUSY_TIMEOUT_MS", 5000) if mode == "per_thread_busy" else 0)
+            report["modes"][mode][str(threads)] = run_mode(access, threads, args.ops, args.read_ratio)
+    if hasattr(app, "DB"):
+        report["manager_stats"] = app.DB.stats()  # writes/batches > 1 means writes were group-committed
+    if hasattr(app, "MEMORY_BUFFER"):
+        report["memory_turns"] = {durability: {str(threads): run_memory_turns(app, durability, threads, args.turns, args.burst)
+                                               for threads in args.threads}
+                                  for durability in ("commit", "buffered")}
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
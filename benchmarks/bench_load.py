@@ -0,0 +1,236 @@
+###
+# bench_load.py: Multi-session load test against the shared chatapp.db (offline; in-process mock xAI API).
+# Each simulated user gets its own script run of the app (loaded like a Streamlit rerun, so st.cache_resource objects
+# such as the DB connection, tool executor and async bridge are shared), then logs in, chats through the tool loop
+# (memory_insert/memory_query calls injected by the mock), saves and lists history like chat_page, and loads a conversation.
+# Every concurrency level runs in a fresh interpreter and scratch dir. Reports throughput, latency percentiles,
+# SQLite busy/locked errors and memory per session as the number of users grows.
+# Usage: python benchmarks/bench_load.py [--users 1 2 4 8 16] [--turns 5] [--think 0.2] [--output load.json]
+import argparse
+import collections
+import contextlib
+import json
+import os
+import random
+import resource
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from common import DEFAULT_APP, REPO_ROOT, load_app
+
+sys.path.insert(0, REPO_ROOT)
+from mock_xai_server import MockConfig, start_server  # noqa: E402
+
+PASSWORD = "load-test"
+SYS_PROMPT = "You are Grok, a highly intelligent, helpful AI assistant."
+TOOL_CALLS = [{"name": "memory_insert", "arguments": {"mem_key": "checkpoint", "mem_value": {"note": "load test step"}}},
+              {"name": "memory_query", "arguments": {"mem_key": "checkpoint"}}]
+
+def rss_mb() -> float:
+    """Current resident set size (Linux /proc), else peak RSS."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def percentiles(samples: list) -> dict:
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000, 2)
+    return {"n": len(ordered), "p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": round(ordered[-1] * 1000, 2)}
+
+class LoadStats:
+    """Latency samples per operation and error counts, shared by the session threads."""
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.samples[name].append(seconds)
+
+    def error(self, kind: str):
+        with self._lock:
+            self.errors[kind] += 1
+
+    @contextlib.contextmanager
+    def op(self, name: str):
+        """Time one operation; failures are counted by kind instead of aborting the session."""
+        start = time.perf_counter()
+        try:
+            yield
+        except sqlite3.OperationalError as e:
+            message = str(e).lower()
+            self.error(f"{name}: sqlite_{'locked' if 'locked' in message else 'busy' if 'busy' in message else 'operational'}")
+        except sqlite3.Error as e:
+            self.error(f"{name}: {type(e).__name__}")
+        except Exception as e:
+            self.error(f"{name}: {type(e).__name__}")
+        else:
+            self.add(name, time.perf_counter() - start)
+
+def app_query(app, sql: str, params=()) -> list:
+    """A read the way the app version does it: its connection manager, or (older versions) the shared cursor `c`."""
+    if hasattr(app, "DB"):
+        return app.DB.query(sql, params)
+    app.c.execute(sql, params)
+    return app.c.fetchall()
+
+def history_table(app) -> str:
+    return "conversations" if hasattr(app, "save_turn_messages") else "history"
+
+def save_history(app, user: str, convo_id, messages: list):
+    """chat_page's save step: append this turn's two messages, or (older versions) a new full-JSON row per turn."""
+    title = messages[0]['content'][:50] + "..."
+    if hasattr(app, "save_turn_messages"):
+        return app.save_turn_messages(user, convo_id, messages, len(messages) - 2 if convo_id else 0, title)
+    app.c.execute("INSERT INTO history (user, title, messages) VALUES (?, ?, ?)", (user, title, json.dumps(messages)))
+    app.conn.commit()
+    return app.c.lastrowid
+
+def simulate_session(app, user: str, args, stats: LoadStats, barrier: threading.Barrier):
+    """One user, mirroring what login_page/chat_page do per interaction."""
+    rng = random.Random(user)
+    bridge = app.get_async_bridge()
+    session_id = uuid.uuid4().hex
+    barrier.wait()
+    with stats.op("login"):
+        result = app_query(app, "SELECT password FROM users WHERE username=?", (user,))
+        if not (result and app.verify_password(result[0][0], PASSWORD)):
+            raise RuntimeError("login failed")
+    messages = []
+    ctx = app.ToolContext(user=user, convo_id=0)
+    convo_id = None
+    for n in range(args.turns):
+        messages.append({"role": "user", "content": f"Turn {n}: refactor the parser and keep a checkpoint in memory."})
+        turn = app.TurnState()
+        pieces = []
+        with stats.op("turn"):
+            pieces.extend(bridge.iterate(app.acall_xai_api(args.model, messages, SYS_PROMPT, enable_tools=args.tools,
+                                                           tool_ctx=ctx, turn=turn)))
+        if turn.error:
+            stats.error("turn: api")
+        if turn.ttft is not None:
+            stats.add("ttft", turn.ttft)
+        for func_name, seconds in turn.tool_timings:
+            stats.add(f"tool: {func_name}", seconds)
+        messages.append({"role": "assistant", "content": app.join_stream(pieces) if hasattr(app, "join_stream") else "".join(pieces)})
+        with stats.op("history_save"):
+            convo_id = ctx.convo_id = save_history(app, user, convo_id, messages)
+        with stats.op("turn_records"):
+            if hasattr(app, "record_turn_metrics"):
+                app.record_turn_metrics(user, session_id, convo_id, turn.turn_id, app.turn_metric_rows(turn))
+            if hasattr(app, "record_turn_usage"):
+                app.record_turn_usage(user, session_id, convo_id, turn)
+        with stats.op("history_list"):  # The sidebar query every rerun runs
+            app_query(app, f"SELECT convo_id, title FROM {history_table(app)} WHERE user=?", (user,))
+        time.sleep(rng.uniform(0, 2 * args.think))
+    if convo_id is not None:
+        with stats.op("history_load"):
+            if hasattr(app, "load_conversation"):
+                app.load_conversation(convo_id)
+            else:
+                json.loads(app_query(app, "SELECT messages FROM history WHERE convo_id=?", (convo_id,))[0][0])
+
+def run_level(args, users: int) -> dict:
+    """Run `users` concurrent sessions in this process (called in a fresh interpreter per level)."""
+    config = MockConfig(tps=args.tps, ttft=args.ttft, reply_tokens=args.reply_tokens,
+                        tool_calls=TOOL_CALLS if args.tools else None, seed=1)
+    server, base_url = start_server(config)
+    os.environ["XAI_BASE_URL"] = base_url
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    workdir = tempfile.mkdtemp(prefix="grokcoder-load-")
+    load_app(args.app, workdir)  # Warm-up run: library imports and cached resources are not per-session memory
+    rss_start = rss_mb()
+    sessions = [load_app(args.app, workdir) for _ in range(users)]  # One script run per session, shared cached resources
+    rss_loaded = rss_mb()
+    hashed = sessions[0].hash_password(PASSWORD)
+    with contextlib.closing(sqlite3.connect("chatapp.db")) as db, db:  # Seeded outside the app (works for every version)
+        db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?)", [(f"user{i}", hashed) for i in range(users)])
+    stats = LoadStats()
+    barrier = threading.Barrier(users)
+    threads = [threading.Thread(target=simulate_session, args=(app, f"user{i}", args, stats, barrier), daemon=True)
+               for i, app in enumerate(sessions)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    rss_end = rss_mb()
+    server.shutdown()
+    app_errors = {}
+    for (name, labels), value in sessions[0].METRICS.snapshot().items():
+        if name == "grokcoder_sqlite_errors" or (name == "grokcoder_tool_invocations" and ("outcome", "ok") not in labels):
+            app_errors[f"{name}{dict(labels)}"] = value
+    turns = len(stats.samples["turn"])
+    return {
+        "users": users,
+        "elapsed_s": round(elapsed, 3),
+        "turns_completed": turns,
+        "throughput_turns_per_s": round(turns / elapsed, 3),
+        "latency": {name: percentiles(samples) for name, samples in sorted(stats.samples.items())},
+        "errors": dict(stats.errors),
+        "app_errors": app_errors,  # Swallowed inside the app (tools report errors as text), from its metrics registry
+        "memory_mb": {"rss_start": round(rss_start, 1), "rss_end": round(rss_end, 1),
+                      "per_session_script_run": round((rss_loaded - rss_start) / users, 2),
+                      "per_session_total": round((rss_end - rss_start) / users, 2)},
+        "mock_api": dict(config.stats),
+    }
+
+def run_worker(args, users: int) -> dict:
+    """One level in a fresh interpreter. A hard crash (e.g. SIGSEGV from concurrent use of one sqlite3 cursor)
+    is reported with the crashing thread's frames from faulthandler instead of aborting the whole run."""
+    command = [sys.executable, "-X", "faulthandler", os.path.abspath(__file__), "--worker", str(users),
+               "--app", os.path.abspath(args.app), "--turns", str(args.turns), "--think", str(args.think),
+               "--tps", str(args.tps), "--ttft", str(args.ttft), "--reply-tokens", str(args.reply_tokens), "--model", args.model]
+    result = subprocess.run(command + ([] if args.tools else ["--no-tools"]), capture_output=True, text=True)
+    if result.returncode == 0:
+        return json.loads(result.stdout.strip().splitlines()[-1])
+    lines = result.stderr.strip().splitlines()
+    if result.returncode < 0:
+        current = next((i for i, line in enumerate(lines) if line.startswith("Current thread")), len(lines))
+        return {"users": users, "crashed": signal.Signals(-result.returncode).name,
+                "crash_frames": [line.strip() for line in lines[current + 1:current + 4]]}
+    raise SystemExit("\n".join(lines[-20:]) or f"worker for {users} users failed")
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test on the shared SQLite database.")
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="Concurrency levels")
+    parser.add_argument("--turns", type=int, default=5, help="Chat turns per session")
+    parser.add_argument("--think", type=float, default=0.2, help="Mean think time between turns (seconds)")
+    parser.add_argument("--tps", type=float, default=200.0, help="Mock API tokens per second")
+    parser.add_argument("--ttft", type=float, default=0.05, help="Mock API time to first token")
+    parser.add_argument("--reply-tokens", type=int, default=60)
+    parser.add_argument("--model", default="grok-4-0709")
+    parser.add_argument("--no-tools", dest="tools", action="store_false", help="Plain chat (no memory tool calls)")
+    parser.add_argument("--app", default=DEFAULT_APP, help="App script to load")
+    parser.add_argument("--output", help="Also write the JSON report here")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)  # Internal: run one level in this process
+    args = parser.parse_args()
+    if args.worker:
+        print(json.dumps(run_level(args, args.worker)))
+        return
+    report = {"turns": args.turns, "think_s": args.think, "tools": args.tools, "levels": []}
+    for users in args.users:
+        level = run_worker(args, users)
+        report["levels"].append(level)
+        if "crashed" in level:
+            print(f"[LOG] {users} users: worker crashed ({level['crashed']}) in {level['crash_frames'][:1]}", file=sys.stderr)
+            continue
+        print(f"[LOG] {users} users: {level['throughput_turns_per_s']} turns/s, "
+              f"turn p95 {level['latency'].get('turn', {}).get('p95_ms')} ms, errors {sum(level['errors'].values())}", file=sys.stderr)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
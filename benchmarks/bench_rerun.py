@@ -0,0 +1,90 @@
+###
+# bench_rerun.py: Per-interaction rerun latency of the app script (Streamlit AppTest, no browser, no API key).
+# Every widget interaction re-executes the whole script, so module-level setup (schema, directories, prompt seeding,
+# tool schema, CSS) is paid on each one. Compares app versions, e.g. the working tree against a git ref.
+# AppTest builds a new ScriptCache on every run, i.e. re-reads, magic-rewrites and compiles the whole script each time,
+# which the real server does once per file change. One ScriptCache is shared across runs here (like the server), so the
+# timings are the script's own per-interaction work; --recompile restores AppTest's default for comparison.
+# Usage: python benchmarks/bench_rerun.py [--reruns 30] [--ref HEAD~1] [--apps GrokCoder-v1.4.py ...]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from common import DEFAULT_APP, REPO_ROOT
+
+RERUN_SNIPPET = """
+import json, os, tempfile, time
+os.chdir(tempfile.mkdtemp(prefix="grokcoder-rerun-"))
+os.environ.setdefault("XAI_API_KEY", "bench-offline")
+os.environ.setdefault("LOG_CONSOLE_LEVEL", "WARNING")
+from streamlit.testing.v1 import AppTest, app_test, local_script_runner
+
+if not {recompile!r}:
+    shared_cache = app_test.ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: shared_cache  # Compiled once, as by the server
+
+def timed_run(at):
+    start = time.perf_counter()
+    at.run()
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    return time.perf_counter() - start
+
+at = AppTest.from_file({app!r}, default_timeout=120)
+first = timed_run(at)
+login = [timed_run(at) for _ in range({reruns})]
+at.session_state["logged_in"] = True
+at.session_state["user"] = "bench"
+at.run()
+chat = [timed_run(at) for _ in range({reruns})]
+print(json.dumps({{"first": first, "login": login, "chat": chat}}))
+"""
+
+def summarize(samples: list) -> dict:
+    ordered = sorted(samples)
+    return {"median_ms": round(statistics.median(ordered) * 1000, 2),
+            "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2),
+            "min_ms": round(ordered[0] * 1000, 2)}
+
+def app_from_ref(ref: str, path: str = DEFAULT_APP) -> str:
+    """Write the app script as of a git ref to a temp file (so two versions can be compared side by side)."""
+    source = subprocess.run(["git", "show", f"{ref}:{os.path.relpath(path, REPO_ROOT)}"], cwd=REPO_ROOT,
+                            capture_output=True, text=True, check=True).stdout
+    target = os.path.join(tempfile.mkdtemp(prefix="grokcoder-ref-"), f"{ref.replace('/', '_')}-{os.path.basename(path)}")
+    with open(target, 'w') as f:
+        f.write(source)
+    return target
+
+def measure(app: str, reruns: int, recompile: bool = False) -> dict:
+    """Fresh interpreter per app, so process-wide caches start cold for each one."""
+    result = subprocess.run([sys.executable, "-c", RERUN_SNIPPET.format(app=os.path.abspath(app), reruns=reruns,
+                                                                         recompile=recompile)],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed")
+    runs = json.loads(result.stdout.strip().splitlines()[-1])
+    return {"first_run_ms": round(runs["first"] * 1000, 2), "login_rerun": summarize(runs["login"]),
+            "chat_rerun": summarize(runs["chat"])}
+
+def main():
+    parser = argparse.ArgumentParser(description="Rerun latency of the Streamlit app script.")
+    parser.add_argument("--reruns", type=int, default=30, help="Timed reruns per page")
+    parser.add_argument("--apps", nargs="+", default=[DEFAULT_APP], help="App scripts to measure")
+    parser.add_argument("--ref", action="append", default=[], help="Also measure the default app as of this git ref")
+    parser.add_argument("--recompile", action="store_true",
+                        help="Compile the script on every run (AppTest's default; not what the server does)")
+    args = parser.parse_args()
+    apps = {os.path.basename(app): app for app in args.apps}
+    for ref in args.ref:
+        apps[f"{os.path.basename(DEFAULT_APP)}@{ref}"] = app_from_ref(ref)
+    report = {"reruns": args.reruns, "recompile": args.recompile, "apps": {}}
+    for name, app in apps.items():
+        report["apps"][name] = measure(app, args.reruns, args.recompile)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+###
+# bench_search.py: Message full-text search latency (FTS5) on a synthetic chatapp.db (offline, no API key).
+# Fills conversations/messages through the app's own schema (so the FTS triggers index every insert) with Zipf-distributed
+# words, then times search_messages for terms from "in nearly every message" down to rare ones, plus multi-word and
+# prefix queries. --windows compares rank-window sizes (a huge window ranks every match, i.e. no bound).
+# Usage: python benchmarks/bench_search.py [--messages 100000] [--users 4] [--repeat 20] [--windows 2000 100000000]
+import argparse
+import contextlib
+import json
+import os
+import random
+import sqlite3
+import statistics
+import time
+
+from common import DEFAULT_APP, load_app
+
+def make_vocabulary(size: int, rng: random.Random) -> list:
+    """Pronounceable pseudo-words, so the default unicode61 tokenizer splits them like prose."""
+    consonants, vowels = "bcdfghklmnprstvz", "aeiou"
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(consonants) + rng.choice(vowels) for _ in range(rng.randint(2, 4))))
+    return sorted(words, key=lambda word: (len(word), word))
+
+def populate(app, messages: int, users: int, words_per_message: int, vocabulary: list, rng: random.Random) -> float:
+    """Insert `messages` messages in 40-message conversations (round-robin users); returns seconds spent."""
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    started = time.perf_counter()
+    per_convo = 40
+    with contextlib.closing(sqlite3.connect("chatapp.db")) as db, db:
+        for first in range(0, messages, per_convo):
+            convo_id = db.execute("INSERT INTO conversations (user, title, message_count) VALUES (?, ?, ?)",
+                                  (f"user{(first // per_convo) % users}", f"Conversation {first // per_convo}", per_convo)).lastrowid
+            count = min(per_convo, messages - first)
+            text = rng.choices(vocabulary, weights, k=count * words_per_message)
+            db.executemany("INSERT INTO messages (convo_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                           [(convo_id, seq, "user" if seq % 2 == 0 else "assistant",
+                             " ".join(text[seq * words_per_message:(seq + 1) * words_per_message])) for seq in range(count)])
+    return time.perf_counter() - started
+
+def time_query(app, user: str, text: str, repeat: int) -> dict:
+    samples, hits = [], 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        hits = len(app.search_messages(user, text))
+        samples.append(time.perf_counter() - started)
+    ordered = sorted(samples)
+    return {"hits": hits, "p50_ms": round(statistics.median(ordered) * 1000, 2),
+            "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Full-text message search latency.")
+    parser.add_argument("--messages", type=int, default=100000, help="Stored messages")
+    parser.add_argument("--users", type=int, default=4, help="Users sharing the database")
+    parser.add_argument("--words", type=int, default=60, help="Words per message")
+    parser.add_argument("--vocabulary", type=int, default=20000, help="Distinct words")
+    parser.add_argument("--repeat", type=int, default=20, help="Timed runs per query")
+    parser.add_argument("--windows", type=int, nargs="+", default=[2000, 100000000], help="SEARCH_RANK_WINDOW values")
+    parser.add_argument("--app", default=DEFAULT_APP, help="App script to load")
+    args = parser.parse_args()
+    app = load_app(args.app)
+    if not app.MESSAGE_SEARCH:
+        raise SystemExit("This SQLite build has no FTS5; message search is disabled.")
+    rng = random.Random(1)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    insert_s = populate(app, args.messages, args.users, args.words, vocabulary, rng)
+    queries = {f"rank {rank}": vocabulary[rank] for rank in (0, 10, 100, 1000, 10000) if rank < len(vocabulary)}
+    queries["two common words"] = f"{vocabulary[1]} {vocabulary[2]}"
+    queries["common + rare"] = f"{vocabulary[1]} {vocabulary[-1]}"
+    queries["prefix"] = vocabulary[50][:3] + "*"
+    report = {"messages": args.messages, "users": args.users, "insert_with_index_s": round(insert_s, 2),
+              "db_mb": round(os.path.getsize("chatapp.db") / 1024 / 1024, 1), "windows": {}}
+    for window in args.windows:
+        app.SEARCH_RANK_WINDOW = window
+        report["windows"][str(window)] = {name: {"query": text, **time_query(app, "user0", text, args.repeat)}
+                                          for name, text in queries.items()}
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
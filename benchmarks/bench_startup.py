@@ -0,0 +1,66 @@
+###
+# bench_startup.py: Cold import time per dependency, and cold load time of app scripts (fresh interpreter per sample).
+# Shows what a Pi pays on cold start, and which optional tool packages an app version imports up front.
+# Usage: python benchmarks/bench_startup.py [--repeat 5] [--apps GrokCoder_v1.3-hybridmemoryV1.py GrokCoder-v1.4.py]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from common import DEFAULT_APP, REPO_ROOT
+
+DEPENDENCIES = ["streamlit", "openai", "httpx", "passlib", "dotenv", "pygit2", "black", "requests", "ntplib"]
+OPTIONAL = ["pygit2", "black", "requests", "ntplib"]
+
+IMPORT_SNIPPET = """
+import importlib, time
+start = time.perf_counter()
+importlib.import_module({name!r})
+print(time.perf_counter() - start)
+"""
+
+APP_SNIPPET = """
+import json, sys, time
+sys.path.insert(0, {bench_dir!r})
+start = time.perf_counter()
+from common import load_app
+load_app({app!r})
+print(json.dumps({{"seconds": time.perf_counter() - start,
+                  "optional_loaded": [name for name in {optional!r} if name in sys.modules]}}))
+"""
+
+def run_python(code: str) -> str:
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=REPO_ROOT)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed")
+    return result.stdout.strip().splitlines()[-1]
+
+def median_ms(samples: list) -> float:
+    return round(statistics.median(samples) * 1000, 1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold import and app load times.")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per measurement")
+    parser.add_argument("--apps", nargs="+", default=[DEFAULT_APP], help="App scripts to cold-load")
+    parser.add_argument("--deps", nargs="+", default=DEPENDENCIES)
+    args = parser.parse_args()
+    report = {"python": sys.version.split()[0], "repeat": args.repeat, "imports_ms": {}, "apps": {}}
+    for name in args.deps:
+        try:
+            samples = [float(run_python(IMPORT_SNIPPET.format(name=name))) for _ in range(args.repeat)]
+            report["imports_ms"][name] = median_ms(samples)
+        except RuntimeError as e:
+            report["imports_ms"][name] = f"not installed ({e})"
+    bench_dir = os.path.dirname(os.path.abspath(__file__))
+    for app in args.apps:
+        app_path = os.path.abspath(app)
+        runs = [json.loads(run_python(APP_SNIPPET.format(bench_dir=bench_dir, app=app_path, optional=OPTIONAL)))
+                for _ in range(args.repeat)]
+        report["apps"][os.path.basename(app_path)] = {"cold_load_ms": median_ms([run["seconds"] for run in runs]),
+                                                      "optional_loaded_at_startup": runs[0]["optional_loaded"]}
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
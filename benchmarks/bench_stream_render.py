@@ -0,0 +1,62 @@
+###
+# bench_stream_render.py: CPU cost of rendering a streamed reply, legacy loop vs. StreamRenderer.
+# Usage: python benchmarks/bench_stream_render.py [--tokens 10000] [--tps 80] [--fps 15] [--app PATH]
+import argparse
+import html
+import json
+import random
+
+from common import DEFAULT_APP, FakeContainer, cpu_timed, load_app
+
+def make_tokens(n: int, seed: int = 7):
+    """Synthetic reply: prose with a fenced Python block roughly every 400 tokens (~4 chars/token)."""
+    rng = random.Random(seed)
+    words = ["the", "value", "<tag>", "list", "&", "returns", "quickly", "data", "loop", "\n"]
+    tokens = []
+    while len(tokens) < n:
+        tokens += [rng.choice(words) + " " for _ in range(300)]
+        tokens += ["```", "python\n"] + [f"x{i} = {i} * 2\n" for i in range(100)] + ["```\n"]
+    return tokens[:n]
+
+def legacy_render(tokens, container):
+    """The pre-StreamRenderer loop: escape and re-send the whole reply on every chunk."""
+    response_container = container.empty()
+    full_response = ""
+    for chunk in tokens:
+        full_response += chunk
+        escaped_full = html.escape(full_response)
+        response_container.markdown(f"<div class='chat-bubble-assistant'><div class='wrapped-code'>{escaped_full}</div></div>", unsafe_allow_html=True)
+    return full_response
+
+def incremental_render(app, tokens, container, tps: float, fps: float):
+    clock_state = {"t": 0.0}
+    renderer = app.StreamRenderer(container, fps=fps, clock=lambda: clock_state["t"])
+    for chunk in tokens:
+        clock_state["t"] += 1.0 / tps  # Simulated arrival time of each token
+        renderer.feed(chunk)
+    return renderer.finish(), renderer.frames
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=10000)
+    parser.add_argument("--tps", type=float, default=80.0, help="Simulated model tokens/sec")
+    parser.add_argument("--fps", type=float, default=15.0, help="Renderer frame cap")
+    parser.add_argument("--app", default=DEFAULT_APP)
+    args = parser.parse_args()
+    app = load_app(args.app)
+    tokens = make_tokens(args.tokens)
+    scale = 10000 / args.tokens
+    results = {}
+    legacy_box = FakeContainer()
+    legacy_text, cpu, wall = cpu_timed(legacy_render, tokens, legacy_box)
+    results["legacy"] = {"cpu_ms_per_10k": round(cpu * 1000 * scale, 2), "ui_messages": legacy_box.messages,
+                         "mb_sent": round(legacy_box.bytes_sent / 1e6, 2)}
+    new_box = FakeContainer()
+    (new_text, frames), cpu, wall = cpu_timed(incremental_render, app, tokens, new_box, args.tps, args.fps)
+    assert new_text == legacy_text
+    results["stream_renderer"] = {"cpu_ms_per_10k": round(cpu * 1000 * scale, 2), "ui_messages": new_box.messages,
+                                  "mb_sent": round(new_box.bytes_sent / 1e6, 2), "frames": frames}
+    print(json.dumps({"tokens": args.tokens, "tps": args.tps, "fps": args.fps, "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+###
+# common.py: Shared helpers for the GrokCoder benchmarks (offline, no API key needed).
+# The app scripts are single files with dashes in their names, so they are loaded by path.
+import os
+import sys
+import time
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_APP = os.path.join(REPO_ROOT, "GrokCoder-v1.4.py")
+sys.path.insert(0, REPO_ROOT)
+import batch_runner  # noqa: E402  (its load_app imports the app in bare mode)
+
+def load_app(app_path: str = DEFAULT_APP, workdir: str = None):
+    """Import an app script as a module inside a scratch dir (it creates chatapp.db, prompts/, sandbox/ in CWD)."""
+    app_path = os.path.abspath(app_path)
+    workdir = workdir or tempfile.mkdtemp(prefix="grokcoder-bench-")
+    os.chdir(workdir)
+    os.environ.setdefault("XAI_API_KEY", "bench-offline")
+    os.environ.setdefault("LOG_CONSOLE_LEVEL", "WARNING")  # Keep app log lines out of benchmark output
+    return batch_runner.load_app(app_path)
+
+def cpu_timed(fn, *args, **kwargs):
+    """Run fn and return (result, cpu_seconds, wall_seconds)."""
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.process_time() - cpu0, time.perf_counter() - wall0
+
+class FakeElement:
+    """Stand-in for a Streamlit element/placeholder; encodes payloads to approximate protobuf serialization."""
+    def __init__(self, sink):
+        self.sink = sink
+
+    def markdown(self, body, unsafe_allow_html=False):
+        self.sink.send(body)
+        return self
+
+    def code(self, body, language=None):
+        self.sink.send(body)
+        return self
+
+    def empty(self):
+        return self
+
+    def container(self):
+        return self
+
+class FakeContainer(FakeElement):
+    """Stand-in for st.container(): counts messages and bytes that would go over the websocket."""
+    def __init__(self):
+        super().__init__(self)
+        self.messages = 0
+        self.bytes_sent = 0
+
+    def send(self, body):
+        self.messages += 1
+        self.bytes_sent += len(body.encode("utf-8"))
+
+    def empty(self):
+        return FakeElement(self)
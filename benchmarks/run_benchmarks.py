@@ -0,0 +1,280 @@
+###
+# run_benchmarks.py: Reproducible offline benchmark suite for the GrokCoder hot paths (tools, persistence, memory, rendering).
+# Works against any app version (GrokCoder.py, GrokCoder_v1.3-hybridmemoryV1.py, GrokCoder-v1.4.py, ...): cases whose
+# functions a version lacks are reported as skipped. Results go to JSON; --baseline compares against an earlier run.
+# Usage: python benchmarks/run_benchmarks.py [--app PATH] [--output results.json] [--baseline old.json] [--quick]
+#        python benchmarks/run_benchmarks.py --app GrokCoder.py --output v1.json && \
+#        python benchmarks/run_benchmarks.py --baseline v1.json --fail-on-regression
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import time
+
+from common import DEFAULT_APP, FakeContainer, load_app
+from bench_stream_render import incremental_render, legacy_render, make_tokens
+
+SIZES = {
+    "full": {"tree_files": 5000, "big_file_mb": 8, "memory_rows": [10000, 100000, 1000000], "history_messages": 2000,
+             "db_rows": 500000, "lint_lines": 5000, "render_tokens": 10000, "ops": 200},
+    "quick": {"tree_files": 500, "big_file_mb": 1, "memory_rows": [10000], "history_messages": 200,
+              "db_rows": 20000, "lint_lines": 500, "render_tokens": 2000, "ops": 50},
+}
+
+class Skip(Exception):
+    """Raised by a case when the app version does not have the function under test."""
+
+def require(app, *names):
+    missing = [name for name in names if not hasattr(app, name)]
+    if missing:
+        raise Skip(f"missing {', '.join(missing)}")
+
+def timed(fn, repeat: int) -> dict:
+    """Run fn `repeat` times; report median/min wall time in ms."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {"median_ms": round(statistics.median(samples), 3), "min_ms": round(min(samples), 3)}
+
+def per_op(fn, ops: int, repeat: int) -> dict:
+    """Time `ops` calls of fn(i) as one sample; report per-call cost in microseconds."""
+    result = timed(lambda: [fn(i) for i in range(ops)], repeat)
+    return {"median_us_per_op": round(result["median_ms"] * 1000 / ops, 2), "min_us_per_op": round(result["min_ms"] * 1000 / ops, 2)}
+
+# --- Tools: sandbox file system ---
+def bench_fs(app, size, repeat):
+    require(app, "fs_read_file", "fs_write_file", "fs_list_files", "SANDBOX_DIR")
+    root = os.path.join(app.SANDBOX_DIR, "bench_tree")
+    os.makedirs(root, exist_ok=True)
+    dirs = [f"bench_tree/d{i}" for i in range(50)]
+    for d in dirs:
+        os.makedirs(os.path.join(app.SANDBOX_DIR, d), exist_ok=True)
+    for i in range(size["tree_files"]):
+        with open(os.path.join(app.SANDBOX_DIR, dirs[i % len(dirs)], f"f{i}.txt"), 'w') as f:
+            f.write(f"file {i}\n" * 20)
+    wide = "bench_tree/wide"
+    os.makedirs(os.path.join(app.SANDBOX_DIR, wide), exist_ok=True)
+    for i in range(size["tree_files"]):
+        open(os.path.join(app.SANDBOX_DIR, wide, f"w{i}.txt"), 'w').close()
+    big = "x" * 79 + "\n"
+    big_content = big * (size["big_file_mb"] * 1024 * 1024 // len(big))
+    app.fs_write_file("bench_tree/big.txt", big_content)
+    ops = size["ops"]
+    return {
+        "fs_read_small": per_op(lambda i: app.fs_read_file(f"{dirs[i % len(dirs)]}/f{i}.txt"), ops, repeat),
+        "fs_read_big": timed(lambda: app.fs_read_file("bench_tree/big.txt"), repeat),
+        "fs_write_small": per_op(lambda i: app.fs_write_file(f"bench_tree/w_{i}.txt", "hello\n" * 50), ops, repeat),
+        "fs_write_big": timed(lambda: app.fs_write_file("bench_tree/big_out.txt", big_content), repeat),
+        "fs_list_wide": timed(lambda: app.fs_list_files(wide), repeat),
+        "fs_list_nested": per_op(lambda i: app.fs_list_files(dirs[i % len(dirs)]), ops, repeat),
+    }
+
+# --- Tools: hybrid memory ---
+def seed_memory(app, rows: int, user: str, convo_id: int):
+    """Fill the memory table: `rows` entries spread over many users, 1% of them for the benchmark user.
+    Seeded on a separate connection to the app's chatapp.db (in the scratch dir), so it works for every app version."""
+    def seeded():
+        for i in range(rows):
+            owner, convo = (user, convo_id) if i % 100 == 0 else (f"user{i % 997}", i % 50)
+            yield owner, convo, f"key{i}", json.dumps({"i": i, "note": "seeded"})
+    with contextlib.closing(sqlite3.connect("chatapp.db")) as db, db:
+        db.execute("DELETE FROM memory")
+        db.executemany("INSERT INTO memory (user, convo_id, mem_key, mem_value) VALUES (?, ?, ?, ?)", seeded())
+
+def bench_memory(app, size, repeat):
+    require(app, "memory_insert", "memory_query")
+    user, convo_id, ops = "bench", 1, size["ops"]
+    results = {}
+    for rows in size["memory_rows"]:
+        seed_memory(app, rows, user, convo_id)
+        own_keys = [f"key{i}" for i in range(0, rows, 100)]
+        def cold_query(i):
+            app.st.session_state['memory_cache'] = {}  # Force the DB path
+            return app.memory_query(user, convo_id, own_keys[i % len(own_keys)])
+        results[f"memory_{rows}"] = {
+            "insert": per_op(lambda i: app.memory_insert(user, convo_id, f"new{i}", {"step": i}), ops, repeat),
+            "query_key_cold": per_op(cold_query, ops, repeat),
+            "query_key_warm": per_op(lambda i: app.memory_query(user, convo_id, f"new{i}"), ops, repeat),
+            "query_recent": per_op(lambda i: app.memory_query(user, convo_id, None, 10), ops, repeat),
+        }
+    return results
+
+# --- Persistence: chat history ---
+def make_conversation(n: int, seed: int = 3):
+    rng = random.Random(seed)
+    words = ["refactor", "the", "loop", "into", "a", "generator", "and", "add", "tests", "for", "edge", "cases"]
+    messages = []
+    for i in range(n):
+        role = "user" if i % 2 == 0 else "assistant"
+        body = " ".join(rng.choice(words) for _ in range(40 if role == "user" else 200))
+        if role == "assistant" and i % 6 == 1:
+            body += "\n```python\n" + "\n".join(f"x{j} = {j}" for j in range(30)) + "\n```"
+        messages.append({"role": role, "content": body})
+    return messages
+
+def save_history_legacy(app, user, messages):
+    """The chat page's save step before append-only storage: one INSERT of the whole conversation as JSON per turn."""
+    title = messages[0]['content'][:50] + "..."
+    app.c.execute("INSERT INTO history (user, title, messages) VALUES (?, ?, ?)", (user, title, json.dumps(messages)))
+    app.conn.commit()
+    return app.c.lastrowid
+
+def bench_history(app, size, repeat):
+    require(app, "load_history")
+    messages = make_conversation(size["history_messages"])
+    user = "bench"
+    appended = hasattr(app, "save_turn_messages")  # Append-only storage: a turn writes only its two new messages
+    if appended:
+        convo_id = app.save_turn_messages(user, None, messages, 0, messages[0]['content'][:50] + "...")
+        turn = make_conversation(2, seed=4)
+        def save_turn():
+            app.save_turn_messages(user, convo_id, messages + turn, len(messages), "")
+    else:
+        convo_id = save_history_legacy(app, user, messages)
+        save_turn = lambda: save_history_legacy(app, user, messages)
+    def load():
+        app.load_history(convo_id)  # st.rerun() is a no-op outside a script run
+        assert len(app.st.session_state['messages']) >= len(messages)
+    return {
+        "history_messages": len(messages),
+        "history_json_kb": round(len(json.dumps(messages)) / 1024, 1),
+        "history_storage": "append" if appended else "json_row",
+        "history_save_turn": timed(save_turn, repeat),
+        "history_load": timed(load, repeat),
+    }
+
+# --- Tools: sandbox SQLite ---
+def bench_db_query(app, size, repeat):
+    require(app, "db_query")
+    path = os.path.join(app.SANDBOX_DIR, "bench.db")
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE events (id INTEGER PRIMARY KEY, kind TEXT, score REAL, payload TEXT)")
+    db.execute("CREATE INDEX idx_events_kind ON events (kind)")
+    rng = random.Random(5)
+    db.executemany("INSERT INTO events (kind, score, payload) VALUES (?, ?, ?)",
+                   ((f"k{rng.randrange(100)}", rng.random(), "p" * 40) for _ in range(size["db_rows"])))
+    db.commit()
+    db.close()
+    ops = size["ops"]
+    return {
+        "db_rows": size["db_rows"],
+        "db_query_point": per_op(lambda i: app.db_query("bench.db", "SELECT * FROM events WHERE id=?", [i + 1]), ops, repeat),
+        "db_query_indexed": timed(lambda: app.db_query("bench.db", "SELECT id, score FROM events WHERE kind=? LIMIT 1000", ["k7"]), repeat),
+        "db_query_aggregate": timed(lambda: app.db_query("bench.db", "SELECT kind, COUNT(*), AVG(score) FROM events GROUP BY kind"), repeat),
+        "db_query_update": timed(lambda: app.db_query("bench.db", "UPDATE events SET score = score + 1 WHERE kind=?", ["k3"]), repeat),
+    }
+
+# --- Tools: code_lint ---
+def bench_code_lint(app, size, repeat):
+    require(app, "code_lint")
+    chunk = ("def f{i}(a,b = 2 ,*args):\n    x=[a,b]+list( args )\n    if x :return {{'k':x,'n':len( x )}}\n"
+             "    return None\nclass C{i}( object ):\n    def m(self):return f{i}(1,2,3)\n")
+    code = "".join(chunk.format(i=i) for i in range(size["lint_lines"] // 6))
+    out = app.code_lint("python", code)
+    if out.startswith("Lint error"):
+        raise Skip(out[:80])
+    return {"lint_lines": code.count("\n"), "code_lint_big": timed(lambda: app.code_lint("python", code), repeat)}
+
+# --- UI: chat render loop ---
+def bench_render(app, size, repeat):
+    tokens = make_tokens(size["render_tokens"])
+    results = {"render_tokens": len(tokens)}
+    def run():
+        box = FakeContainer()
+        if hasattr(app, "StreamRenderer"):
+            incremental_render(app, tokens, box, tps=80.0, fps=getattr(app, "STREAM_RENDER_FPS", 15.0))
+        else:
+            legacy_render(tokens, box)  # Versions before StreamRenderer re-render the whole reply per chunk
+        results["ui_messages"] = box.messages
+    results["render_stream"] = timed(run, repeat)
+    return results
+
+CASES = [("fs", bench_fs), ("memory", bench_memory), ("history", bench_history),
+         ("db_query", bench_db_query), ("code_lint", bench_code_lint), ("render", bench_render)]
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    """Map nested results to {"case.metric.stat": value} for the timing stats only."""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif key.startswith("median_"):
+            flat[name] = value
+    return flat
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """Print a per-metric comparison; return the metrics that got slower by more than `threshold`."""
+    now, before = flatten(current["results"]), flatten(baseline["results"])
+    regressions = []
+    print(f"\nComparison vs. {baseline.get('app')} ({baseline.get('timestamp')}):")
+    print(f"{'metric':60} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name in sorted(set(now) & set(before)):
+        if not before[name]:
+            continue
+        change = now[name] / before[name] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{name:60} {before[name]:>12} {now[name]:>12} {change:>+8.1%}{flag}")
+    for name in sorted(set(before) - set(now)):
+        print(f"{name:60} {before[name]:>12} {'-':>12}   (not run)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark suite for GrokCoder app versions.")
+    parser.add_argument("--app", default=DEFAULT_APP, help="App script to benchmark")
+    parser.add_argument("--output", help="Write results JSON here (default: print only)")
+    parser.add_argument("--baseline", help="Earlier results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Relative slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit 1 if any metric regressed (for CI)")
+    parser.add_argument("--only", help="Comma-separated case names: " + ",".join(name for name, _ in CASES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--quick", action="store_true", help="Small sizes for CI smoke runs")
+    parser.add_argument("--memory-rows", help="Override memory table sizes, e.g. 10000,1000000")
+    args = parser.parse_args()
+    size = dict(SIZES["quick" if args.quick else "full"])
+    if args.memory_rows:
+        size["memory_rows"] = [int(n) for n in args.memory_rows.split(",")]
+    app_path = os.path.abspath(args.app)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    app = load_app(app_path)  # Changes CWD to a scratch dir
+    selected = set(args.only.split(",")) if args.only else None
+    report = {"app": os.path.basename(app_path), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(), "platform": platform.platform(), "size": "quick" if args.quick else "full",
+              "repeat": args.repeat, "results": {}, "skipped": {}}
+    for name, case in CASES:
+        if selected and name not in selected:
+            continue
+        started = time.perf_counter()
+        try:
+            report["results"][name] = case(app, size, args.repeat)
+            print(f"[LOG] {name}: done in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        except Skip as e:
+            report["skipped"][name] = str(e)
+            print(f"[LOG] {name}: skipped ({e})", file=sys.stderr)
+    print(json.dumps(report, indent=2))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if baseline_path:
+        with open(baseline_path, 'r') as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
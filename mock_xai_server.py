@@ -0,0 +1,232 @@
+###
+# mock_xai_server.py: Local stand-in for the xAI API (OpenAI-compatible /v1/chat/completions), stdlib only.
+# For offline benchmarks, load tests and CI on air-gapped boxes: point the app at it with
+#   XAI_BASE_URL=http://127.0.0.1:8765/v1 streamlit run GrokCoder-v1.4.py
+# Scriptable behaviour: tokens/sec, time-to-first-token, injected tool calls with chunked arguments,
+# 429/5xx fault injection (with Retry-After), mid-stream disconnects and usage blocks.
+# Usage: python mock_xai_server.py [--port 8765] [--tps 50] [--ttft 0.3] [--tool-calls JSON] [--fault-429 0.1] [--scenario FILE]
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_WORDS = ["Sure", "here", "is", "the", "code", "you", "asked", "for", "with", "tests", "and", "notes"]
+
+class MockConfig:
+    """Behaviour of the mock API. A scenario (list of per-request step dicts, cycled) overrides the defaults
+    request by request, e.g. [{"status": 429, "retry_after": 1}, {"tool_calls": [...]}, {"text": "done"}]."""
+    def __init__(self, tps=50.0, ttft=0.3, reply_tokens=120, text=None, tool_calls=None, arg_chunk_size=16,
+                 fault_429=0.0, fault_5xx=0.0, drop_rate=0.0, retry_after=1.0, scenario=None, seed=None):
+        self.tps = tps
+        self.ttft = ttft
+        self.reply_tokens = reply_tokens
+        self.text = text
+        self.tool_calls = tool_calls or []  # [{"name": ..., "arguments": {...}}], sent when the last message is not a tool result
+        self.arg_chunk_size = arg_chunk_size
+        self.fault_429 = fault_429
+        self.fault_5xx = fault_5xx
+        self.drop_rate = drop_rate
+        self.retry_after = retry_after
+        self._scenario = itertools.cycle(scenario) if scenario else None
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "streams": 0, "faults_429": 0, "faults_5xx": 0, "drops": 0, "tool_call_turns": 0}
+
+    def next_step(self) -> dict:
+        """Resolve the behaviour for one request (scenario step over defaults, random faults applied)."""
+        with self._lock:
+            self.stats["requests"] += 1
+            step = dict(next(self._scenario)) if self._scenario else {}
+            roll = self._rng.random()
+            if "status" not in step:
+                if roll < self.fault_429:
+                    step["status"] = 429
+                elif roll < self.fault_429 + self.fault_5xx:
+                    step["status"] = self._rng.choice([500, 502, 503])
+            if "drop_after" not in step and self._rng.random() < self.drop_rate:
+                step["drop_after"] = self._rng.randint(1, max(self.reply_tokens // 2, 1))
+            return step
+
+    def count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+def reply_tokens(step: dict, config: MockConfig) -> list:
+    text = step.get("text", config.text)
+    if text is not None:
+        return [word + " " for word in text.split(" ")]
+    n = step.get("reply_tokens", config.reply_tokens)
+    words = [DEFAULT_WORDS[i % len(DEFAULT_WORDS)] + " " for i in range(n)]
+    middle = len(words) // 2
+    return words[:middle] + ["\n```python\n", "print('mock')\n", "```\n"] + words[middle:]  # Exercises code-fence rendering
+
+def estimate_prompt_tokens(body: dict) -> int:
+    return sum(len(str(msg.get("content") or "")) // 4 + 4 for msg in body.get("messages", []))
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so client connection reuse can be measured
+    config: MockConfig = None
+
+    def log_message(self, format, *args):
+        pass  # Quiet: benchmarks hammer this server
+
+    def _json(self, status: int, payload: dict, headers: dict = None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith("/models"):
+            self._json(200, {"object": "list", "data": [{"id": m, "object": "model", "owned_by": "mock"}
+                                                        for m in ("grok-4-0709", "grok-3-mini", "grok-code-fast-1")]})
+        elif self.path.rstrip('/').endswith("/stats"):
+            self._json(200, self.config.stats)
+        else:
+            self._json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith("/chat/completions"):
+            self._json(404, {"error": {"message": "not found"}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        config = self.config
+        step = config.next_step()
+        status = step.get("status", 200)
+        if status == 429:
+            config.count("faults_429")
+            self._json(429, {"error": {"message": "Rate limit exceeded (mock)", "type": "rate_limit"}},
+                       {"Retry-After": str(step.get("retry_after", config.retry_after))})
+            return
+        if status >= 400:
+            if status >= 500:
+                config.count("faults_5xx")
+            self._json(status, {"error": {"message": f"Mock error {status}"}})
+            return
+        messages = body.get("messages", [])
+        tool_calls = step.get("tool_calls", config.tool_calls) if body.get("tools") else []
+        if messages and messages[-1].get("role") == "tool":
+            tool_calls = step.get("tool_calls_after_tools", [])  # Default: answer in text after a tool round
+        tokens = [] if tool_calls else reply_tokens(step, config)
+        usage = {"prompt_tokens": estimate_prompt_tokens(body), "completion_tokens": len(tokens) + 10 * len(tool_calls)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if tool_calls:
+            config.count("tool_call_turns")
+        if body.get("stream"):
+            self._stream(body, step, tokens, tool_calls, usage)
+        else:
+            time.sleep(step.get("ttft", config.ttft) + len(tokens) / step.get("tps", config.tps))
+            message = {"role": "assistant", "content": "".join(tokens) or None}
+            if tool_calls:
+                message["tool_calls"] = [{"id": f"call_{i}", "type": "function",
+                                          "function": {"name": call["name"], "arguments": json.dumps(call.get("arguments", {}))}}
+                                         for i, call in enumerate(tool_calls)]
+            self._json(200, {"id": "mock", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+                             "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+                             "usage": usage})
+
+    def _stream(self, body, step, tokens, tool_calls, usage):
+        config = self.config
+        config.count("streams")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        model = body.get("model")
+        def send(delta=None, finish=None, usage_block=None):
+            payload = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                       "choices": [] if usage_block else [{"index": 0, "delta": delta or {}, "finish_reason": finish}]}
+            if usage_block:
+                payload["usage"] = usage_block
+            self._chunk(f"data: {json.dumps(payload)}\n\n".encode())
+        tps = step.get("tps", config.tps)
+        start = time.monotonic() + step.get("ttft", config.ttft)
+        drop_after = step.get("drop_after")
+        try:
+            sent = 0
+            for i, token in enumerate(tokens):
+                delay = start + i / tps - time.monotonic()  # Cumulative schedule keeps high tps accurate
+                if delay > 0:
+                    time.sleep(delay)
+                send({"role": "assistant", "content": token} if i == 0 else {"content": token})
+                sent += 1
+                if drop_after and sent >= drop_after:
+                    config.count("drops")
+                    self.close_connection = True
+                    return  # Disconnect mid-stream without the terminating chunk
+            if tool_calls:
+                time.sleep(max(start - time.monotonic(), 0))
+                chunk_size = step.get("arg_chunk_size", config.arg_chunk_size)
+                for index, call in enumerate(tool_calls):
+                    arguments = json.dumps(call.get("arguments", {}))
+                    send({"tool_calls": [{"index": index, "id": f"call_{index}", "type": "function",
+                                          "function": {"name": call["name"], "arguments": ""}}]})
+                    for pos in range(0, len(arguments), chunk_size):
+                        time.sleep(1 / tps)
+                        send({"tool_calls": [{"index": index, "function": {"arguments": arguments[pos:pos + chunk_size]}}]})
+            send(finish="tool_calls" if tool_calls else "stop")
+            if (body.get("stream_options") or {}).get("include_usage"):
+                send(usage_block=usage)
+            self._chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # Client went away (e.g. user stopped the stream)
+
+    def _chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+def make_server(config: MockConfig = None, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    handler = type("BoundMockHandler", (MockHandler,), {"config": config or MockConfig()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def start_server(config: MockConfig = None, host: str = "127.0.0.1", port: int = 0):
+    """Start the mock in a daemon thread (port 0 = pick a free one). Returns (server, base_url)."""
+    server = make_server(config, host, port)
+    threading.Thread(target=server.serve_forever, name="mock-xai", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stand-in for the xAI API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tps", type=float, default=50.0, help="Streamed tokens per second")
+    parser.add_argument("--ttft", type=float, default=0.3, help="Seconds before the first token")
+    parser.add_argument("--reply-tokens", type=int, default=120, help="Tokens per generated reply")
+    parser.add_argument("--text", help="Fixed reply text instead of generated tokens")
+    parser.add_argument("--tool-calls", default="[]", help='JSON list, e.g. \'[{"name": "fs_list_files", "arguments": {}}]\'')
+    parser.add_argument("--arg-chunk-size", type=int, default=16, help="Characters per streamed arguments fragment")
+    parser.add_argument("--fault-429", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--fault-5xx", type=float, default=0.0, help="Fraction of requests answered with 5xx")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Fraction of streams cut off mid-reply")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds on 429")
+    parser.add_argument("--scenario", help="JSON file with a list of per-request steps (cycled)")
+    parser.add_argument("--seed", type=int, help="Seed for fault injection")
+    args = parser.parse_args()
+    scenario = None
+    if args.scenario:
+        with open(args.scenario, 'r') as f:
+            scenario = json.load(f)
+    config = MockConfig(tps=args.tps, ttft=args.ttft, reply_tokens=args.reply_tokens, text=args.text,
+                        tool_calls=json.loads(args.tool_calls), arg_chunk_size=args.arg_chunk_size,
+                        fault_429=args.fault_429, fault_5xx=args.fault_5xx, drop_rate=args.drop_rate,
+                        retry_after=args.retry_after, scenario=scenario, seed=args.seed)
+    server = make_server(config, args.host, args.port)
+    print(f"[LOG] Mock xAI API on http://{args.host}:{server.server_address[1]}/v1 (tps={args.tps}, ttft={args.ttft}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+###
+# conftest.py: Shared fixtures. The app is loaded once per session in a scratch dir (its chatapp.db, sandbox, logs):
+# its st.cache_resource objects (DB writer, memory buffer, bridge loop) are process-wide anyway.
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+from common import load_app  # noqa: E402
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """The app, with its scratch dir as the working directory (chatapp.db and the sandbox are relative paths)."""
+    cwd = os.getcwd()
+    yield load_app(workdir=str(tmp_path_factory.mktemp("app")))
+    os.chdir(cwd)
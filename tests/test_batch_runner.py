@@ -0,0 +1,31 @@
+###
+# test_batch_runner.py: Resuming a batch run from its output file.
+# Run: python -m pytest -q tests
+import argparse
+import asyncio
+import json
+
+import batch_runner
+
+def test_resume_skips_only_ok_records(tmp_path):
+    output = tmp_path / "results.jsonl"
+    lines = [json.dumps({"id": "a", "status": "ok"}), json.dumps({"id": "b", "status": "error"}),
+             json.dumps({"id": "c", "status": "error"}), json.dumps({"id": "c", "status": "ok"}),
+             '{"id": "d", "stat']  # Truncated by a crash mid-write
+    output.write_text("\n".join(lines))
+    assert batch_runner.completed_ids(str(output)) == {"a", "c"}
+
+def test_resume_without_output_file(tmp_path):
+    assert batch_runner.completed_ids(str(tmp_path / "missing.jsonl")) == set()
+
+def test_append_after_truncated_line_starts_a_new_line(tmp_path):
+    output = tmp_path / "results.jsonl"
+    output.write_text(json.dumps({"id": "a", "status": "ok"}) + '\n{"id": "b", "stat')
+    source = tmp_path / "records.jsonl"
+    source.write_text(json.dumps({"id": "a", "messages": "hi"}) + "\n")
+    args = argparse.Namespace(input=str(source), output=str(output), rps=0, concurrency=1)
+    asyncio.run(batch_runner.run_batch(None, args))  # Nothing pending: only the truncated line is finished
+    assert output.read_text().endswith('"stat\n') and not batch_runner.ends_mid_line(str(output))
+    with open(output, 'a') as out:
+        out.write(json.dumps({"id": "b", "status": "ok"}) + "\n")
+    assert batch_runner.completed_ids(str(output)) == {"a", "b"}
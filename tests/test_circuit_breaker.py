@@ -0,0 +1,92 @@
+###
+# test_circuit_breaker.py: Circuit breaker half-open probes and Retry-After parsing, against the local mock API (offline).
+# Run: python -m pytest -q tests
+import contextlib
+
+import pytest
+from mock_xai_server import MockConfig, start_server
+
+@pytest.fixture(scope="module")
+def base_url():
+    server, url = start_server(MockConfig(tps=500, ttft=0, reply_tokens=40, seed=1))
+    yield url
+    server.shutdown()
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def half_open_breaker(app):
+    """A breaker that has opened after an outage and whose cooldown has just ended."""
+    clock = FakeClock()
+    breaker = app.CircuitBreaker(threshold=1, cooldown=30, clock=clock)
+    breaker.record_failure("server")
+    with pytest.raises(app.CircuitOpenError):
+        breaker.before_request()
+    clock.now += 31
+    assert breaker.state == "half-open"
+    return breaker
+
+def stream(app, base_url, breaker):
+    """Sync iterator over one streamed turn on the app's bridge loop, with its own retry state on `breaker`."""
+    async def core():
+        client = app.get_async_client_registry().get(api_key="test", base_url=base_url)
+        async with contextlib.aclosing(app.astream_chat(client, "grok-4-0709", [{"role": "user", "content": "hi"}],
+                                                        retry=app.RetryState(breaker=breaker))) as pieces:
+            async for piece in pieces:
+                yield piece
+    return app.get_async_bridge().iterate(core())
+
+def test_completed_probe_closes_breaker(app, base_url):
+    breaker = half_open_breaker(app)
+    pieces = list(stream(app, base_url, breaker))
+    assert pieces and not any("API unavailable" in piece for piece in pieces)
+    assert breaker.state == "closed"
+
+def test_abandoned_probe_is_released(app, base_url):
+    breaker = half_open_breaker(app)
+    generator = stream(app, base_url, breaker)
+    next(generator)
+    next(generator)
+    generator.close()  # Rerun/Stop mid-stream: neither success nor failure is recorded
+    assert breaker.state == "half-open"
+    assert breaker.before_request() is True  # The next caller gets to probe instead of failing fast
+    breaker.release_probe()
+    pieces = list(stream(app, base_url, breaker))
+    assert not any("API unavailable" in piece for piece in pieces)
+    assert breaker.state == "closed"
+
+def test_release_probe_only_by_holder(app):
+    breaker = half_open_breaker(app)
+    holder, other = app.RetryState(breaker=breaker), app.RetryState(breaker=breaker)
+    holder.before_request()
+    with pytest.raises(app.CircuitOpenError):
+        other.before_request()
+    other.release_probe()  # Not the probe holder: must not let a second probe through
+    with pytest.raises(app.CircuitOpenError):
+        breaker.before_request()
+    holder.release_probe()
+    assert breaker.before_request() is True
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after": "2"}, 2.0),
+    ({"retry-after": "1.5"}, 1.5),
+    ({"retry-after-ms": "250"}, 0.25),
+    ({"retry-after-ms": "nan"}, None),
+    ({"retry-after-ms": "inf"}, None),
+    ({"retry-after-ms": "-5"}, 0.0),
+    ({"retry-after": "nan"}, None),
+    ({"retry-after": "soon"}, None),
+])
+def test_retry_after_seconds(app, headers, expected):
+    error = type("Error", (Exception,), {})()
+    error.response = type("Response", (), {"headers": headers})()
+    assert app.retry_after_seconds(error) == expected
+
+def test_retry_after_http_date(app):
+    error = type("Error", (Exception,), {})()
+    error.response = type("Response", (), {"headers": {"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}})()
+    assert app.retry_after_seconds(error) == 0.0  # A date in the past means retry now
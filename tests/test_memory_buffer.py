@@ -0,0 +1,32 @@
+###
+# test_memory_buffer.py: Buffered memory_insert rows stay visible to every reader until they are committed.
+# Run: python -m pytest -q tests
+import threading
+
+def test_key_visible_while_flush_commits(app):
+    app.MEMORY_DURABILITY = "buffered"
+    release = threading.Event()
+    app.DB.submit(lambda cur: release.wait(5))  # Keep the writer busy, as under load
+    try:
+        app.memory_insert("alice", 1, "plan", {"v": 1}, cache={})
+        app.MEMORY_BUFFER.flush()  # Handed to the writer, queued behind the busy job
+        assert app.memory_query("alice", 1, "plan", cache={}) == '{"v": 1}'  # Another session: no shared cache
+    finally:
+        release.set()
+    app.MEMORY_BUFFER.flush(wait=True)
+    assert app.MEMORY_BUFFER.get("alice", 1, "plan") is None  # Committed: served by the DB now
+    assert app.memory_query("alice", 1, "plan", cache={}) == '{"v": 1}'
+
+def test_newer_insert_wins_over_inflight(app):
+    app.MEMORY_DURABILITY = "buffered"
+    release = threading.Event()
+    app.DB.submit(lambda cur: release.wait(5))
+    try:
+        app.memory_insert("bob", 1, "step", {"n": 1}, cache={})
+        app.MEMORY_BUFFER.flush()
+        app.memory_insert("bob", 1, "step", {"n": 2}, cache={})
+        assert app.memory_query("bob", 1, "step", cache={}) == '{"n": 2}'
+    finally:
+        release.set()
+    app.MEMORY_BUFFER.flush(wait=True)
+    assert app.memory_query("bob", 1, "step", cache={}) == '{"n": 2}'
@@ -0,0 +1,39 @@
+###
+# test_profiling.py: ProfileCapture setup failures leave nothing behind (profilers, tracemalloc, the loop lock).
+# Run: python -m pytest -q tests
+import threading
+import tracemalloc
+
+def loop_of(app):
+    return app.get_async_bridge().loop
+
+def test_capture_profiles_calling_and_loop_thread(app):
+    capture = app.ProfileCapture("turn", loop=loop_of(app))
+    with capture:
+        sum(range(1000))
+    assert capture.report and capture.report["prof"]
+    assert not app.ProfileCapture._loop_lock.locked() and not tracemalloc.is_tracing()
+
+def test_loop_profiler_is_optional(app):
+    class NoLoopProfiler(app.ProfileCapture):
+        def _on_loop(self, fn):
+            if fn.__name__ == "enable":
+                raise ValueError("Another profiling tool is already active")  # Python 3.12+
+            super()._on_loop(fn)
+    capture = NoLoopProfiler("turn", loop=loop_of(app))
+    with capture:
+        sum(range(1000))
+    assert capture.loop_profile is None and capture.report  # Profiled on the calling thread alone
+    assert not app.ProfileCapture._loop_lock.locked()
+
+def test_failed_enable_is_undone(app):
+    class Busy:
+        def enable(self):
+            raise ValueError("Another profiling tool is already active")
+    capture = app.ProfileCapture("rerun", loop=loop_of(app))
+    capture.profile = Busy()
+    with capture:  # The wrapped rerun still runs, unprofiled
+        ran = True
+    assert ran and capture.report is None
+    assert not tracemalloc.is_tracing() and not app.ProfileCapture._loop_lock.locked()
+    assert threading.get_ident() not in app.ProfileCapture._active
@@ -0,0 +1,48 @@
+###
+# test_stream_render.py: Throttled stream rendering shows the pending tail when the stream stalls.
+# Run: python -m pytest -q tests
+import asyncio
+
+import pytest
+from common import FakeContainer
+
+def test_flush_renders_held_back_text(app):
+    now = {"t": 0.0}
+    box = FakeContainer()
+    renderer = app.StreamRenderer(box, fps=1, clock=lambda: now["t"])
+    renderer.feed("first ")
+    now["t"] = 0.1
+    renderer.feed("second")  # Inside the frame interval: held back
+    assert renderer.frames == 1
+    renderer.flush()
+    assert renderer.frames == 2 and box.messages == 2
+    renderer.flush()  # Nothing pending
+    assert renderer.frames == 2
+
+def test_bridge_calls_on_idle_while_stalled(app):
+    async def stalls():
+        yield "a"
+        await asyncio.sleep(0.35)  # e.g. tools running
+        yield "b"
+    idle_calls = []
+    pieces = list(app.get_async_bridge().iterate(stalls(), on_idle=lambda: idle_calls.append(1), idle=0.1))
+    assert pieces == ["a", "b"] and len(idle_calls) >= 2
+
+def test_bridge_closes_stream_when_on_idle_raises(app):
+    class Rerun(Exception):
+        pass
+    closed = []
+    async def stalls():
+        try:
+            yield "a"
+            await asyncio.sleep(10)  # e.g. waiting on a tool when Streamlit stops the script
+            yield "b"
+        finally:
+            closed.append(1)
+    def on_idle():
+        raise Rerun()
+    generator = app.get_async_bridge().iterate(stalls(), on_idle=on_idle, idle=0.05)
+    assert next(generator) == "a"
+    with pytest.raises(Rerun):  # Not masked by "aclose(): asynchronous generator is already running"
+        next(generator)
+    assert closed == [1]  # The async side unwound before the exception reached the caller
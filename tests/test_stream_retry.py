@@ -0,0 +1,67 @@
+###
+# test_stream_retry.py: A stream cut off mid-reply is retried (logged as a warning) without keeping the interrupted text.
+# Run: python -m pytest -q tests
+import contextlib
+import logging
+
+import pytest
+from common import FakeContainer
+from mock_xai_server import MockConfig, start_server
+
+@pytest.fixture(scope="module")
+def base_url():
+    scenario = [{"text": "interrupted partial reply text", "drop_after": 2}, {"text": "the final answer"}]
+    server, url = start_server(MockConfig(tps=500, ttft=0, scenario=scenario))
+    yield url
+    server.shutdown()
+
+def stream_turn(app, base_url):
+    """All pieces of one streamed turn (through the app's bridge loop) and its TurnState."""
+    turn = app.TurnState()
+    async def core():
+        client = app.get_async_client_registry().get(api_key="test", base_url=base_url)
+        retry = app.RetryState(base_delay=0.01, max_delay=0.01)
+        async with contextlib.aclosing(app.astream_chat(client, "grok-4-0709", [{"role": "user", "content": "hi"}],
+                                                        retry=retry, turn=turn)) as pieces:
+            async for piece in pieces:
+                yield piece
+    return list(app.get_async_bridge().iterate(core())), turn
+
+def test_retry_drops_interrupted_text(app, base_url):
+    pieces, turn = stream_turn(app, base_url)
+    notices = [piece for piece in pieces if isinstance(piece, app.StreamRetry)]
+    assert len(notices) == 1 and notices[0].discard > 0
+    assert "interrupted" in "".join(pieces)  # Shown live before the cut-off
+    assert app.join_stream(pieces) == turn.full_response
+    assert "interrupted" not in turn.full_response and "retrying" not in turn.full_response
+    assert turn.full_response.startswith("the final answer")
+
+def test_retried_attempt_logs_a_warning(app, base_url):
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    app.log_api.addHandler(handler)  # The app's loggers don't propagate to the root logger
+    try:
+        stream_turn(app, base_url)
+    finally:
+        app.log_api.removeHandler(handler)
+    errors = [record for record in records if record.getMessage().startswith("API Error")]
+    assert [record.levelno for record in errors] == [logging.WARNING]
+    assert errors[0].exc_info is None and "retrying in" in errors[0].getMessage()
+
+def test_renderer_saves_only_final_attempt(app, base_url):
+    pieces, turn = stream_turn(app, base_url)
+    renderer = app.StreamRenderer(FakeContainer(), fps=0)
+    for piece in pieces:
+        renderer.feed(piece)
+    assert renderer.finish() == turn.full_response
+
+def test_renderer_redraws_finished_code_blocks(app):
+    renderer = app.StreamRenderer(FakeContainer(), fps=0)
+    renderer.feed("Intro\n")
+    attempt = "```python\nx = 1\n```\nand then"
+    for delta in attempt.split(" "):
+        renderer.feed(delta + " ")
+    renderer.feed(app.StreamRetry("\n[Stream interrupted; retrying...]\n", len(attempt) + 1))
+    renderer.feed("```python\ny = 2\n```")
+    assert renderer.finish() == "Intro\n```python\ny = 2\n```"
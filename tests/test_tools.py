@@ -0,0 +1,71 @@
+###
+# test_tools.py: Tool dispatch (run_tool) with the arguments the model sends, and the clock service behind get_current_time.
+# Run: python -m pytest -q tests
+import pytest
+
+def test_git_ops_dispatch(app, tmp_path, monkeypatch):
+    pytest.importorskip("pygit2")
+    monkeypatch.chdir(tmp_path)  # SANDBOX_DIR is relative to the working directory
+    (tmp_path / "sandbox" / "repo").mkdir(parents=True)
+    ctx = app.ToolContext(user="test")
+    assert app.run_tool("git_ops", {"operation": "init", "repo_path": "repo"}, ctx) == "Repository initialized."
+    (tmp_path / "sandbox" / "repo" / "a.txt").write_text("a")
+    commit = {"operation": "commit", "repo_path": "repo", "message": "Add a"}
+    assert app.run_tool("git_ops", commit, ctx) == "Changes committed."
+    branch = {"operation": "branch", "repo_path": "repo", "name": "feature"}
+    assert app.run_tool("git_ops", branch, ctx) == "Branch 'feature' created."
+
+def test_clock_service_started_by_getter(app):
+    assert app.CLOCK._thread is not None and app.CLOCK._thread.is_alive()
+    assert app.get_clock_service() is app.CLOCK
+
+def test_clock_service_reports_pending_then_unavailable(app, monkeypatch):
+    measured = app.threading.Event()
+    release = app.threading.Event()
+    def measure(self):
+        measured.set()
+        release.wait(5)
+        raise OSError("no route to host")
+    monkeypatch.setattr(app.ClockOffsetService, "measure", measure)
+    clock = app.ClockOffsetService(server="127.0.0.1", retry_interval=60)
+    clock.start()
+    assert measured.wait(5)
+    assert clock.now()[1] == "host (NTP pending)"
+    release.set()
+    for _ in range(100):
+        if clock.last_error:
+            break
+        app.time.sleep(0.01)
+    assert clock.now()[1] == "host (NTP unavailable)"
+
+def test_clock_service_disabled_without_server(app):
+    clock = app.ClockOffsetService(server="")
+    assert clock.now()[1] == "host" and clock._thread is None
+
+def test_capped_calls_wait_outside_the_pool(app, monkeypatch):
+    release = app.threading.Event()
+    running, peak = [], []
+    real_run_tool = app.run_tool
+    def run_tool(func_name, args, ctx):
+        if func_name != "fs_list_files":
+            return real_run_tool(func_name, args, ctx)
+        running.append(1)
+        peak.append(len(running))
+        release.wait(5)
+        running.pop()
+        return "listed"
+    monkeypatch.setattr(app, "run_tool", run_tool)
+    executor = app.ToolExecutor({"fs_list_files": 1}, thread_workers=2)
+    ctx = app.ToolContext(user="test")
+    try:
+        listed = [executor.submit("fs_list_files", "{}", ctx) for _ in range(4)]
+        cancelled = executor.submit("fs_list_files", "{}", ctx)
+        assert cancelled.cancel()  # Still queued for its tool, so it never started
+        # Three listings wait for the cap, yet a second worker is still free for other tools
+        assert executor.submit("get_current_time", "{}", ctx).result(timeout=5)
+        release.set()
+        assert [f.result(timeout=5) for f in listed] == ["listed"] * 4
+    finally:
+        release.set()
+        executor.threads.shutdown(wait=True)
+    assert max(peak) == 1 and not executor._caps["fs_list_files"].running